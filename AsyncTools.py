@@ -0,0 +1,34 @@
+import asyncio
+import inspect
+import threading
+
+_local = threading.local()
+
+
+async def maybe_await(value):
+    """
+    Awaits the result of a call if it is awaitable. Lets one coroutine use either a sync client
+    (which returns results) or an async one (which returns futures)
+
+    :param value: result of a sync or async call
+    :usage:
+    ```python
+    response = await maybe_await(ws.client.chat_postMessage(channel=channel, text=text))
+    ```
+    """
+    if inspect.isawaitable(value):
+        return await value
+    return value
+
+
+def run_sync(coroutine):
+    """
+    Runs a coroutine to completion from sync code, on an event loop kept per thread (cheaper than `asyncio.run` every time)
+
+    :param coroutine: the coroutine to run
+    :rtype: whatever the coroutine returns
+    """
+    loop = getattr(_local, 'loop', None)
+    if loop is None or loop.is_closed():
+        loop = _local.loop = asyncio.new_event_loop()
+    return loop.run_until_complete(coroutine)
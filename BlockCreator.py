@@ -1,6 +1,47 @@
+import json
+import re
 from datetime import datetime
 from pymongo import MongoClient
 
+_SLOT_MARK = "\x1a"  # Control character that can't show up in normal slack text
+_ENCODED_SLOT = re.compile(r"\\u001a(\w+)\\u001a")
+
+MAX_BLOCKS = 50  # Blocks slack accepts in one message
+MAX_VIEW_BLOCKS = 100  # Blocks slack accepts in a modal
+MAX_TEXT = 3000  # Characters in a section's text
+MAX_MESSAGE_BYTES = 40000  # Encoded size of the blocks of one message (slack truncates past 40,000 characters)
+MAX_CONTEXT_ELEMENTS = 10
+MAX_ACTION_ELEMENTS = 25
+MAX_BUTTON_TEXT = 75
+MAX_BUTTON_VALUE = 2000
+
+
+class BlockLimitError(ValueError):
+    """Raised when blocks break one of slack's limits, before they are sent"""
+
+
+def split_text(text: str, limit: int = MAX_TEXT) -> list:
+    """
+    Splits text into parts of at most `limit` characters, at line breaks (or spaces) where it can
+
+    :param text: text to split
+    :param limit: most characters in a part
+    :rtype: list of str
+    """
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 1, limit + 1)
+        if cut == -1:
+            cut = text.rfind(" ", 1, limit + 1)
+        if cut == -1:  # Nowhere to break, so cut a word
+            parts.append(text[:limit])
+            text = text[limit:]
+        else:
+            parts.append(text[:cut])
+            text = text[cut + 1:]
+    parts.append(text)
+    return parts
+
 
 def date_to_words(year: str, month: str, day: str) -> tuple:
     """
@@ -63,13 +104,84 @@ def date_to_words(year: str, month: str, day: str) -> tuple:
     ]
 
 
+def slot(name: str) -> str:
+    """
+    Creates a named placeholder to use in a `BlockTemplate`
+
+    :param name: name of the slot, passed to `BlockTemplate.render`
+
+    :usage:
+    ```python
+    BlockBuilder([]).section(text=f"Hello <@{slot('user')}>!").to_template()
+    ```
+    """
+    return f"{_SLOT_MARK}{name}{_SLOT_MARK}"
+
+
+def _encoded_size(block: dict) -> int:
+    """Bytes a block takes in a message's JSON (ASCII, since non-ASCII characters are escaped)"""
+    return len(json.dumps(block, separators=(",", ":")))
+
+
+class BlockTemplate:
+    """A block compiled once into JSON fragments, rendered by splicing in only the slot values"""
+
+    def __init__(self, block: list):
+        """
+        :param block: usable slack block containing slots (see `slot`)
+        """
+        parts = _ENCODED_SLOT.split(json.dumps(block, separators=(",", ":")))
+        self.fragments = parts[0::2]
+        self.slots = parts[1::2]
+
+    def render(self, **values) -> str:
+        """
+        Renders the template into an encoded JSON block
+
+        :param **values: value of every slot
+        :rtype: str
+
+        :usage:
+        ```python
+        client.api_call("chat.postMessage", data={"channel": channel, "blocks": template.render(user=user)})
+        ```
+        """
+        if not self.slots:
+            return self.fragments[0]
+        rendered = [self.fragments[0]]
+        for name, fragment in zip(self.slots, self.fragments[1:]):
+            rendered.append(json.dumps(str(values[name]))[1:-1])
+            rendered.append(fragment)
+        return "".join(rendered)
+
+    def to_block(self, **values) -> list:
+        """
+        Renders the template into a usable slack block
+
+        :param **values: value of every slot
+        :rtype: Array of dict(s)
+        """
+        return json.loads(self.render(**values))
+
+
 class BlockBuilder:
     """A simple python script for creating slack blocks easily and quickly"""
 
-    def __init__(self, block: list = []):
-        """Creates a `BlockBuilder` object"""
-        # self.block = None
-        self.block = block
+    def __init__(self, block: list = None):
+        """
+        Creates a `BlockBuilder` object. The number of blocks and their encoded size are kept up to date as blocks are added,
+        so limits are checked without measuring the whole message again
+
+        :param block: blocks to start with (a new list if None)
+        """
+        self.block = [] if block is None else block
+        self.sizes = [_encoded_size(block) for block in self.block
+                      ]  # Encoded size of each block, in bytes
+        self.size = sum(self.sizes) + max(len(self.sizes) - 1,
+                                          0) + 2  # Of the whole JSON array
+        self.errors = []  # Limits broken by single blocks
+        for number, block in enumerate(self.block, 1):
+            self._check(block, number)
 
     def divider(self):
         """
@@ -80,38 +192,40 @@ class BlockBuilder:
         BlockBuilder([]).divider()
         ```
         """
-        self.block.append({"type": "divider"})
-        return BlockBuilder(block=self.block)
+        return self._add({"type": "divider"})
 
-    def button(self, name: str = "Button", value: str = "value"):
+    def button(self,
+               name: str = "Button",
+               value: str = "value",
+               action_id: str = None):
         """
         Creates a button
         
         :param name: What the button shows on the block
         :param value: The value sent went clicked
+        :param action_id: Identifies the button in interaction payloads
         
         :usage:
         ```python
-        BlockBuilder([]).button(name='Display Value', value='Value sent when clicked')
+        BlockBuilder([]).button(name='Display Value', value='Value sent when clicked', action_id='routed_action')
         """
-        self.block.append({
-            "type":
-            "actions",
-            "elements": [{
-                "type": "button",
-                "text": {
-                    "type": "plain_text",
-                    "text": f"{name}",
-                    "emoji": True
-                },
-                "value": f"{value}"
-            }]
-        })
-        return BlockBuilder(block=self.block)
+        element = {
+            "type": "button",
+            "text": {
+                "type": "plain_text",
+                "text": f"{name}",
+                "emoji": True
+            },
+            "value": f"{value}"
+        }
+        if action_id:
+            element["action_id"] = action_id
+
+        return self._add({"type": "actions", "elements": [element]})
 
     def section(self, text: str = "text"):
         """
-        Creates a section of text
+        Creates a section of text. Text longer than slack allows is split into more sections
         
         :param text: Text within section
         
@@ -120,14 +234,15 @@ class BlockBuilder:
         BlockBuilder([]).section(text="some text")
         ```
         """
-        self.block.append({
-            "type": "section",
-            "text": {
-                "type": "mrkdwn",
-                "text": text
-            }
-        })
-        return BlockBuilder(block=self.block)
+        for part in split_text(text):
+            self._add({
+                "type": "section",
+                "text": {
+                    "type": "mrkdwn",
+                    "text": part
+                }
+            })
+        return self
 
     def many_buttons(self,
                      name_value: tuple = (["Button1", "b1"], ["Button2",
@@ -135,19 +250,19 @@ class BlockBuilder:
         """
         Creates many buttons. Names and values have to be the same length
 
-        :param name_value: a tuple of tuples of names of buttons and values
+        :param name_value: a tuple of tuples of names of buttons and values (and optionally action_ids)
         :rtype: BlockBuilder
 
         :usage: 
         ```python
-        many_buttons(name_value=(["Button_1", "b_1"],...,["Button_n", "b_n"])
+        many_buttons(name_value=(["Button_1", "b_1", "action_1"],...,["Button_n", "b_n"])
         ```
         """
 
         button_dict = {"type": "actions", "elements": []}
 
         for data in name_value:
-            button_dict["elements"].append({
+            element = {
                 "type": "button",
                 "text": {
                     "type": "plain_text",
@@ -155,11 +270,12 @@ class BlockBuilder:
                     "emoji": True
                 },
                 "value": f"{data[1]}"
-            })
-
-        self.block.append(button_dict)
+            }
+            if len(data) > 2:
+                element["action_id"] = data[2]
+            button_dict["elements"].append(element)
 
-        return BlockBuilder(block=self.block)
+        return self._add(button_dict)
 
     def img(self, title: str = "image", img_data: tuple = ("url", "alt text")):
         """
@@ -175,7 +291,7 @@ class BlockBuilder:
         ```
         """
 
-        self.block.append({
+        return self._add({
             "type": "image",
             "title": {
                 "type": "plain_text",
@@ -186,8 +302,6 @@ class BlockBuilder:
             "alt_text": f"{img_data[1]}"
         })
 
-        return BlockBuilder(block=self.block)
-
     def img_section(self,
                     text: str = "text",
                     img_data: tuple = ("url", "alt text")):
@@ -203,7 +317,7 @@ class BlockBuilder:
         ```
         """
 
-        self.block.append({
+        return self._add({
             "type": "section",
             "text": {
                 "type": "mrkdwn",
@@ -216,14 +330,14 @@ class BlockBuilder:
             }
         })
 
-        return BlockBuilder(block=self.block)
-
     def datepicker(self,
                    text: str = "text",
                    placeholder: str = "Select a date",
                    year=None,
                    month=None,
-                   day=None):
+                   day=None,
+                   initial_date: str = None,
+                   action_id: str = None):
         """
         creates a datepicker element (default today's date) with a section
         
@@ -231,6 +345,8 @@ class BlockBuilder:
         :param year: default year (leave alone if you want today's year)
         :param month: default month (leave alone if you want today's month)
         :param day: default day (leave alone if you want today's day)
+        :param initial_date: default date as `YYYY-MM-DD` (overrides year, month and day)
+        :param action_id: Identifies the datepicker in interaction payloads
         
         :usage: 
         ```python
@@ -239,25 +355,73 @@ class BlockBuilder:
         """
         time = datetime.now()
 
-        self.block.append({
+        accessory = {
+            "type": "datepicker",
+            "initial_date":
+            initial_date if initial_date else
+            f"{year if year else time.year}-{month if month else time.month}-{day if day else time.day}",
+            "placeholder": {
+                "type": "plain_text",
+                "text": "Select a date",
+                "emoji": True
+            }
+        }
+        if action_id:
+            accessory["action_id"] = action_id
+
+        return self._add({
             "type": "section",
             "text": {
                 "type": "mrkdwn",
                 "text": f"{text}"
             },
-            "accessory": {
-                "type": "datepicker",
-                "initial_date":
-                f"{year if year else time.year}-{month if month else time.month}-{day if day else time.day}",
-                "placeholder": {
-                    "type": "plain_text",
-                    "text": "Select a date",
-                    "emoji": True
-                }
-            }
+            "accessory": accessory
         })
 
-        return BlockBuilder(block=self.block)
+    def date_input(self,
+                   label: str = "Date",
+                   block_id: str = None,
+                   action_id: str = None,
+                   initial_date: str = None):
+        """
+        creates an input block with a datepicker, for modals. Its value is sent in the `view_submission` payload
+        (`view.state.values[block_id][action_id].selected_date`)
+
+        :param label: Label above the datepicker
+        :param block_id: Identifies the input in `view.state.values` and in validation errors
+        :param action_id: Identifies the datepicker within its block
+        :param initial_date: default date as `YYYY-MM-DD` (empty if None)
+
+        :usage:
+        ```python
+        BlockBuilder([]).date_input(label="Start Date", block_id="start", action_id="start_date").to_block(max_blocks=MAX_VIEW_BLOCKS)
+        ```
+        """
+        element = {
+            "type": "datepicker",
+            "placeholder": {
+                "type": "plain_text",
+                "text": "Select a date",
+                "emoji": True
+            }
+        }
+        if initial_date:
+            element["initial_date"] = initial_date
+        if action_id:
+            element["action_id"] = action_id
+
+        block = {
+            "type": "input",
+            "label": {
+                "type": "plain_text",
+                "text": f"{label}",
+                "emoji": True
+            },
+            "element": element
+        }
+        if block_id:
+            block["block_id"] = block_id
+        return self._add(block)
 
     def dropdown(self,
                  section_text: str = "text",
@@ -303,9 +467,7 @@ class BlockBuilder:
                 "value": f"{data[1]}"
             })
 
-        self.block.append(builder)
-
-        return BlockBuilder(block=self.block)
+        return self._add(builder)
 
     def overflow(self, text: str = "text", options: tuple = (())):
         """
@@ -336,9 +498,7 @@ class BlockBuilder:
                 "value": f"{data[1]}"
             })
 
-        self.block.append(builder)
-
-        return BlockBuilder(block=self.block)
+        return self._add(builder)
 
     def context(self, data: tuple):
         """creates a context"""
@@ -359,22 +519,152 @@ class BlockBuilder:
                 builder["elements"].append(
                     c_img(url=block[1], alt_text=block[2]))
 
-        self.block.append(builder)
-
-        return BlockBuilder(block=self.block)
+        return self._add(builder)
 
     def append(self, json):
         """Use when ceating blocks not implemented"""
-        self.block.append(json)
+        return self._add(json)
+
+    def validate(self,
+                 max_blocks: int = MAX_BLOCKS,
+                 max_bytes: int = MAX_MESSAGE_BYTES):
+        """
+        Checks the blocks against slack's limits for one message
 
-    def to_block(self):
+        :param max_blocks: most blocks allowed (`MAX_BLOCKS` in a message, 100 in a modal)
+        :param max_bytes: most encoded bytes of blocks allowed
+        :raises BlockLimitError: listing every limit that is broken
+        """
+        errors = list(self.errors)
+        if len(self.block) > max_blocks:
+            errors.append(
+                f"{len(self.block)} blocks, more than the {max_blocks} allowed (use to_messages)"
+            )
+        if self.size > max_bytes:
+            errors.append(
+                f"{self.size} bytes of blocks, more than the {max_bytes} allowed (use to_messages)"
+            )
+        if errors:
+            raise BlockLimitError('; '.join(errors))
+
+    def to_block(self,
+                 max_blocks: int = MAX_BLOCKS,
+                 max_bytes: int = MAX_MESSAGE_BYTES):
         """
         Converts Blockbuilder object into usable slack block
         
+        :param max_blocks: most blocks allowed (`MAX_BLOCKS` in a message, 100 in a modal)
+        :param max_bytes: most encoded bytes of blocks allowed
         :rtype: Array of dict(s)
+        :raises BlockLimitError: if the blocks break slack's limits
         """
+        self.validate(max_blocks, max_bytes)
         return self.block
 
+    def to_messages(self,
+                    max_blocks: int = MAX_BLOCKS,
+                    max_bytes: int = MAX_MESSAGE_BYTES) -> list:
+        """
+        Splits the blocks into as few messages as slack will accept, in order.
+        A message isn't ended right before an `actions` block, so buttons stay with the block they belong to
+        (unless the two don't fit in one message together)
+
+        :param max_blocks: most blocks in a message
+        :param max_bytes: most encoded bytes of blocks in a message
+        :rtype: list of Array of dict(s), one per message
+        :raises BlockLimitError: if a single block breaks slack's limits (splitting can't fix that)
+
+        :usage:
+        ```python
+        for blocks in builder.to_messages():
+            client.chat_postMessage(channel=channel, blocks=blocks)
+        ```
+        """
+        errors = list(self.errors)
+        for number, block_size in enumerate(self.sizes, 1):
+            if block_size + 2 > max_bytes:
+                errors.append(
+                    f"block {number}: {block_size} bytes, more than the {max_bytes} a message allows"
+                )
+        if errors:
+            raise BlockLimitError('; '.join(errors))
+        messages = []
+        message, size = [], 2  # Blocks of the message being filled, and its encoded size
+        for i, (block, block_size) in enumerate(zip(self.block, self.sizes)):
+            if message and (len(message) >= max_blocks
+                            or size + 1 + block_size > max_bytes):
+                carried = 0
+                if block["type"] == "actions" and len(message) > 1 and (
+                        max_blocks > 1
+                        and 2 + self.sizes[i - 1] + 1 + block_size <= max_bytes):
+                    carried = 1  # Moves the block the buttons belong to along with them, if they fit together
+                messages.append(message[:len(message) - carried])
+                message = message[len(message) - carried:]
+                size = 2 + sum(self.sizes[i - carried:i]) + carried
+            size += block_size + (1 if message else 0)
+            message.append(block)
+        if message:
+            messages.append(message)
+        return messages
+
+    def to_template(self):
+        """
+        Compiles the BlockBuilder object into a `BlockTemplate`
+
+        :rtype: BlockTemplate
+
+        :usage:
+        ```python
+        BlockBuilder([]).section(text=f"Hello <@{slot('user')}>!").to_template().render(user="U12345678")
+        ```
+        """
+        return BlockTemplate(self.block)
+
+    def _add(self, block: dict):
+        """Appends a block, keeping the count and size up to date"""
+        block_size = _encoded_size(block)
+        self.size += block_size + (1 if self.block else 0)
+        self.block.append(block)
+        self.sizes.append(block_size)
+        self._check(block, len(self.block))
+        return self
+
+    def _check(self, block: dict, number: int):
+        """Records the limits a block breaks on its own"""
+        position = len(self.errors)
+        text = block.get("text")
+        if block["type"] == "section" and isinstance(text, dict) and len(
+                text.get("text", "")) > MAX_TEXT:
+            self.errors.append(
+                f"section text of {len(text['text'])} characters, more than {MAX_TEXT}"
+            )
+        elements = block.get("elements", [])
+        if block["type"] == "context" and len(elements) > MAX_CONTEXT_ELEMENTS:
+            self.errors.append(
+                f"context with {len(elements)} elements, more than {MAX_CONTEXT_ELEMENTS}"
+            )
+        if block["type"] == "actions" and len(elements) > MAX_ACTION_ELEMENTS:
+            self.errors.append(
+                f"actions with {len(elements)} elements, more than {MAX_ACTION_ELEMENTS}"
+            )
+        for element in elements:
+            if element.get("type") != "button":
+                continue
+            button_text = (element.get("text") or {}).get("text", "")
+            if len(button_text) > MAX_BUTTON_TEXT:
+                self.errors.append(
+                    f"button text of {len(button_text)} characters, more than {MAX_BUTTON_TEXT}"
+                )
+            if len(element.get("value", "")) > MAX_BUTTON_VALUE:
+                self.errors.append(
+                    f"button value of {len(element['value'])} characters, more than {MAX_BUTTON_VALUE}"
+                )
+        for i in range(position, len(self.errors)):
+            self.errors[i] = f"block {number}: {self.errors[i]}"
+
+    def __len__(self) -> int:
+        return len(self.block)
+
     def __str__(self):
         return self.block
 
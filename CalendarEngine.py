@@ -0,0 +1,137 @@
+from datetime import date, datetime
+from functools import lru_cache
+
+import numpy as np
+
+from BlockCreator import date_to_words
+from Database import date_key
+
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+
+def to_ordinal(value) -> int:
+    """
+    Converts a date into its day ordinal (days since 0001-01-01)
+
+    :param value: an int key, a `YYYY-MM-DD` string, a split date array or a date
+    :rtype: int
+    """
+    if isinstance(value, (date, datetime)):
+        return value.toordinal()
+    key = date_key(value)
+    return date(key // 10000, key // 100 % 100, key % 100).toordinal()
+
+
+def from_ordinal(ordinal: int) -> date:
+    """
+    Converts a day ordinal back into a date
+
+    :param ordinal: days since 0001-01-01
+    :rtype: date
+    """
+    return date.fromordinal(int(ordinal))
+
+
+@lru_cache(maxsize=4096)
+def _words(year: str, month: str, day: str) -> str:
+    return date_to_words(year, month, day)[0]
+
+
+def date_words(split_date) -> str:
+    """
+    Cached `date_to_words`, like `First of January, 2026`
+
+    :param split_date: date array (`['YYYY', 'MM', 'DD']`), `YYYY-MM-DD` string or date
+    :rtype: str
+    """
+    if isinstance(split_date, (date, datetime)):
+        split_date = split_date.strftime('%Y-%m-%d')
+    if isinstance(split_date, str):
+        split_date = split_date.split('-')
+    return _words(*(f'{int(part):02}' if i else part
+                    for i, part in enumerate(split_date)))
+
+
+def key_ordinals(keys):
+    """
+    Converts an array of date keys (`YYYYMMDD`) into day ordinals without a python loop
+
+    :param keys: array of int date keys
+    :rtype: numpy array of ordinals
+    """
+    keys = np.asarray(keys, dtype=np.int64)
+    months = (keys // 10000 - 1970) * 12 + keys // 100 % 100 - 1
+    days = months.astype('datetime64[M]').astype('datetime64[D]') + (
+        keys % 100 - 1)
+    return days.astype(np.int64) + _EPOCH_ORDINAL
+
+
+def schedule_ordinals(schedules) -> tuple:
+    """
+    Converts schedule documents into arrays of start and end day ordinals
+
+    :param schedules: iterable of `scheduled_users` documents (with `start_key` and `end_key`)
+    :rtype: tuple of (user ids, start ordinals, end ordinals)
+    """
+    users, starts, ends = [], [], []
+    for schedule in schedules:
+        if not (schedule.get('start_key') and schedule.get('end_key')):
+            continue
+        users.append(schedule['user_id'])
+        starts.append(schedule['start_key'])
+        ends.append(schedule['end_key'])
+    return users, key_ordinals(starts), key_ordinals(ends)
+
+
+def coverage(starts, ends, first_day: int, days: int = 365):
+    """
+    Counts how many people are on call on each day of a horizon
+
+    :param starts: array of start ordinals
+    :param ends: array of end ordinals (inclusive)
+    :param first_day: ordinal of the first day of the horizon
+    :param days: length of the horizon
+    :rtype: numpy array of `days` counts
+    """
+    starts = np.clip(np.asarray(starts) - first_day, 0, days)
+    ends = np.clip(np.asarray(ends) - first_day + 1, 0, days)
+    keep = starts < ends  # Drops schedules outside of the horizon
+
+    changes = np.zeros(days + 1, dtype=np.int64)
+    np.add.at(changes, starts[keep], 1)
+    np.add.at(changes, ends[keep], -1)
+    return np.cumsum(changes[:-1])
+
+
+def runs(mask, first_day: int) -> list:
+    """
+    Groups the days where mask is true into ranges
+
+    :param mask: boolean array, one item per day
+    :param first_day: ordinal of the first day of the mask
+    :rtype: list of (first date, last date) tuples
+    """
+    edges = np.diff(np.concatenate(([0], mask.astype(np.int8), [0])))
+    run_starts = np.flatnonzero(edges == 1)
+    run_ends = np.flatnonzero(edges == -1) - 1
+    return [(from_ordinal(first_day + s), from_ordinal(first_day + e))
+            for s, e in zip(run_starts, run_ends)]
+
+
+def coverage_gaps(schedules, start=None, days: int = 365) -> dict:
+    """
+    Finds the days no one is on call and the days more than one person is
+
+    :param schedules: iterable of `scheduled_users` documents
+    :param start: first day of the horizon (today if None)
+    :param days: length of the horizon
+    :rtype: dict of `gaps` and `overlaps` (lists of date ranges) and the `coverage` array
+    """
+    first_day = to_ordinal(start or datetime.now())
+    users, starts, ends = schedule_ordinals(schedules)
+    counts = coverage(starts, ends, first_day, days)
+    return {
+        'coverage': counts,
+        'gaps': runs(counts == 0, first_day),
+        'overlaps': runs(counts > 1, first_day)
+    }
@@ -0,0 +1,183 @@
+import threading
+import time
+
+from AsyncTools import maybe_await
+
+
+class CommandError(ValueError):
+    """Raised when a command's arguments can't be parsed"""
+
+    def __init__(self, command, message: str):
+        super().__init__(message)
+        self.command = command
+
+
+class Command():
+    """A registered command, with its handler, arguments and counters"""
+
+    def __init__(self, name: str, handler, args: tuple = ()):
+        """
+        :param name: words that trigger the command (like `view on call`)
+        :param handler: function called with the context and parsed arguments
+        :param args: tuple of (name, type) or (name, type, default) for each argument
+        """
+        self.name = name
+        self.handler = handler
+        self.args = args
+        self.invocations = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    @property
+    def usage(self) -> str:
+        """How to type the command, like `view on call [date]`"""
+        words = [self.name]
+        for arg in self.args:
+            words.append(f'[{arg[0]}]' if len(arg) > 2 else f'<{arg[0]}>')
+        return ' '.join(words)
+
+    def parse(self, words: list) -> dict:
+        """
+        Converts the words typed after the command into arguments
+
+        :param words: words after the command name
+        :rtype: dict of argument name to value
+        """
+        if len(words) > len(self.args):
+            raise CommandError(self, f'Too many arguments. Usage: `{self.usage}`')
+
+        parsed = {}
+        for i, arg in enumerate(self.args):
+            name, arg_type = arg[0], arg[1]
+            if i >= len(words):
+                if len(arg) < 3:
+                    raise CommandError(self,
+                                       f'Missing `{name}`. Usage: `{self.usage}`')
+                parsed[name] = arg[2]
+                continue
+            try:
+                parsed[name] = arg_type(words[i])
+            except ValueError as e:
+                raise CommandError(
+                    self, f'Invalid `{name}`: {e}. Usage: `{self.usage}`')
+        return parsed
+
+
+class CommandRouter():
+    """
+    Routes message text to registered commands using a trie of command words
+    """
+
+    def __init__(self):
+        self._root = {}  # word -> child node. A node's command is kept under None
+        self._commands = []
+        self._lock = threading.Lock()
+        self.ignored = 0
+
+    def command(self, name: str, args: tuple = ()):
+        """
+        Decorator registering a function as a command
+
+        :param name: words that trigger the command (like `view on call`)
+        :param args: tuple of (name, type) or (name, type, default) for each argument
+
+        :usage:
+        ```python
+        @router.command("view on call", args=(("date", date_key, None),))
+        def view_on_call(user, channel, date):
+            ...
+        ```
+        """
+
+        def register(handler):
+            node = self._root
+            for word in name.lower().split():
+                node = node.setdefault(word, {})
+            node[None] = Command(name, handler, args)
+            self._commands.append(node[None])
+            return handler
+
+        return register
+
+    def match(self, text: str) -> tuple:
+        """
+        Finds the longest command that the text starts with. Text with more words after a command than the command
+        takes arguments (like "on call rotation is broken today") is ordinary chatter, not a command
+
+        :param text: message text
+        :rtype: tuple of the Command and the remaining words, or (None, None)
+        """
+        words = text.split() if text else []
+        if not words or words[0].lower() not in self._root:
+            return None, None  # Most messages aren't commands, so this has to be quick
+
+        node = self._root
+        found, rest = None, None
+        for i, word in enumerate(words):
+            node = node.get(word.lower())
+            if node is None:
+                break
+            if None in node and len(words) - i - 1 <= len(node[None].args):
+                found, rest = node[None], words[i + 1:]
+        return found, rest
+
+    async def adispatch(self, text: str, **context) -> bool:
+        """
+        Runs the command the text calls for, awaiting the handler if it is a coroutine function
+
+        :param text: message text
+        :param **context: passed to the handler (like `user` and `channel`)
+        :rtype: bool, True if a command was run
+        :raises CommandError: if the command's arguments are invalid
+        """
+        command, words = self.match(text)
+        if command is None:
+            with self._lock:
+                self.ignored += 1
+            return False
+
+        start = time.perf_counter()
+        try:
+            await maybe_await(command.handler(**context, **command.parse(words)))
+        except Exception:
+            self._record_error(command)
+            raise
+        finally:
+            self._record(command, time.perf_counter() - start)
+        return True
+
+    def _record_error(self, command: Command):
+        with self._lock:
+            command.errors += 1
+
+    def _record(self, command: Command, elapsed: float):
+        with self._lock:
+            command.invocations += 1
+            command.total_time += elapsed
+            command.max_time = max(command.max_time, elapsed)
+
+    def stats(self) -> dict:
+        """
+        Invocation counts and latency of every command
+
+        :rtype: dict of command name to counters
+        """
+        with self._lock:
+            return {
+                command.name: {
+                    'invocations':
+                    command.invocations,
+                    'errors':
+                    command.errors,
+                    'avg_time':
+                    command.total_time /
+                    command.invocations if command.invocations else 0.0,
+                    'max_time':
+                    command.max_time
+                }
+                for command in self._commands
+            }
+
+    def __iter__(self):
+        return iter(self._commands)
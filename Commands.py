@@ -0,0 +1,548 @@
+"""
+Commands and interactions of the bot, shared by the Flask app (`app.py`) and the ASGI server (`asgi.py`).
+
+Handlers are coroutine functions that wrap every slack, MongoDB and session call in `maybe_await`,
+so the same code runs on sync clients (driven by `run_sync` from the Flask workers) and on async ones.
+"""
+import asyncio
+import json
+import logging
+import os
+from datetime import datetime
+
+from AsyncTools import maybe_await
+from BlockCreator import MAX_BLOCKS, BlockBuilder, slot
+from CalendarEngine import coverage_gaps, date_words, from_ordinal, to_ordinal
+from CommandRouter import CommandError, CommandRouter
+from Database import date_key, parse_date
+from DmChannels import DmChannels
+from Interactions import InteractionRouter
+from Metrics import metrics
+from Snapshot import Snapshot
+from Workspaces import Workspace
+
+logger = logging.getLogger(__name__)
+
+EVENT_SECONDS = metrics.histogram(
+    'slack_event_seconds', 'Time spent handling slack events, by event type')
+INTERACTION_SECONDS = metrics.histogram(
+    'slack_interaction_seconds',
+    'Time spent handling slack interactions, by action type')
+
+MAX_ON_CALL_PAGE_SIZE = (
+    MAX_BLOCKS - 3) // 2  # Users per `view on call` page (2 blocks each, plus a header and page buttons)
+router = CommandRouter()  # Commands are registered below with @router.command
+interactions = InteractionRouter(
+)  # Buttons are registered below with @interactions.action, modals with @interactions.view
+
+SCHEDULE_PROMPT = BlockBuilder([]).section(
+    text=
+    f"Hello <@{slot('user')}>! Pick the days you will be on call").many_buttons(
+        name_value=(("Pick dates", "open", "schedule_open"), )).to_template()
+SCHEDULE_FORM = BlockBuilder([]).section(
+    text="Pick the first and last day you will be on call.").date_input(
+        label="Start Date",
+        block_id="start",
+        action_id="start_date",
+        initial_date=slot('start')).date_input(
+            label="End Date",
+            block_id="end",
+            action_id="end_date",
+            initial_date=slot('end')).to_template()
+SCHEDULE_SAVED = BlockBuilder([]).section(
+    text=
+    f"You are on call from the *{slot('start')}* to the *{slot('end')}*.\n>Type `view me` to see it again, or `reset on call` to remove yourself from the list."
+).to_template()
+HELP_MESSAGE = BlockBuilder([]).section(
+    text='_Beep Boop_. I am a bot who schedules things!').divider().section(
+        text=
+        '*Command*: `view on call`\n\nThis command displays who is on call on certain dates.\n>Usage: type `view on call` to see who is on call today, or `view on call YYYY-MM-DD` for another day.'
+    ).section(
+        text=
+        '*Command*: `view me`\n\nThis command shows only when you are on call.\n>Usage: type `view me` to view when you are on call.'
+    ).section(
+        text=
+        '*Command*: `on call`\n\nThis command allows you to pick the dates you are on call.\n>Usage: type `on call` and follow the steps I display!'
+    ).section(
+        text=
+        '*Command*: `reset on call`\n\nThis command removes you from the on call list.\n>Usage: type `reset on call` to be removed from the list'
+    ).section(
+        text=
+        '*Command*: `coverage gaps`\n\nThis command lists the days no one is on call and the days more than one person is.\n>Usage: type `coverage gaps` to check the next year, or `coverage gaps 30` for the next 30 days.'
+    ).section(
+        text=
+        '*Command*: `refresh on call`\n\nThis command rebuilds the on call list right away instead of waiting for the next refresh.\n>Usage: type `refresh on call` if `view on call` looks out of date.'
+    ).to_template()
+
+
+def setup_workspace(ws: Workspace, reminders=None, setting=os.getenv):
+    """
+    Adds the bot's own state to a workspace when it is first loaded
+
+    :param ws: the new workspace
+    :param reminders: ShiftReminders that should watch the workspace's schedules, if reminders are on
+    :param setting: function getting a setting by name, with a default (like `Services.setting`)
+    """
+    ws.on_call_page_size = min(int(setting('ON_CALL_PAGE_SIZE', 10)),
+                               MAX_ON_CALL_PAGE_SIZE)
+    ws.flushed_in_background = bool(setting(
+        'BACKGROUND_JOBS', '1'))  # Whether a job flushes buffered writes once they are stale
+    ws.on_call_snapshot = Snapshot(
+        lambda day, page: render_on_call(ws, day, page),
+        max_age=int(setting('ON_CALL_SNAPSHOT_AGE', 300))
+    )  # Rendered `view on call` pages, rebuilt at midnight or after a write
+    ws.db.add_listener(ws.on_call_snapshot.invalidate)
+    ws.schedule_index.add_listener(
+        ws.on_call_snapshot.invalidate)  # Schedules written by another process
+    ws.dms = DmChannels(
+        getattr(ws.db, 'async_database', ws.db.database)['dm_channels'],
+        ws.team_id,
+        max_size=int(setting('DM_CHANNEL_CACHE_SIZE', 4096)),
+        window=int(setting('PING_WINDOW', 60))
+    )  # DM channel of each user, for pings. Pings to a user within the window are combined
+    if setting('SCHEDULE_INDEX_FOLLOW'):  # Needs MongoDB to be a replica set
+        ws.schedule_index.follow(ws.db.database[ws.db.collection])
+    if reminders is not None:
+        reminders.watch(ws)
+
+
+async def run_command(ws: Workspace, message: dict):
+    """
+    Runs the command in a slack message, replying with the usage if its arguments are wrong
+
+    :param ws: workspace the message was sent in
+    :param message: the event sent from slack
+    """
+    user = message.get("user")  # Gets user id of user or None if not a user
+    if not user:  # Makes sure that message is not sent by a bot
+        return
+
+    channel = message.get("channel")  # Gets channel that message was sent in
+    try:
+        with EVENT_SECONDS.time(type=message.get("type", "message")):
+            await router.adispatch(message.get("text"),
+                                   ws=ws,
+                                   user=user,
+                                   channel=channel)
+    except CommandError as e:
+        await maybe_await(
+            ws.client.chat_postEphemeral(user=user,
+                                         channel=channel,
+                                         text=str(e)))
+
+
+async def run_interaction(ws: Workspace, req: dict):
+    """
+    Runs the handlers of an interaction payload. Payloads that `interactions.is_inline` are run before slack is answered,
+    the others after
+
+    :param ws: workspace the interaction came from
+    :param req: the decoded interaction payload
+    """
+    action_type = (req.get('actions') or [{}])[0].get('type', req.get('type'))
+    with INTERACTION_SECONDS.time(type=action_type):
+        await interactions.adispatch(req, ws=ws)
+
+
+async def run_view_submission(ws: Workspace, req: dict) -> dict:
+    """
+    Runs the handler of a submitted modal. Slack shows the response (like validation errors) in the modal
+
+    :param ws: workspace the modal was submitted in
+    :param req: the decoded `view_submission` payload
+    :rtype: dict of the response to send slack, or None to close the modal
+    """
+    with INTERACTION_SECONDS.time(type='view_submission'):
+        return await interactions.asubmit(req, ws=ws)
+
+
+@router.command("on call")
+async def on_call(ws, user, channel):
+    """
+    Command to schedule when on call. Messages don't come with a `trigger_id` to open a modal with,
+    so this posts a button that opens it
+    """
+    await maybe_await(
+        ws.client.api_call("chat.postEphemeral",
+                           data={
+                               "user": user,
+                               "channel": channel,
+                               "blocks": SCHEDULE_PROMPT.render(user=user)
+                           }))
+
+
+def date_arg(value: str) -> int:
+    """Parses a `YYYY-MM-DD` date for `view on call`, refusing days that don't exist"""
+    try:
+        return date_key(datetime.strptime(value, '%Y-%m-%d').date())
+    except ValueError:
+        raise ValueError(f'{value} is not a date like 2030-01-31')
+
+
+@router.command("view on call", args=(("date", date_arg, None), ))
+async def view_on_call(ws, user, channel, date):
+    """See who is on call on whichever dates (today if no date is given)"""
+    await maybe_await(
+        ws.client.api_call("chat.postMessage",
+                           data={
+                               "channel":
+                               channel,
+                               "blocks":
+                               await ws.on_call_snapshot.aget(
+                                   date or date_key(datetime.now()), 0)
+                           }))
+
+
+@router.command("refresh on call")
+async def refresh_on_call(ws, user, channel):
+    """Rebuilds the `view on call` snapshot (for changed profile pictures and the like)"""
+    ws.on_call_snapshot.invalidate()
+    await ws.on_call_snapshot.arefresh(date_key(datetime.now()), 0)
+    await maybe_await(
+        ws.client.chat_postEphemeral(user=user,
+                                     channel=channel,
+                                     text='Refreshed the on call list'))
+
+
+async def render_on_call(ws: Workspace, day: int, page: int = 0) -> str:
+    """
+    Renders one page of `view on call` as JSON, for the snapshot
+
+    :param ws: workspace whose schedules are listed
+    :param day: date key of the day shown
+    :param page: page number, starting at 0
+    :rtype: str
+    """
+    return json.dumps(await on_call_blocks(ws, day, page))
+
+
+async def on_call_blocks(ws: Workspace, day: int, page: int = 0) -> list:
+    """
+    Builds one page of the `view on call` list, with Previous/Next buttons to change pages.
+    Until the workspace's schedule index is loaded (no warm up, no writes yet) only the page is read from MongoDB.
+    Profile pictures missing from the cache are fetched at the same time (with an async client)
+
+    :param ws: workspace whose schedules are listed
+    :param day: date key of the day shown
+    :param page: page number, starting at 0
+    :rtype: Array of dict(s)
+    """
+    size = ws.on_call_page_size
+    if ws.schedule_index.loaded:
+        on_call = ws.schedule_index.at(day)
+        users_page = on_call[page * size:(page + 1) * size]
+        has_next = len(on_call) > (page + 1) * size
+    else:
+        users_page, has_next = await maybe_await(
+            ws.db.on_call_page(day,
+                               page=page,
+                               page_size=size,
+                               collection=ws.db.collection))
+    images = await asyncio.gather(
+        *(ws.profiles.aimage(users['user_id']) for users in users_page))
+
+    block = BlockBuilder([]).section(text='*Dates People are on Call*').divider()
+    if not users_page and page == 0:
+        block.section(text='_No one is on call._')
+
+    for users, image in zip(users_page, images):
+        start_date = users['start_date']
+        end_date = users['end_date']
+
+        block.context(data=((
+            'img', image, '_error displaying user image_'
+        ), ('text',
+            f'<@{users["user_id"]}> is on call from the *{date_words(start_date)}* to the *{date_words(end_date)}*.\n_Contact them if you have any concerns_'
+            ))).button(name="Ping",
+                       value=f'{users["user_id"]}',
+                       action_id="ping")
+
+    pages = []
+    if page > 0:
+        pages.append(("Previous", f"{day}:{page - 1}", "on_call_previous"))
+    if has_next:
+        pages.append(("Next", f"{day}:{page + 1}", "on_call_next"))
+    if pages:
+        block.many_buttons(name_value=pages)
+
+    logger.debug('profile cache: %s', ws.profiles.stats())
+    return block.to_block()
+
+
+def days_arg(value: str) -> int:
+    """Parses a number of days for `coverage gaps`"""
+    days = int(value)
+    if not 1 <= days <= 3650:
+        raise ValueError('should be between 1 and 3650')
+    return days
+
+
+@router.command("coverage gaps", args=(("days", days_arg, 365), ))
+async def view_coverage_gaps(ws, user, channel, days):
+    """Lists the days no one is on call, and the days more than one person is"""
+    first_day = to_ordinal(datetime.now())
+    schedules = ws.schedule_index.between(from_ordinal(first_day),
+                                          from_ordinal(first_day + days - 1))
+    result = coverage_gaps(schedules, start=from_ordinal(first_day), days=days)
+
+    block = BlockBuilder([]).section(
+        text=f'*On call coverage for the next {days} days*').divider()
+    block.section(text='*No one on call*\n' +
+                  format_ranges(result['gaps'], 'Everyone is covered!'))
+    block.section(text='*More than one person on call*\n' +
+                  format_ranges(result['overlaps'], 'No overlaps.'))
+
+    await post_blocks(ws, channel, block, user=user)
+
+
+async def post_blocks(ws: Workspace, channel: str, block: BlockBuilder, user: str = None):
+    """
+    Posts blocks in as many messages as they need to stay under slack's block and size limits
+
+    :param ws: workspace posted in
+    :param channel: channel id
+    :param block: BlockBuilder of the blocks
+    :param user: posts ephemeral messages only this user sees if given
+    :usage:
+    ```python
+    await post_blocks(ws, channel, BlockBuilder([]).section(text=long_text), user=user)
+    ```
+    """
+    for blocks in block.to_messages():
+        if user:
+            await maybe_await(
+                ws.client.chat_postEphemeral(user=user,
+                                             channel=channel,
+                                             blocks=blocks))
+        else:
+            await maybe_await(
+                ws.client.chat_postMessage(channel=channel, blocks=blocks))
+
+
+def format_ranges(ranges: list, empty: str, limit: int = 15) -> str:
+    """
+    Formats date ranges as a markdown list
+
+    :param ranges: list of (first date, last date) tuples
+    :param empty: text shown when there are no ranges
+    :param limit: most ranges listed
+    :rtype: str
+    """
+    if not ranges:
+        return f'_{empty}_'
+    lines = []
+    for first, last in ranges[:limit]:
+        if first == last:
+            lines.append(f'• {date_words(first)}')
+        else:
+            lines.append(f'• {date_words(first)} to {date_words(last)}')
+    if len(ranges) > limit:
+        lines.append(f'_...and {len(ranges) - limit} more_')
+    return '\n'.join(lines)
+
+
+@router.command("reset on call")
+async def reset_on_call(ws, user, channel):
+    """Remove user from on call list"""
+    await maybe_await(
+        ws.db.append(other=[{
+            'user_id': user,
+            'start_date': None,
+            'end_date': None
+        }]))
+    await maybe_await(
+        ws.client.chat_postEphemeral(
+            user=user,
+            channel=channel,
+            text=f'Sucessfully removed you from on call list'))
+
+
+@router.command("help me schedule")
+async def help_me_schedule(ws, user, channel):
+    """Help Command"""
+    await maybe_await(
+        ws.client.api_call("chat.postEphemeral",
+                           data={
+                               "user": user,
+                               "channel": channel,
+                               "blocks": HELP_MESSAGE.render()
+                           }))
+
+
+@router.command("view me")
+async def view_me(ws, user, channel):
+    """Shows when the user is on call"""
+    user_data = ws.schedule_index.get(user) or {}
+    start_date = user_data.get("start_date")
+    end_date = user_data.get("end_date")
+    if not (start_date or end_date):
+        await maybe_await(
+            ws.client.chat_postMessage(
+                channel=channel,
+                text=
+                "You haven't specified when you will be on call! To specify, please type `on call` and follow the steps it gives you."
+            ))
+        return
+
+    block = BlockBuilder(
+        []).section(text="Showing when *you* are on call").divider().section(
+            text=
+            f"You are on call from the *{date_words(start_date)}* to the *{date_words(end_date)}*.\n>If you would like to change this, type `on call`. If you would like to remove yourself from the on call list, type `reset on call`."
+        ).to_block()
+
+    await maybe_await(ws.client.chat_postMessage(channel=channel,
+                                                 blocks=block))
+
+
+@interactions.action("schedule_open", inline=True)
+async def open_schedule(ws, action, req):
+    """
+    Opens the `on call` modal, starting from the user's current dates if they have some.
+    Runs before slack is answered, since the `trigger_id` expires 3 seconds after the click
+    """
+    user_data = ws.schedule_index.get(req['user']['id']) or {}
+    today = datetime.now().strftime('%Y-%m-%d')
+    await maybe_await(
+        ws.client.views_open(
+            trigger_id=req['trigger_id'],
+            view={
+                "type":
+                "modal",
+                "callback_id":
+                "schedule",
+                "title": {
+                    "type": "plain_text",
+                    "text": "On call"
+                },
+                "submit": {
+                    "type": "plain_text",
+                    "text": "Save"
+                },
+                "close": {
+                    "type": "plain_text",
+                    "text": "Cancel"
+                },
+                "blocks":
+                SCHEDULE_FORM.to_block(
+                    start=iso_date(user_data.get('start_date')) or today,
+                    end=iso_date(user_data.get('end_date')) or today)
+            }))
+
+
+def iso_date(split_date) -> str:
+    """
+    Formats a stored split date as `YYYY-MM-DD`
+
+    :param split_date: date array like `['2025', '01', '31']`, or None
+    :rtype: str, or None
+    """
+    return '-'.join(split_date) if split_date else None
+
+
+@interactions.view("schedule")
+async def save_schedule(ws, view, req):
+    """Saves the dates picked in the `on call` modal, or shows slack what is wrong with them"""
+    values = view['state']['values']
+    start_date = values['start']['start_date'].get('selected_date')
+    end_date = values['end']['end_date'].get('selected_date')
+    errors = schedule_errors(start_date, end_date)
+    if errors:
+        return {"response_action": "errors", "errors": errors}
+
+    user = req['user']
+    await maybe_await(
+        ws.db.append(other=[{
+            'user_id': user['id'],
+            'name': user.get('username'),
+            'start_date': parse_date(start_date)[1],
+            'end_date': parse_date(end_date)[1]
+        }],
+                     flush=False))  # Slack is waiting, so the background flush writes it
+    if not ws.flushed_in_background:  # Nothing else would write it
+        await maybe_await(ws.db.push_to_collection(ws.db.collection))
+    return {
+        "response_action": "update",
+        "view": {
+            "type":
+            "modal",
+            "title": {
+                "type": "plain_text",
+                "text": "On call"
+            },
+            "close": {
+                "type": "plain_text",
+                "text": "Done"
+            },
+            "blocks":
+            SCHEDULE_SAVED.to_block(
+                start=date_words(parse_date(start_date)[1]),
+                end=date_words(parse_date(end_date)[1]))
+        }
+    }
+
+
+def schedule_errors(start_date: str, end_date: str, today: int = None) -> dict:
+    """
+    Checks the dates submitted in the `on call` modal
+
+    :param start_date: picked start date as `YYYY-MM-DD`, or None
+    :param end_date: picked end date as `YYYY-MM-DD`, or None
+    :param today: date key of today (defaults to the current date)
+    :rtype: dict of input block_id to error message, empty if the dates are fine
+    """
+    errors = {}
+    keys = {}
+    for block_id, value in (('start', start_date), ('end', end_date)):
+        try:
+            keys[block_id] = date_key(value) if value else None
+        except ValueError:
+            keys[block_id] = None
+        if keys[block_id] is None:
+            errors[block_id] = 'Pick a date'
+    if errors:
+        return errors
+
+    if keys['end'] < keys['start']:
+        errors['end'] = "The end date can't be before the start date"
+    elif keys['end'] < (today or date_key(datetime.now())):
+        errors['end'] = 'The end date has already passed'
+    return errors
+
+
+@interactions.action("ping")
+async def ping(ws, action, req):
+    """DMs an on call user that someone wants to talk to them (pings from a burst share one message)"""
+    await ws.dms.notify(ws.client, action['value'], req["user"]["id"],
+                        ping_text)
+
+
+def ping_text(senders: list) -> str:
+    """
+    Text of the DM sent by the Ping button
+
+    :param senders: user ids of everyone who pinged
+    :rtype: str
+    """
+    if len(senders) == 1:
+        return f'<@{senders[0]}> wants to talk to you about when you\'re on call. Please shoot them a dm.'
+    mentions = ', '.join(f'<@{sender}>' for sender in senders[:-1])
+    return f'{mentions} and <@{senders[-1]}> want to talk to you about when you\'re on call. Please shoot them a dm.'
+
+
+@interactions.action("on_call_previous", "on_call_next")
+async def change_on_call_page(ws, action, req):
+    """Shows another page of `view on call`"""
+    day, page = action['value'].split(':')
+    await maybe_await(
+        ws.client.api_call("chat.update",
+                           data={
+                               "text":
+                               '',
+                               "channel":
+                               req['channel']['id'],
+                               "ts":
+                               req['message']['ts'],
+                               "blocks":
+                               await ws.on_call_snapshot.aget(
+                                   int(day), int(page))
+                           }))
@@ -1,6 +1,18 @@
+import asyncio
 import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
 
-from pymongo import MongoClient
+from pymongo import ASCENDING, DESCENDING, MongoClient, UpdateOne
+
+from Metrics import metrics
+
+MONGO_SECONDS = metrics.histogram('mongo_operation_seconds',
+                                  'Time spent in MongoTools operations')
+MONGO_FLUSHES = metrics.counter('mongo_buffer_flushes_total',
+                                'Write-behind buffer flushes')
 
 
 def parse_date(date: str) -> tuple:
@@ -38,6 +50,59 @@ def parse_date(date: str) -> tuple:
     return (int_dates, split_date)
 
 
+def date_key(value) -> int:
+    """
+    Converts a date into a sortable integer (`YYYYMMDD`), the same one `parse_date` returns
+
+    :param value: an int key, a `YYYY-MM-DD` string, a split date array or a date
+    :rtype: int, or None if value is None
+    """
+    if value is None:
+        return None
+    if isinstance(value, int):
+        return value
+    if isinstance(value, (date, datetime)):
+        return value.year * 10000 + value.month * 100 + value.day
+    if isinstance(value, (list, tuple)):
+        value = '-'.join(value)
+    return parse_date(value)[0]
+
+
+def with_date_keys(document: dict) -> dict:
+    """
+    Adds `start_key` and `end_key` to a schedule document from its `start_date` and `end_date` arrays
+
+    :param document: a document from `scheduled_users`
+    :rtype: dict
+    """
+    if 'start_date' in document:
+        start_date = document['start_date']
+        document['start_key'] = date_key(start_date) if start_date else None
+    if 'end_date' in document:
+        end_date = document['end_date']
+        document['end_key'] = date_key(end_date) if end_date else None
+    return document
+
+
+ON_CALL_ORDER = [('start_key', ASCENDING),
+                 ('user_id', ASCENDING)]  # Same order as `IntervalIndex.between`
+CLOCK_SKEW_SECONDS = 5  # How far apart the clocks of processes writing `updated_at` can be
+FLUSH_LOCK_POLL_SECONDS = 0.01  # How often an async flush checks whether another flush is done
+
+
+def on_call_filter(start, end=None) -> dict:
+    """
+    MongoDB filter for the schedules overlapping two dates (inclusive), served by the (start_key, end_key) index
+
+    :param start: first date (int key, `YYYY-MM-DD`, split date or date)
+    :param end: last date. Same as start if None
+    :rtype: dict
+    """
+    start = date_key(start)
+    end = start if end is None else date_key(end)
+    return {'start_key': {'$lte': end}, 'end_key': {'$gte': start}}
+
+
 class MongoTools():
     """
     Helper functions for MongoDB, specifically for slack applications
@@ -48,38 +113,78 @@ class MongoTools():
                  buffer_size: int = 3,
                  host="localhost",
                  port=27017,
+                 max_age: float = 60,
+                 collection: str = "scheduled_users",
+                 mongo_client: MongoClient = None,
                  **kwargs):
         """
         :param database: Database in MongoDB
         :param buffer_size: Size of buffer of users
         :param host: MongoDB host
         :param port: MongoDB port
+        :param max_age: Seconds a write can wait in the buffer before it is flushed
+        :param collection: Collection the buffer is flushed to
+        :param mongo_client: MongoClient to share (and its connection pool) instead of connecting to host and port
         :param **kwargs: Not implemented yet
         """
-        self.buffer = []
-        self.mc = MongoClient(f'mongodb://{host}:{port}/')
+        self.buffer = OrderedDict()  # user_id -> document, last write wins
+        self.mc = mongo_client or MongoClient(f'mongodb://{host}:{port}/')
         self.database = self.mc[database]
         self.BUFFER_SIZE = buffer_size
+        self.MAX_AGE = max_age
+        self.collection = collection
+
+        self.flushes = 0
+        self.listeners = []  # Called with (user_id, document) for every write
+        self._oldest = None  # When the oldest buffered write was made
+        self._in_flight = {}  # Documents being written by a flush
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
 
     def clear_buffer(self):
-        self.buffer.clear()
+        with self._lock:
+            self.buffer.clear()
+            self._oldest = None
 
-    def append(self, other):
+    def append(self, other, flush: bool = True):
         """
-        Append more elements into the mongo buffer
+        Append more elements into the mongo buffer. Writes to the same user are merged, with the last write winning
 
-        :param other: either a list of dicts or another MongoBuffer
+        :param other: either a list of dicts or another MongoTools
+        :param flush: push the buffer if it is full or stale. If False it is left to the next write or `flush_if_stale`
         """
-        # for documents in other: # * Need to figure out how to use __iter__
-        #    assert documents is dict # ? Deprecated
-        assert type(other) is list or type(other) is MongoTools  # Fixed
-        if len(self.buffer) + len(other) > self.BUFFER_SIZE:
-            self.push_to_collection("scheduled_users")
+        if self._buffer_documents(other) and flush:
+            self.push_to_collection(self.collection)
 
-        self.buffer = [*self.buffer, *other] if type(other) is list else [
-            *self.buffer, *other.buffer
-        ]
-        self.remove_duplicates()
+    def _buffer_documents(self, other) -> bool:
+        """Buffers writes and tells the listeners. Returns whether the buffer should be flushed"""
+        assert isinstance(other, (list, MongoTools))
+        documents = other if type(other) is list else list(
+            other.buffer.values())
+
+        with self._lock:
+            for doc in documents:
+                user_id = doc['user_id']
+                self.buffer[user_id] = {
+                    **self.buffer.pop(user_id, {}),
+                    **doc
+                }
+            if self._oldest is None and self.buffer:
+                self._oldest = time.monotonic()
+            should_flush = len(self.buffer) >= self.BUFFER_SIZE or self._is_stale()
+
+        for listener in self.listeners:
+            for doc in documents:
+                listener(doc['user_id'], doc)
+        return should_flush
+
+    def add_listener(self, listener):
+        """
+        Writes every change through to another store (like an `IntervalIndex`) as it is buffered
+
+        :param listener: function called with the user id and the fields written (None when the user is removed)
+        """
+        self.listeners.append(listener)
 
     def remove_user(self, collection, user_id):
         """
@@ -88,83 +193,413 @@ class MongoTools():
         :param collection: Collection user will be removed from
         :param user_id: user's ID
         """
-        self.database[collection].remove(filter='user_id')
+        with self._lock:
+            self.buffer.pop(user_id, None)
+        self.database[collection].delete_one({'user_id': user_id})
+        for listener in self.listeners:
+            listener(user_id, None)
 
-    def remove_duplicates(self, id_list=None):
+    def pending(self) -> dict:
         """
-        Remove duplicates from the buffer
+        Writes that aren't in MongoDB yet (buffered or being flushed)
+
+        :rtype: dict of user id to the fields written
         """
-        if id_list is None:
-            id_list = self.get_ids()
-        id_set = set(id_list)
-        if len(id_list) == len(id_set):
-            pass  # May add something here later
-        elif len(id_list) > len(id_set):
-            dif = [s if s not in id_list else None for s in id_set]
-            dif = list(filter(lambda x: x, dif))
+        with self._lock:
+            pending = {
+                user_id: dict(doc)
+                for user_id, doc in self._in_flight.items()
+            }
+            for user_id, doc in self.buffer.items():
+                pending[user_id] = {**pending.get(user_id, {}), **doc}
+            return pending
 
-            assert len(self.buffer) >= len(dif)
-            u_buffer = []
-            for i, r_id in enumerate(dif):
-                if self.buffer[i].get("user_id") != r_id:
-                    u_buffer.append(self.buffer[i])
+    def stored_version(self, collection: str = "scheduled_users") -> tuple:
+        """
+        Cheap marker that changes whenever a collection's schedules do: the document count and the newest `updated_at`
 
-            self.buffer = u_buffer
-        else:
-            print('something went wrong...')
+        :param collection: The MongoDB Collection
+        :rtype: tuple
+        """
+        col = self.database[collection]
+        newest = col.find_one({}, {
+            '_id': 0,
+            'updated_at': 1
+        },
+                              sort=[('updated_at', DESCENDING)])
+        return col.estimated_document_count(), (newest or {}).get('updated_at')
 
-    def is_duplicates(self, remove_dupes=False) -> bool:
+    def changed_since(self,
+                      updated_at: datetime,
+                      collection: str = "scheduled_users") -> tuple:
         """
-        Checks if there are duplicates in buffer
-        
-        :param remove_dupes: If true, will also remove duplicates from buffer. Otherwise will only return a bool 
+        Schedules written after a time (the `updated_at` of a `stored_version`), to catch up with other processes
+        without reading the whole collection. Reads from CLOCK_SKEW_SECONDS before, since their clocks can be a bit off
+
+        :param updated_at: the time
+        :param collection: The MongoDB Collection
+        :rtype: tuple of the documents, and how many of them were inserted after the time
         """
-        if len(self.buffer) >= 0:
-            ids = self.get_ids(self.buffer)
-            if ids != set(ids):
-                if remove_dupes:
-                    self.remove_duplicates(ids)
-                return True
-            return False
+        documents = list(self.database[collection].find(
+            {'updated_at': {
+                '$gt': updated_at - timedelta(seconds=CLOCK_SKEW_SECONDS)
+            }}, {
+                '_id': 0,
+                'updated_at': 0
+            }))
+        inserted = 0
+        for doc in documents:
+            created_at = doc.pop('created_at', None)
+            if created_at is not None and created_at > updated_at:
+                inserted += 1
+        return documents, inserted
 
-    def get_ids(self, buffer: list = None) -> list:
+    def get_ids(self, buffer: dict = None) -> list:
         if buffer is None:
             buffer = self.buffer
-        ids = []
-        for document in buffer:
-            ids.append(document.get("id"))
-        return ids
+        return list(buffer)
 
-    def push_to_collection(self, collection: str):
+    def push_to_collection(self, collection: str = "scheduled_users") -> int:
         """
-        Push to specified collection in MongoDB
+        Push to specified collection in MongoDB, as a single unordered `bulk_write` of upserts
 
         :param collection: The MongoDB Collection
+        :rtype: number of documents written
         """
         col = self.database[collection]
 
-        if self.is_duplicates():
-            self.remove_duplicates(id_list=self.get_ids(buffer=self.buffer))
+        with self._flush_lock:
+            taken, oldest = self._take_buffer()
+            if not taken:
+                return 0
+            try:
+                with MONGO_SECONDS.time(operation='push_to_collection'):
+                    col.bulk_write(self._upserts(), ordered=False)
+            except Exception:
+                self._restore_buffer(oldest)
+                raise
+            finally:
+                written = self._clear_in_flight()
+            self.flushes += 1
+            MONGO_FLUSHES.inc()
+            return written
+
+    def _take_buffer(self) -> tuple:
+        """Moves the buffer in flight. Returns whether there was anything to write, and when the oldest write was made"""
+        with self._lock:
+            if not self.buffer:
+                return False, None
+            self._in_flight, self.buffer = self.buffer, OrderedDict()
+            oldest, self._oldest = self._oldest, None
+            return True, oldest
+
+    def _upserts(self) -> list:
+        updated_at = datetime.utcnow()  # Lets other processes see the collection changed (`stored_version`)
+        return [
+            UpdateOne({'user_id': user_id}, {
+                "$set": {
+                    **with_date_keys(dict(doc)), 'updated_at': updated_at
+                },
+                "$setOnInsert": {
+                    'created_at': updated_at
+                }
+            },
+                      upsert=True) for user_id, doc in self._in_flight.items()
+        ]
+
+    def _restore_buffer(self, oldest):
+        """Puts a failed flush back in the buffer, unless the writes have been overwritten since"""
+        with self._lock:
+            for user_id, doc in self._in_flight.items():
+                if user_id in self.buffer:
+                    self.buffer[user_id] = {**doc, **self.buffer[user_id]}
+                else:
+                    self.buffer[user_id] = doc
+            self._oldest = oldest
+
+    def _clear_in_flight(self) -> int:
+        with self._lock:
+            written = len(self._in_flight)
+            self._in_flight = {}
+            return written
+
+    def upsert_many(self,
+                    documents,
+                    collection: str = "scheduled_users",
+                    batch_size: int = 500) -> int:
+        """
+        Upserts documents straight to MongoDB in batches, skipping the buffer. Meant for bulk imports,
+        so the documents can be a generator and only one batch is held in memory
 
-        for doc in self.buffer:
-            col.update_one(filter={'user_id': doc['user_id']},
-                           update={"$set": doc},
-                           upsert=True)
-        self.clear_buffer()
+        :param documents: iterable of dicts with a `user_id`
+        :param collection: The MongoDB Collection
+        :param batch_size: Upserts sent per `bulk_write`
+        :rtype: number of documents written
+        """
+        self.push_to_collection(
+            collection)  # So older buffered writes can't overwrite the import
+        return self._upsert_all(documents, collection, batch_size)
+
+    def _upsert_all(self, documents, collection, batch_size) -> int:
+        col = self.database[collection]
+        written = 0
+        batch = []
+        for doc in documents:
+            batch.append(with_date_keys(dict(doc)))
+            if len(batch) >= batch_size:
+                written += self._upsert_batch(col, batch)
+                batch = []
+        if batch:
+            written += self._upsert_batch(col, batch)
+        return written
+
+    def _upsert_batch(self, col, batch: list) -> int:
+        updated_at = datetime.utcnow()
+        with MONGO_SECONDS.time(operation='upsert_many'):
+            col.bulk_write([
+                UpdateOne({'user_id': doc['user_id']}, {
+                    "$set": {
+                        **doc, 'updated_at': updated_at
+                    },
+                    "$setOnInsert": {
+                        'created_at': updated_at
+                    }
+                },
+                          upsert=True) for doc in batch
+            ],
+                           ordered=False)
+        for listener in self.listeners:
+            for doc in batch:
+                listener(doc['user_id'], doc)
+        return len(batch)
+
+    def flush_if_stale(self, collection: str = "scheduled_users") -> int:
+        """
+        Pushes the buffer if its oldest write is older than `max_age`
+
+        :param collection: The MongoDB Collection
+        :rtype: number of documents written
+        """
+        with self._lock:
+            stale = self._is_stale()
+        return self.push_to_collection(collection) if stale else 0
+
+    def _is_stale(self) -> bool:
+        """Caller must hold the lock"""
+        return self._oldest is not None and time.monotonic(
+        ) - self._oldest >= self.MAX_AGE
+
+    def ensure_indexes(self, collection: str = "scheduled_users"):
+        """
+        Creates the index writes are upserted by, the one `stored_version` reads and the one behind `on_call_between`
+
+        :param collection: The MongoDB Collection
+        """
+        col = self.database[collection]
+        col.create_index('user_id', unique=True)
+        col.create_index('updated_at')
+        col.create_index([('start_key', ASCENDING), ('end_key', ASCENDING)])
+
+    def on_call_between(self,
+                        start,
+                        end=None,
+                        collection: str = "scheduled_users"):
+        """
+        Finds everyone on call at any point between two dates (inclusive) with an indexed query, for lookups
+        that shouldn't load every schedule into an `IntervalIndex` first
+
+        :param start: first date (int key, `YYYY-MM-DD`, split date or date)
+        :param end: last date. Same as start if None
+        :param collection: The MongoDB Collection
+        :rtype: pymongo cursor of schedule documents
+        """
+        return self.database[collection].find(on_call_filter(start, end),
+                                              {'_id': 0})
+
+    def on_call_page(self,
+                     start,
+                     end=None,
+                     page: int = 0,
+                     page_size: int = 10,
+                     collection: str = "scheduled_users") -> tuple:
+        """
+        Gets one page of `on_call_between`, sorted by start date then user id so pages are stable.
+        Only the page (and one more document) is read
+
+        :param start: first date (int key, `YYYY-MM-DD`, split date or date)
+        :param end: last date. Same as start if None
+        :param page: page number, starting at 0
+        :param page_size: documents per page
+        :param collection: The MongoDB Collection
+        :rtype: tuple of the page's documents and whether there is a next page
+        """
+        cursor = self.on_call_between(start, end, collection).sort(
+            ON_CALL_ORDER).skip(page * page_size).limit(page_size + 1)
+        with MONGO_SECONDS.time(operation='on_call_page'):
+            documents = list(cursor)
+        return documents[:page_size], len(documents) > page_size
+
+    def migrate_date_keys(self,
+                          collection: str = "scheduled_users",
+                          batch_size: int = 500) -> int:
+        """
+        Adds `start_key` and `end_key` to documents saved before they existed
+
+        :param collection: The MongoDB Collection
+        :param batch_size: Updates sent per `bulk_write`
+        :rtype: number of documents updated
+        """
+        col = self.database[collection]
+        missing = col.find({'start_key': {
+            '$exists': False
+        }}, {
+            'start_date': 1,
+            'end_date': 1
+        })
+
+        updated = 0
+        batch = []
+        for doc in missing:
+            try:
+                keys = with_date_keys({
+                    'start_date': doc.get('start_date'),
+                    'end_date': doc.get('end_date')
+                })
+            except ValueError:
+                keys = {'start_key': None, 'end_key': None}
+            batch.append(
+                UpdateOne({'_id': doc['_id']}, {
+                    '$set': {
+                        'start_key': keys['start_key'],
+                        'end_key': keys['end_key']
+                    }
+                }))
+            if len(batch) >= batch_size:
+                updated += col.bulk_write(batch, ordered=False).modified_count
+                batch = []
+        if batch:
+            updated += col.bulk_write(batch, ordered=False).modified_count
+        return updated
 
     def __add__(self, other):
         """
         Python '+' operator support
         
-        :param other: Thing added to buffer. Has to be MongoBuffer or list
+        :param other: Thing added to buffer. Has to be MongoTools or list
         """
-        assert isinstance(other, list) or isinstance(other, MongoTools)
-        if len(self.buffer) + len(other) > self.BUFFER_SIZE:
-            self.push_to_collection("scheduled_users")
-        self.buffer = [*self.buffer, *other] if type(other) is list else [
-            *self.buffer, *other.buffer
-        ]
-        self.remove_duplicates()
+        self.append(other)
+        return self
 
     def __len__(self) -> int:
         return len(self.buffer)
+
+
+class AsyncMongoTools(MongoTools):
+    """
+    MongoTools whose writes go through an async driver (motor), for the ASGI server.
+    Reads (like loading an `IntervalIndex`) and imports still use pymongo, so the server runs them off the event loop
+    """
+
+    def __init__(self, async_client, database: str = "users", **kwargs):
+        """
+        :param async_client: `motor.motor_asyncio.AsyncIOMotorClient`
+        :param database: Database in MongoDB
+        :param **kwargs: passed to MongoTools
+        """
+        super().__init__(database=database, **kwargs)
+        self.async_database = async_client[database]
+
+    async def append(self, other, flush: bool = True):
+        """
+        Append more elements into the mongo buffer, flushing it without blocking the event loop
+
+        :param other: either a list of dicts or another MongoTools
+        :param flush: push the buffer if it is full or stale. If False it is left to the next write or `flush_if_stale`
+        """
+        if self._buffer_documents(other) and flush:
+            await self.push_to_collection(self.collection)
+
+    async def push_to_collection(self,
+                                 collection: str = "scheduled_users") -> int:
+        """
+        Push to specified collection in MongoDB, as a single unordered `bulk_write` of upserts.
+        If another flush is running, waits for it (polling, since blocking on its lock would block the event loop)
+        and then pushes what was buffered since
+
+        :param collection: The MongoDB Collection
+        :rtype: number of documents written
+        """
+        while not self._flush_lock.acquire(blocking=False):
+            await asyncio.sleep(FLUSH_LOCK_POLL_SECONDS)
+        try:
+            taken, oldest = self._take_buffer()
+            if not taken:
+                return 0
+            try:
+                with MONGO_SECONDS.time(operation='push_to_collection'):
+                    await self.async_database[collection].bulk_write(
+                        self._upserts(), ordered=False)
+            except Exception:
+                self._restore_buffer(oldest)
+                raise
+            finally:
+                written = self._clear_in_flight()
+            self.flushes += 1
+            MONGO_FLUSHES.inc()
+            return written
+        finally:
+            self._flush_lock.release()
+
+    async def upsert_many(self,
+                          documents,
+                          collection: str = "scheduled_users",
+                          batch_size: int = 500) -> int:
+        """
+        Upserts documents straight to MongoDB in batches, skipping the buffer (see `MongoTools.upsert_many`).
+        The buffer is flushed first, then the batches are written with pymongo off the event loop
+
+        :param documents: iterable of dicts with a `user_id`
+        :param collection: The MongoDB Collection
+        :param batch_size: Upserts sent per `bulk_write`
+        :rtype: number of documents written
+        """
+        await self.push_to_collection(
+            collection)  # So older buffered writes can't overwrite the import
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self._upsert_all, documents, collection, batch_size)
+
+    async def on_call_page(self,
+                           start,
+                           end=None,
+                           page: int = 0,
+                           page_size: int = 10,
+                           collection: str = "scheduled_users") -> tuple:
+        """
+        Gets one page of the schedules overlapping two dates without blocking the event loop (see `MongoTools.on_call_page`)
+
+        :param start: first date (int key, `YYYY-MM-DD`, split date or date)
+        :param end: last date. Same as start if None
+        :param page: page number, starting at 0
+        :param page_size: documents per page
+        :param collection: The MongoDB Collection
+        :rtype: tuple of the page's documents and whether there is a next page
+        """
+        cursor = self.async_database[collection].find(
+            on_call_filter(start, end), {
+                '_id': 0
+            }).sort(ON_CALL_ORDER).skip(page * page_size).limit(page_size + 1)
+        with MONGO_SECONDS.time(operation='on_call_page'):
+            documents = await cursor.to_list(length=page_size + 1)
+        return documents[:page_size], len(documents) > page_size
+
+    async def flush_if_stale(self,
+                             collection: str = "scheduled_users") -> int:
+        """
+        Pushes the buffer if its oldest write is older than `max_age`
+
+        :param collection: The MongoDB Collection
+        :rtype: number of documents written
+        """
+        with self._lock:
+            stale = self._is_stale()
+        return await self.push_to_collection(collection) if stale else 0
@@ -0,0 +1,205 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from AsyncTools import maybe_await
+
+
+class _Burst():
+    """Messages to one user that are being coalesced into a single DM"""
+
+    __slots__ = ('expires_at', 'senders', 'channel', 'ts')
+
+    def __init__(self, expires_at, sender):
+        self.expires_at = expires_at
+        self.senders = [sender]
+        self.channel = None
+        self.ts = None  # Set once the DM is posted
+
+
+class DmChannels():
+    """
+    Maps users to the bot's DM channel with them, so DMs don't need a `conversations.open` call first.
+    Channels are kept in an LRU in front of a MongoDB collection (DM channel ids never change), and
+    DMs sent to the same user within `window` seconds are coalesced into one message
+    """
+
+    def __init__(self,
+                 collection,
+                 team_id: str,
+                 max_size: int = 4096,
+                 window: float = 60,
+                 clock=time.monotonic):
+        """
+        :param collection: pymongo (or motor) collection of `{_id: '<team>:<user>', channel}` documents, or None to only keep them in memory
+        :param team_id: workspace the channels are in
+        :param max_size: Most channels kept in memory
+        :param window: Seconds after a DM is sent that more DMs to the same user are added to it
+        :param clock: Function returning the current time in seconds
+        """
+        self.collection = collection
+        self.team_id = team_id
+        self.MAX_SIZE = max_size
+        self.WINDOW = window
+        self.clock = clock
+
+        self._channels = OrderedDict()  # user_id -> channel id
+        self._bursts = OrderedDict()  # user_id -> _Burst, oldest first
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.stored_hits = 0  # Found in MongoDB
+        self.opened = 0
+        self.coalesced = 0
+
+    async def channel(self, client, user_id: str) -> str:
+        """
+        Gets the DM channel with a user, opening it only if it isn't known
+
+        :param client: slack client (sync or async) used if the channel has to be opened
+        :param user_id: slack user id
+        :rtype: str of the channel id
+        """
+        with self._lock:
+            channel = self._channels.get(user_id)
+            if channel is not None:
+                self._channels.move_to_end(user_id)
+                self.hits += 1
+                return channel
+
+        doc = await maybe_await(
+            self.collection.find_one({'_id': self._key(user_id)
+                                      })) if self.collection is not None else None
+        if doc is not None:
+            self.stored_hits += 1
+            channel = doc['channel']
+        else:
+            response = await maybe_await(
+                client.conversations_open(users=user_id))
+            channel = response['channel']['id']
+            self.opened += 1
+            if self.collection is not None:
+                await maybe_await(
+                    self.collection.update_one({'_id': self._key(user_id)},
+                                               {'$set': {
+                                                   'channel': channel
+                                               }},
+                                               upsert=True))
+        self.put(user_id, channel)
+        return channel
+
+    async def notify(self, client, user_id: str, sender: str, render) -> bool:
+        """
+        DMs a user on behalf of a sender. If the user was DMed less than `window` seconds ago,
+        the sender is added to that message instead of sending another one
+
+        :param client: slack client (sync or async)
+        :param user_id: user the DM is sent to
+        :param sender: user id the DM is from
+        :param render: function turning the list of senders into the message text
+        :rtype: bool, False if the sender was already in the message
+        :usage:
+        ```python
+        await ws.dms.notify(ws.client, 'U123', 'U456', lambda senders: f'{len(senders)} people pinged you')
+        ```
+        """
+        now = self.clock()
+        with self._lock:
+            while self._bursts and next(iter(
+                    self._bursts.values())).expires_at <= now:
+                self._bursts.popitem(last=False)
+            burst = self._bursts.get(user_id)
+            if burst is None:
+                burst = self._bursts[user_id] = _Burst(now + self.WINDOW,
+                                                       sender)
+            elif sender in burst.senders:
+                self.coalesced += 1
+                return False
+            else:
+                burst.senders.append(sender)
+                self.coalesced += 1
+                if burst.ts is None:  # The first DM is still being sent, and will include this sender
+                    return True
+                senders, channel, ts = list(
+                    burst.senders), burst.channel, burst.ts
+                burst = None
+
+        if burst is None:
+            await maybe_await(
+                client.chat_update(channel=channel, ts=ts,
+                                   text=render(senders)))
+            return True
+
+        try:
+            channel = await self.channel(client, user_id)
+            senders = list(burst.senders)
+            response = await maybe_await(
+                client.chat_postMessage(channel=channel,
+                                        text=render(senders)))
+        except Exception:
+            with self._lock:  # So the next sender tries again
+                if self._bursts.get(user_id) is burst:
+                    del self._bursts[user_id]
+            raise
+        with self._lock:
+            burst.channel, burst.ts = channel, response['ts']
+            missed = len(burst.senders) > len(senders)
+            senders = list(burst.senders)
+        if missed:  # Senders added while the DM was being sent
+            await maybe_await(
+                client.chat_update(channel=channel,
+                                   ts=response['ts'],
+                                   text=render(senders)))
+        return True
+
+    def put(self, user_id: str, channel: str):
+        """
+        Adds a channel to the in-memory map
+
+        :param user_id: slack user id
+        :param channel: id of the DM channel with the user
+        """
+        with self._lock:
+            self._channels[user_id] = channel
+            self._channels.move_to_end(user_id)
+            while len(self._channels) > self.MAX_SIZE:
+                self._channels.popitem(last=False)
+
+    def warm(self) -> int:
+        """
+        Loads the stored channels into memory (the most `max_size`). Needs a pymongo collection
+
+        :rtype: int of channels loaded
+        """
+        if self.collection is None:
+            return 0
+        loaded = 0
+        for doc in self.collection.find(
+            {'_id': {
+                '$regex': f'^{re.escape(self.team_id)}:'
+            }}).limit(self.MAX_SIZE):
+            self.put(doc['_id'].split(':', 1)[1], doc['channel'])
+            loaded += 1
+        return loaded
+
+    def stats(self) -> dict:
+        """
+        Channel map and coalescing counters
+
+        :rtype: dict of hits, stored hits, opened, coalesced and size
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'stored_hits': self.stored_hits,
+                'opened': self.opened,
+                'coalesced': self.coalesced,
+                'size': len(self._channels)
+            }
+
+    def _key(self, user_id) -> str:
+        return f'{self.team_id}:{user_id}'
+
+    def __len__(self) -> int:
+        return len(self._channels)
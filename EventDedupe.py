@@ -0,0 +1,206 @@
+import abc
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from pymongo import ReturnDocument
+
+
+def event_key(event_data: dict) -> str:
+    """
+    Key identifying a slack event across retries. Messages use their `client_msg_id`, which stays the same
+    when one message is delivered to several subscriptions; other events use the envelope's `event_id`
+
+    :param event_data: Events API payload
+    :rtype: str, or None if the event can't be identified
+    """
+    message = event_data.get('event') or {}
+    if message.get('client_msg_id'):
+        return f"{event_data.get('team_id')}:{message['client_msg_id']}"
+    return event_data.get('event_id')
+
+
+def interaction_key(req: dict) -> str:
+    """
+    Key identifying an interaction payload across retries
+
+    :param req: decoded interaction payload
+    :rtype: str, or None if the interaction can't be identified
+    """
+    if req.get('trigger_id'):
+        return req['trigger_id']
+    action = (req.get('actions') or [{}])[0]
+    if action.get('action_ts'):
+        return f"{(req.get('user') or {}).get('id')}:{action['action_ts']}"
+    return None
+
+
+class EventDedupe(abc.ABC):
+    """
+    Interface for remembering which slack events were already handled, so the events slack redelivers
+    (`X-Slack-Retry-Num`) when a handler is slow aren't run twice
+    """
+
+    def __init__(self):
+        self.checked = 0
+        self.suppressed = 0
+
+    @abc.abstractmethod
+    def seen(self, key: str) -> bool:
+        """
+        Marks an event as handled
+
+        :param key: `event_key` or `interaction_key` (None is never a duplicate)
+        :rtype: bool, True if the event was already handled (so it should be skipped)
+        """
+
+    @abc.abstractmethod
+    def forget(self, key: str):
+        """
+        Unmarks an event, so a retry of it is handled (when it was dropped instead of run)
+
+        :param key: key passed to `seen`
+        """
+
+    def stats(self) -> dict:
+        """
+        Dedupe counters
+
+        :rtype: dict of events checked and retries suppressed
+        """
+        return {'checked': self.checked, 'suppressed': self.suppressed}
+
+    def _count(self, duplicate: bool) -> bool:
+        self.checked += 1
+        if duplicate:
+            self.suppressed += 1
+        return duplicate
+
+
+class MemoryEventDedupe(EventDedupe):
+    """
+    Dedupe for a single process. Keys are remembered for `ttl` seconds and the oldest are evicted past `max_size`
+    """
+
+    def __init__(self,
+                 ttl: float = 900,
+                 max_size: int = 10000,
+                 clock=time.monotonic):
+        """
+        :param ttl: Seconds an event is remembered (slack retries for about 5 minutes)
+        :param max_size: Most keys kept
+        :param clock: Function returning the current time in seconds
+        """
+        super().__init__()
+        self.TTL = ttl
+        self.MAX_SIZE = max_size
+        self.clock = clock
+        self._seen = OrderedDict()  # key -> expires_at, oldest first
+        self._lock = threading.Lock()
+
+    def seen(self, key: str) -> bool:
+        if key is None:
+            return False
+        with self._lock:
+            now = self.clock()
+            expires_at = self._seen.get(key)
+            if expires_at is not None and expires_at > now:
+                return self._count(True)
+
+            self._seen.pop(key, None)
+            self._seen[key] = now + self.TTL
+            while self._seen and (len(self._seen) > self.MAX_SIZE or
+                                  next(iter(self._seen.values())) <= now):
+                self._seen.popitem(last=False)
+            return self._count(False)
+
+    def forget(self, key: str):
+        with self._lock:
+            self._seen.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._seen)
+
+
+class MongoEventDedupe(EventDedupe):
+    """
+    Dedupe shared by every worker and instance, kept in a MongoDB collection with a TTL index
+    """
+
+    def __init__(self,
+                 database,
+                 collection: str = "seen_events",
+                 ttl: int = 900):
+        """
+        :param database: pymongo database (like `MongoTools().database`)
+        :param collection: Collection keys are kept in
+        :param ttl: Seconds an event is remembered
+        """
+        super().__init__()
+        self.TTL = ttl
+        self.collection = database[collection]
+
+    def ensure_indexes(self):
+        """Creates the TTL index that makes MongoDB delete old keys"""
+        self.collection.create_index('seen_at', expireAfterSeconds=self.TTL)
+
+    def seen(self, key: str) -> bool:
+        if key is None:
+            return False
+        # One atomic upsert, so two instances getting the same retry can't both run it
+        doc = self.collection.find_one_and_update(
+            {'_id': key}, {'$setOnInsert': {
+                'seen_at': datetime.utcnow()
+            }},
+            upsert=True,
+            return_document=ReturnDocument.BEFORE)
+        return self._count(self._is_duplicate(key, doc))
+
+    def forget(self, key: str):
+        self.collection.delete_one({'_id': key})
+
+    def _is_duplicate(self, key, doc) -> bool:
+        if doc is None:
+            return False
+        if doc['seen_at'] <= self._expired_before(
+        ):  # MongoDB only removes expired documents every minute
+            self.collection.update_one(
+                {'_id': key}, {'$set': {
+                    'seen_at': datetime.utcnow()
+                }})
+            return False
+        return True
+
+    def _expired_before(self):
+        return datetime.utcnow() - timedelta(seconds=self.TTL)
+
+
+class AsyncMongoEventDedupe(MongoEventDedupe):
+    """
+    MongoEventDedupe on an async driver (motor), for the ASGI server. Its methods are coroutines
+    """
+
+    async def ensure_indexes(self):
+        await self.collection.create_index('seen_at',
+                                           expireAfterSeconds=self.TTL)
+
+    async def seen(self, key: str) -> bool:
+        if key is None:
+            return False
+        doc = await self.collection.find_one_and_update(
+            {'_id': key}, {'$setOnInsert': {
+                'seen_at': datetime.utcnow()
+            }},
+            upsert=True,
+            return_document=ReturnDocument.BEFORE)
+        if doc is not None and doc['seen_at'] <= self._expired_before():
+            await self.collection.update_one(
+                {'_id': key}, {'$set': {
+                    'seen_at': datetime.utcnow()
+                }})
+            doc = None
+        return self._count(doc is not None)
+
+    async def forget(self, key: str):
+        await self.collection.delete_one({'_id': key})
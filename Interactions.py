@@ -0,0 +1,151 @@
+import json
+from urllib.parse import parse_qs
+
+from AsyncTools import maybe_await
+
+try:  # Optional faster JSON backend
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def loads(data):
+    """
+    Decodes JSON with orjson if it is installed, otherwise with the json module
+
+    :param data: JSON string or bytes
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def decode_payload(body) -> dict:
+    """
+    Decodes the form-encoded body slack sends to the interactive endpoint (`payload=<url-encoded JSON>`)
+
+    :param body: raw request body (bytes or str)
+    :rtype: dict of the interaction payload
+    :raises ValueError: if there is no payload or it isn't JSON
+    """
+    if isinstance(body, bytes):
+        body = body.decode()
+    payload = parse_qs(body).get('payload')
+    if not payload:
+        raise ValueError('Interaction body has no payload')
+    return loads(payload[0])
+
+
+class InteractionRouter():
+    """
+    Routes interaction actions to handlers by `action_id` (or `block_id`), and modal submissions by `callback_id`
+    """
+
+    def __init__(self):
+        self._handlers = {}  # action_id or block_id -> handler
+        self._views = {}  # callback_id -> view submission handler
+        self._inline = set()  # action_ids and block_ids whose handlers run while slack waits
+        self.unhandled = 0
+
+    def action(self, *keys, inline: bool = False):
+        """
+        Decorator registering a function for one or more action_ids/block_ids.
+        The function is called with the action, the whole payload and any context passed to `adispatch`
+
+        :param *keys: action_ids or block_ids handled by the function
+        :param inline: run it before slack is answered instead of queueing it (for handlers using the payload's
+            `trigger_id`, which expires 3 seconds after the click)
+
+        :usage:
+        ```python
+        @interactions.action("ping")
+        def ping(ws, action, req):
+            ...
+        ```
+        """
+
+        def register(handler):
+            for key in keys:
+                self._handlers[key] = handler
+                if inline:
+                    self._inline.add(key)
+            return handler
+
+        return register
+
+    def view(self, *callback_ids):
+        """
+        Decorator registering a function for the submissions of one or more modals.
+        The function is called with the submitted view, the whole payload and any context passed to `asubmit`,
+        and returns the response slack gets (like validation errors), or None to close the modal
+
+        :param *callback_ids: callback_ids of the modals handled by the function
+
+        :usage:
+        ```python
+        @interactions.view("schedule")
+        def save_schedule(ws, view, req):
+            return {"response_action": "errors", "errors": {"end": "..."}}
+        ```
+        """
+
+        def register(handler):
+            for callback_id in callback_ids:
+                self._views[callback_id] = handler
+            return handler
+
+        return register
+
+    def is_inline(self, req: dict) -> bool:
+        """
+        Whether an interaction payload has an action registered with `inline=True`
+
+        :param req: the decoded interaction payload
+        :rtype: bool
+        """
+        return any(
+            action.get('action_id') in self._inline
+            or action.get('block_id') in self._inline
+            for action in req.get('actions') or ())
+
+    async def asubmit(self, req: dict, **context) -> dict:
+        """
+        Runs the handler of a `view_submission` payload, awaiting it if it is a coroutine function. Slack waits
+        for its response, so it has to be run while the request is open instead of being queued
+
+        :param req: the decoded interaction payload
+        :param **context: passed to the handler (like the workspace)
+        :rtype: dict of the response to send slack, or None to close the modal
+        """
+        handler = self._view_handler(req)
+        if handler is None:
+            return None
+        return await maybe_await(handler(view=req['view'], req=req, **context))
+
+    async def adispatch(self, req: dict, **context) -> int:
+        """
+        Runs the handler of every action in an interaction payload, awaiting handlers that are coroutine functions
+
+        :param req: the decoded interaction payload
+        :param **context: passed to the handler (like the workspace)
+        :rtype: int, number of actions handled
+        """
+        handled = 0
+        for action in req.get('actions') or ():
+            handler = self._handler(action)
+            if handler is None:
+                self.unhandled += 1
+                continue
+            await maybe_await(handler(action=action, req=req, **context))
+            handled += 1
+        return handled
+
+    def _view_handler(self, req: dict):
+        handler = self._views.get((req.get('view') or {}).get('callback_id'))
+        if handler is None:
+            self.unhandled += 1
+        return handler
+
+    def _handler(self, action: dict):
+        return self._handlers.get(action.get('action_id')) or self._handlers.get(
+            action.get('block_id'))
@@ -0,0 +1,340 @@
+import hashlib
+import json
+import logging
+import threading
+
+from Database import date_key, with_date_keys
+
+logger = logging.getLogger(__name__)
+
+
+class _Node():
+    """Node of a centered interval tree"""
+
+    __slots__ = ('center', 'by_start', 'by_end', 'left', 'right')
+
+    def __init__(self, intervals: list):
+        """
+        :param intervals: list of (start, end, user_id) tuples
+        """
+        endpoints = sorted(
+            [point for interval in intervals for point in interval[:2]])
+        self.center = endpoints[len(endpoints) // 2]
+
+        here, left, right = [], [], []
+        for interval in intervals:
+            if interval[1] < self.center:
+                left.append(interval)
+            elif interval[0] > self.center:
+                right.append(interval)
+            else:
+                here.append(interval)
+
+        self.by_start = sorted(here)  # Ascending start
+        self.by_end = sorted(here, key=lambda i: i[1],
+                             reverse=True)  # Descending end
+        self.left = _Node(left) if left else None
+        self.right = _Node(right) if right else None
+
+
+def content_hash(documents: list) -> str:
+    """
+    Hash of schedule documents that doesn't depend on which process loaded them (or in what order their fields are)
+
+    :param documents: schedule documents, in a fixed order
+    :rtype: str
+    """
+    digest = hashlib.sha1()
+    for doc in documents:
+        digest.update(
+            json.dumps({k: v
+                        for k, v in doc.items() if k != '_id'},
+                       sort_keys=True,
+                       default=str).encode())
+    return digest.hexdigest()[:16]
+
+
+class IntervalIndex():
+    """
+    In-memory index of everyone's on call range, answering point and range queries in O(log n + k).
+    Users written since the tree was built are kept in an overlay that queries scan, and the tree is only rebuilt
+    once the overlay has more than `overlay_size` users, so a burst of writes doesn't rebuild it on every query.
+    Writes made by this process are applied as they happen; `refresh` picks up the ones made elsewhere
+    (other workers, imports)
+    """
+
+    def __init__(self,
+                 loader=None,
+                 version=None,
+                 changes=None,
+                 overlay_size: int = 256):
+        """
+        :param loader: function returning every schedule document, called on first use and by `refresh`
+        :param version: cheap function returning a value that changes whenever the stored schedules do, so `refresh` only reloads when it has to
+        :param changes: function taking the `version` the index was loaded at and the current one, returning the schedules written in between (or None if it can't tell, like after a delete), so `refresh` doesn't reload everything
+        :param overlay_size: Most users written since the tree was built before it is rebuilt
+        """
+        self.loader = loader
+        self.version = version
+        self.changes = changes
+        self.OVERLAY_SIZE = overlay_size
+        self.documents = {}  # user_id -> schedule document
+        self.listeners = []  # Called after `refresh` reloads the index
+        self.reloads = 0
+        self.updates = 0  # Refreshes that only read the schedules written since the last one
+        self._root = None
+        self._overlay = set()  # Users written since the tree was built, whose tree entries are stale
+        self._dirty = True
+        self._loaded = loader is None
+        self._stored_version = None  # `version` when the index was last loaded
+        self._recent = None  # Writes applied while a refresh is reading, so they aren't lost when it loads
+        self._lock = threading.RLock()
+        self._refresh_lock = threading.Lock()
+        self._writes = 0
+        self._content_version = (None, None)  # (`_writes` it was computed at, hash of the schedules)
+
+    def load(self, documents):
+        """
+        Replaces the index with the given schedules
+
+        :param documents: iterable of `scheduled_users` documents
+        """
+        with self._lock:
+            self.documents = {
+                doc['user_id']: doc if 'start_key' in doc else with_date_keys(
+                    dict(doc))
+                for doc in documents
+            }
+            self._dirty = True
+            self._overlay.clear()
+            self._loaded = True
+            self._writes += 1
+
+    def apply(self, user_id: str, document: dict = None):
+        """
+        Writes a change through to the index. Fields are merged into the user's current document
+
+        :param user_id: user's ID
+        :param document: the fields written, or None if the user was removed
+        """
+        with self._lock:
+            self._ensure_loaded()
+            if self._recent is not None:
+                self._recent.append((user_id, document))
+            if document is None:
+                self.documents.pop(user_id, None)
+            else:
+                self.documents[user_id] = with_date_keys({
+                    **self.documents.get(user_id, {}),
+                    **document
+                })
+            if not self._dirty:
+                self._overlay.add(user_id)
+            self._writes += 1
+
+    @property
+    def loaded(self) -> bool:
+        """Whether the schedules were loaded, so queries won't read MongoDB"""
+        return self._loaded
+
+    def refresh(self) -> bool:
+        """
+        Catches the index up if the stored schedules changed since it was loaded: with `changes` only the schedules
+        written since are read, otherwise (or if they can't be) everything is reloaded. Run it periodically, off the
+        request path
+
+        :rtype: bool, True if the index was updated
+        """
+        if self.loader is None or not self._refresh_lock.acquire(blocking=False):
+            return False  # Nothing to load from, or another refresh is running
+        try:
+            with self._lock:
+                if not self._loaded:
+                    self._ensure_loaded()
+                    return True
+                self._recent = []
+            try:
+                stored_version = self.version() if self.version else None
+                changed = stored_version is None or stored_version != self._stored_version
+                documents = written = None  # Read outside the lock, so queries aren't held up
+                if changed and self.changes and None not in (
+                        stored_version, self._stored_version):
+                    written = self.changes(self._stored_version,
+                                           stored_version)
+                if changed and written is None:
+                    documents = list(self.loader())
+            except Exception:
+                with self._lock:
+                    self._recent = None
+                raise
+
+            with self._lock:
+                recent, self._recent = self._recent, None
+                if not changed:
+                    return False
+                if written is not None:
+                    for document in written:
+                        self.apply(document['user_id'], document)
+                    self.updates += 1
+                else:
+                    self.load(documents)
+                    self.reloads += 1
+                for user_id, document in recent:  # Writes made while the loader was reading
+                    self.apply(user_id, document)
+                self._stored_version = stored_version
+        finally:
+            self._refresh_lock.release()
+        for listener in self.listeners:
+            listener()
+        return True
+
+    def add_listener(self, listener):
+        """
+        Calls a function whenever `refresh` reloads the index (like a cache built from it)
+
+        :param listener: function called with no arguments
+        """
+        self.listeners.append(listener)
+
+    def get(self, user_id: str) -> dict:
+        """
+        Gets a user's schedule
+
+        :param user_id: user's ID
+        :rtype: dict, or None if the user isn't scheduled
+        """
+        with self._lock:
+            self._ensure_loaded()
+            return self.documents.get(user_id)
+
+    def at(self, point) -> list:
+        """
+        Finds everyone on call on a day
+
+        :param point: the day (int key, `YYYY-MM-DD`, split date or date)
+        :rtype: list of schedule documents, sorted by start date then user id
+        """
+        return self.between(point, point)
+
+    def between(self, start, end) -> list:
+        """
+        Finds everyone on call at any point between two days (inclusive)
+
+        :param start: first day (int key, `YYYY-MM-DD`, split date or date)
+        :param end: last day
+        :rtype: list of schedule documents, sorted by start date then user id
+        """
+        start, end = date_key(start), date_key(end)
+        with self._lock:
+            root = self._tree()
+            found = []
+            self._search(root, start, end, found)
+            if self._overlay:
+                found = [
+                    interval for interval in found
+                    if interval[2] not in self._overlay
+                ]
+                for user_id in self._overlay:
+                    doc = self.documents.get(user_id)
+                    if doc and doc.get('start_key') and doc.get(
+                            'end_key') and doc['start_key'] <= end and doc[
+                                'end_key'] >= start:
+                        found.append(
+                            (doc['start_key'], doc['end_key'], user_id))
+            found.sort(key=lambda interval: (interval[0], interval[2]))
+            return [self.documents[user_id] for _, _, user_id in found]
+
+    def snapshot(self) -> tuple:
+        """
+        Gets every schedule with dates, and the version they are from
+
+        :rtype: tuple of the version (a hash of the schedules, so every process holding the same schedules agrees on it)
+            and a list of schedule documents, sorted by start date then user id
+        """
+        with self._lock:
+            self._ensure_loaded()
+            documents = [
+                doc for doc in self.documents.values()
+                if doc.get('start_key') and doc.get('end_key')
+            ]
+            writes = self._writes
+            hashed_at, version = self._content_version
+        documents.sort(key=lambda doc: (doc['start_key'], doc['user_id']))
+        if hashed_at != writes:
+            version = content_hash(documents)
+            with self._lock:
+                self._content_version = (writes, version)
+        return version, documents
+
+    def follow(self, collection) -> threading.Thread:
+        """
+        Keeps the index current from a MongoDB change stream (needs a replica set), for writes made by other processes
+
+        :param collection: pymongo collection of schedules
+        :rtype: the thread reading the change stream
+        """
+        ids = {}  # _id -> user_id, since delete events only have the _id
+
+        def watch():
+            try:
+                with collection.watch(full_document='updateLookup') as stream:
+                    for change in stream:
+                        doc = change.get('fullDocument')
+                        if doc is not None:
+                            ids[doc['_id']] = doc['user_id']
+                            self.apply(doc['user_id'], doc)
+                        elif change['operationType'] == 'delete':
+                            user_id = ids.pop(change['documentKey']['_id'],
+                                              None)
+                            if user_id:
+                                self.apply(user_id, None)
+            except Exception as e:
+                logger.exception(e)
+
+        thread = threading.Thread(target=watch,
+                                  name='interval-index-follow',
+                                  daemon=True)
+        thread.start()
+        return thread
+
+    def _ensure_loaded(self):
+        if not self._loaded:
+            self._stored_version = self.version() if self.version else None
+            self.load(self.loader())
+
+    def _tree(self):
+        """Rebuilds the tree if it was reloaded or the overlay is full. Caller must hold the lock"""
+        self._ensure_loaded()
+        if self._dirty or len(self._overlay) > self.OVERLAY_SIZE:
+            intervals = [(doc['start_key'], doc['end_key'], user_id)
+                         for user_id, doc in self.documents.items()
+                         if doc.get('start_key') and doc.get('end_key')]
+            self._root = _Node(intervals) if intervals else None
+            self._dirty = False
+            self._overlay.clear()
+        return self._root
+
+    @staticmethod
+    def _search(node, start, end, found):
+        while node is not None:
+            if end < node.center:  # Everything here ends at or after the center
+                for interval in node.by_start:
+                    if interval[0] > end:
+                        break
+                    found.append(interval)
+                node = node.left
+            elif start > node.center:  # Everything here starts at or before the center
+                for interval in node.by_end:
+                    if interval[1] < start:
+                        break
+                    found.append(interval)
+                node = node.right
+            else:  # The query covers the center, so everything here overlaps
+                found.extend(node.by_start)
+                IntervalIndex._search(node.left, start, end, found)
+                node = node.right
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._ensure_loaded()
+            return len(self.documents)
@@ -0,0 +1,123 @@
+import json
+import logging
+import queue
+from datetime import datetime
+from logging.handlers import (QueueHandler, QueueListener, RotatingFileHandler,
+                              TimedRotatingFileHandler)
+from pprint import pformat
+
+payloads = logging.getLogger(
+    'payloads')  # Raw slack payloads. Off unless enabled in LOG_LEVELS
+
+
+class Pretty():
+    """
+    Wraps an object so it is only pretty-printed if the log record is actually written
+
+    :usage:
+    ```python
+    payloads.debug('%s', Pretty(event_data))
+    ```
+    """
+
+    __slots__ = ('obj', )
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        return pformat(self.obj)
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as one JSON object per line"""
+
+    def format(self, record) -> str:
+        entry = {
+            'time': datetime.fromtimestamp(record.created).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage()
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class _LazyQueueHandler(QueueHandler):
+    """
+    QueueHandler that leaves formatting to the background writer, so the request thread only enqueues
+    """
+
+    def prepare(self, record):
+        if record.exc_info and not record.exc_text:
+            # Tracebacks can't be pickled or kept around safely, so render them now
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def parse_levels(levels: str) -> dict:
+    """
+    Parses per-module log levels
+
+    :param levels: comma separated `logger=LEVEL` pairs, like `app=INFO,payloads=DEBUG`
+    :rtype: dict of logger name to level name
+    """
+    parsed = {}
+    for pair in (levels or '').split(','):
+        if '=' not in pair:
+            continue
+        name, level = pair.split('=', 1)
+        parsed[name.strip()] = level.strip().upper()
+    return parsed
+
+
+def configure_logging(filename: str = 'debug.log',
+                      level: str = 'DEBUG',
+                      levels: str = '',
+                      max_bytes: int = 10 * 1024 * 1024,
+                      backup_count: int = 5,
+                      when: str = None) -> QueueListener:
+    """
+    Sends every log record through a queue to a background thread that writes rotated JSON lines
+
+    :param filename: log file
+    :param level: level of the root logger
+    :param levels: per-module levels, like `app=INFO,payloads=DEBUG` (payloads are off unless listed)
+    :param max_bytes: size a log file is rotated at (when `when` isn't set)
+    :param backup_count: rotated files kept
+    :param when: rotate on time instead of size (`midnight`, `H`, ... see TimedRotatingFileHandler)
+    :rtype: QueueListener, stop it on shutdown to flush the queue
+    """
+    if when:
+        file_handler = TimedRotatingFileHandler(filename,
+                                                when=when,
+                                                backupCount=backup_count)
+    else:
+        file_handler = RotatingFileHandler(filename,
+                                           maxBytes=max_bytes,
+                                           backupCount=backup_count)
+    file_handler.setFormatter(JsonFormatter())
+
+    records = queue.Queue(-1)
+    listener = QueueListener(records,
+                             file_handler,
+                             respect_handler_level=True)
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_LazyQueueHandler(records))
+    root.setLevel(level.upper())
+
+    payloads.setLevel(logging.WARNING)
+    for name, module_level in parse_levels(levels).items():
+        logging.getLogger(name).setLevel(module_level)
+
+    listener.start()
+    return listener
@@ -0,0 +1,271 @@
+import threading
+import time
+from bisect import bisect_left
+from functools import wraps
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+GAUGE_STATS = frozenset(
+    ('workspaces', 'clients', 'size', 'queued', 'depth', 'workers',
+     'avg_wait', 'max_wait', 'avg_time',
+     'max_time'))  # `stats()` keys that can go down. Every other key is a count that only goes up
+
+
+def _format_labels(labels) -> str:
+    if not labels:
+        return ''
+    pairs = []
+    for key, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+            '\n', '\\n')
+        pairs.append(f'{key}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+def stat_samples(prefix: str, stats: dict, help: str, labels: dict = None):
+    """
+    Turns a `stats()` dict into collector samples. Counts that only go up are counters named `<prefix><key>_total`,
+    the rest (sizes, averages) are gauges named `<prefix><key>`
+
+    :param prefix: metric name prefix, like `profile_cache_`
+    :param stats: the counters
+    :param help: description shown in `/metrics`
+    :param labels: prometheus labels of every sample
+    :rtype: generator of (name, type, help, labels dict, value)
+    """
+    for key, value in stats.items():
+        if key in GAUGE_STATS:
+            yield (prefix + key, 'gauge', help, labels or {}, value)
+        else:
+            yield (prefix + key + '_total', 'counter', help, labels or {},
+                   value)
+
+
+class _NullTimer():
+    """Timer used while metrics are disabled, so timing costs nothing"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer():
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+class Counter():
+    """A value that only goes up, like the number of buffer flushes"""
+
+    TYPE = 'counter'
+
+    def __init__(self, registry, name: str, help: str):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.values = {}  # label tuple -> value
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        """
+        Adds to the counter
+
+        :param amount: amount added
+        :param **labels: prometheus labels of the series
+        """
+        if not self.registry.enabled:
+            return
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, value)
+                    for key, value in self.values.items()]
+
+
+class Histogram():
+    """Distribution of durations (in seconds), counted into buckets"""
+
+    TYPE = 'histogram'
+
+    def __init__(self,
+                 registry,
+                 name: str,
+                 help: str,
+                 buckets: tuple = DEFAULT_BUCKETS):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.series = {}  # label tuple -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        """
+        Records one value
+
+        :param value: the value (seconds, for timings)
+        :param **labels: prometheus labels of the series
+        """
+        if not self.registry.enabled:
+            return
+        key = tuple(sorted(labels.items()))
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [0] * (len(self.buckets) + 2)
+            series[i] += 1  # i == len(buckets) is the +Inf bucket
+            series[-2] += value
+            series[-1] += 1
+
+    def time(self, **labels):
+        """
+        Context manager that records how long its block takes
+
+        :param **labels: prometheus labels of the series
+
+        :usage:
+        ```python
+        with MONGO_SECONDS.time(operation="push_to_collection"):
+            ...
+        ```
+        """
+        if not self.registry.enabled:
+            return _NULL_TIMER
+        return _Timer(self, labels)
+
+    def timed(self, **labels):
+        """
+        Decorator that records how long a function takes
+
+        :param **labels: prometheus labels of the series
+        """
+
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.time(**labels):
+                    return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, series in self.series.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets, series):
+                    cumulative += count
+                    samples.append(
+                        (f'{self.name}_bucket', key + (('le', bound), ),
+                         cumulative))
+                samples.append((f'{self.name}_bucket', key + (('le', '+Inf'), ),
+                                series[-1]))
+                samples.append((f'{self.name}_sum', key, series[-2]))
+                samples.append((f'{self.name}_count', key, series[-1]))
+        return samples
+
+
+class Registry():
+    """
+    Holds every metric and renders them in the prometheus text format.
+    Recording is skipped until the first scrape (or METRICS_ENABLED is set), so there is no overhead without a scraper
+    """
+
+    def __init__(self, enabled: bool = False):
+        """
+        :param enabled: If true, metrics are recorded before the first scrape
+        """
+        self.enabled = enabled
+        self.metrics = {}  # name -> Counter or Histogram
+        self.collectors = {}  # module and name of the function -> collector
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, help: str = '') -> Counter:
+        """
+        Gets (or creates) a counter
+
+        :param name: metric name, ending in `_total`
+        :param help: description shown in `/metrics`
+        """
+        return self._get(Counter, name, help)
+
+    def histogram(self,
+                  name: str,
+                  help: str = '',
+                  buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        """
+        Gets (or creates) a histogram
+
+        :param name: metric name, ending in `_seconds` for timings
+        :param help: description shown in `/metrics`
+        :param buckets: upper bounds of the buckets
+        """
+        return self._get(Histogram, name, help, buckets)
+
+    def collector(self, func):
+        """
+        Registers a function called on every scrape, for values that are already counted elsewhere (like cache stats).
+        It returns an iterable of (name, type, help, labels dict, value). Registering the same function again
+        (like the method of a newer app) replaces it, so its samples aren't rendered twice
+
+        :param func: the collector function
+        """
+        self.collectors[f'{func.__module__}.{func.__qualname__}'] = func
+        return func
+
+    def render(self) -> str:
+        """
+        Renders every metric in the prometheus text format, and starts recording if it wasn't already
+
+        :rtype: str
+        """
+        self.enabled = True
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.TYPE}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{_format_labels(labels)} {value}')
+
+        families = {}  # name -> (type, help, sample lines), so every family's samples are together
+        for collect in list(self.collectors.values()):
+            for name, metric_type, help, labels, value in collect():
+                family = families.get(name)
+                if family is None:
+                    family = families[name] = (metric_type, help, [])
+                family[2].append(
+                    f'{name}{_format_labels(sorted(labels.items()))} {value}')
+        for name, (metric_type, help, samples) in families.items():
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            lines.extend(samples)
+        return '\n'.join(lines) + '\n'
+
+    def _get(self, metric_class, name, *args):
+        with self._lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = metric_class(self, name, *args)
+            return metric
+
+
+metrics = Registry()  # Shared registry, rendered by the `/metrics` route
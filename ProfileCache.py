@@ -0,0 +1,211 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+
+
+class _PendingFetch():
+    """A profile fetch that other threads can wait on"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.profile = None
+        self.error = None
+
+
+class ProfileCache():
+    """
+    Bounded LRU cache (with TTL eviction) for slack user profiles
+    """
+
+    def __init__(self,
+                 client,
+                 max_size: int = 1024,
+                 ttl: float = 3600,
+                 clock=time.monotonic):
+        """
+        :param client: slack.WebClient used for `users.profile.get` and `users.list`
+        :param max_size: Most profiles kept before the least recently used is evicted
+        :param ttl: Seconds a profile stays fresh
+        :param clock: Function returning the current time in seconds
+        """
+        self.client = client
+        self.MAX_SIZE = max_size
+        self.TTL = ttl
+        self.clock = clock
+
+        self._profiles = OrderedDict()  # user_id -> (expires_at, profile)
+        self._pending = {}  # user_id -> _PendingFetch
+        self._async_pending = {}  # user_id -> asyncio.Future, for `aget`
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, user_id: str) -> dict:
+        """
+        Gets a user's profile, calling slack only if it isn't cached.
+        Concurrent misses for the same user share a single api call.
+
+        :param user_id: slack user id
+        :rtype: dict of the user's profile
+        """
+        with self._lock:
+            profile = self._lookup(user_id)
+            if profile is not None:
+                self.hits += 1
+                return profile
+
+            self.misses += 1
+            pending = self._pending.get(user_id)
+            is_leader = pending is None
+            if is_leader:
+                pending = self._pending[user_id] = _PendingFetch()
+
+        if not is_leader:
+            pending.event.wait()
+            if pending.error is not None:
+                raise pending.error
+            return pending.profile
+
+        try:
+            pending.profile = self.client.users_profile_get(
+                user=user_id)['profile']
+            self.put(user_id, pending.profile)
+            return pending.profile
+        except Exception as e:
+            pending.error = e
+            raise
+        finally:
+            with self._lock:
+                self._pending.pop(user_id, None)
+            pending.event.set()
+
+    async def aget(self, user_id: str) -> dict:
+        """
+        Gets a user's profile from a coroutine. With an async client (`run_async=True`) the event loop
+        isn't blocked, so many misses can be fetched at once with `asyncio.gather`.
+        With a sync client this is the same as `get`. Concurrent misses for the same user share a single api call
+
+        :param user_id: slack user id
+        :rtype: dict of the user's profile
+        """
+        if not getattr(self.client, 'run_async', False):
+            return self.get(user_id)
+
+        with self._lock:
+            profile = self._lookup(user_id)
+            if profile is not None:
+                self.hits += 1
+                return profile
+            self.misses += 1
+
+        pending = self._async_pending.get(user_id)  # Only touched from the event loop
+        if pending is not None:
+            return await asyncio.shield(pending)
+
+        pending = self._async_pending[user_id] = asyncio.get_running_loop(
+        ).create_future()
+        try:
+            profile = (await
+                       self.client.users_profile_get(user=user_id))['profile']
+            self.put(user_id, profile)
+            pending.set_result(profile)
+            return profile
+        except asyncio.CancelledError:
+            pending.cancel()
+            raise
+        except Exception as e:
+            pending.set_exception(e)
+            pending.exception(
+            )  # Marks it retrieved, so it isn't logged when no one else waited
+            raise
+        finally:
+            del self._async_pending[user_id]
+
+    async def aimage(self, user_id: str, size: str = "image_72") -> str:
+        """
+        Gets the url of a user's profile picture from a coroutine
+
+        :param user_id: slack user id
+        :param size: profile key of the image (`image_24` ... `image_512`)
+        """
+        return (await self.aget(user_id)).get(size)
+
+    def put(self, user_id: str, profile: dict):
+        """
+        Adds (or refreshes) a profile in the cache
+
+        :param user_id: slack user id
+        :param profile: the user's profile
+        """
+        with self._lock:
+            self._profiles[user_id] = (self.clock() + self.TTL, profile)
+            self._profiles.move_to_end(user_id)
+            while len(self._profiles) > self.MAX_SIZE:
+                self._profiles.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, user_id: str = None):
+        """
+        Drops a profile from the cache
+
+        :param user_id: user to drop. Drops every profile if None
+        """
+        with self._lock:
+            if user_id is None:
+                self._profiles.clear()
+            else:
+                self._profiles.pop(user_id, None)
+
+    def warm(self, client=None, page_size: int = 200) -> int:
+        """
+        Fills the cache from a paginated `users.list`
+
+        :param client: client to list users with (defaults to the cache's client)
+        :param page_size: users requested per page
+        :rtype: number of profiles loaded
+        """
+        client = client or self.client
+        cursor = None
+        loaded = 0
+        while True:
+            page = client.users_list(cursor=cursor, limit=page_size)
+            for member in page['members']:
+                if member.get('deleted') or not member.get('profile'):
+                    continue
+                self.put(member['id'], member['profile'])
+                loaded += 1
+            cursor = page.get('response_metadata', {}).get('next_cursor')
+            if not cursor:
+                return loaded
+
+    def stats(self) -> dict:
+        """
+        Cache counters, for sizing the cache
+
+        :rtype: dict of hits, misses, evictions and size
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self._profiles)
+            }
+
+    def _lookup(self, user_id):
+        """Returns a fresh profile or None. Caller must hold the lock"""
+        entry = self._profiles.get(user_id)
+        if entry is None:
+            return None
+        if entry[0] <= self.clock():
+            del self._profiles[user_id]
+            self.evictions += 1
+            return None
+        self._profiles.move_to_end(user_id)
+        return entry[1]
+
+    def __len__(self) -> int:
+        return len(self._profiles)
@@ -0,0 +1,266 @@
+"""
+Streaming import and export of on call schedules as CSV or ICS
+
+Usage:
+```
+python ScheduleIO.py schedules.csv             # upserts every valid row into scheduled_users
+python ScheduleIO.py team.ics --team T0123ABCD --batch-size 1000
+```
+CSV files need `user_id`, `start_date` and `end_date` columns (`name` is optional), with `YYYY-MM-DD` dates.
+ICS files need all-day events with an `X-SLACK-USER-ID` property (like the ones `/oncall.ics` exports).
+Connects to `MONGO_URI`. Running servers pick the import up within `SCHEDULE_INDEX_REFRESH` seconds
+"""
+import argparse
+import csv
+import io
+import os
+import re
+import sys
+from datetime import date, datetime, timedelta
+from os.path import dirname, join
+
+from Database import MongoTools, parse_date
+
+CSV_FIELDS = ('user_id', 'name', 'start_date', 'end_date')
+
+
+def validate(user_id: str, name: str, start: str, end: str) -> dict:
+    """
+    Checks one imported schedule and converts it into a `scheduled_users` document
+
+    :param user_id: user's ID
+    :param name: user's name (may be empty)
+    :param start: first day on call, `YYYY-MM-DD`
+    :param end: last day on call, `YYYY-MM-DD`
+    :rtype: dict
+    :raises ValueError: if a field is missing, a date is invalid or the end is before the start
+    """
+    if not user_id:
+        raise ValueError('Missing user_id')
+    start_key, start_date = parse_date(start)
+    end_key, end_date = parse_date(end)
+    for key, text in ((start_key, start), (end_key, end)):
+        try:  # parse_date accepts days like 2026-02-31
+            date(key // 10000, key // 100 % 100, key % 100)
+        except ValueError:
+            raise ValueError(f'Invalid date: {text} does not exist')
+    if end_key < start_key:
+        raise ValueError(f'End date ({end}) is before start date ({start})')
+    return {
+        'user_id': user_id,
+        'name': name or '',
+        'start_date': start_date,
+        'end_date': end_date
+    }
+
+
+def read_csv(lines, errors: list):
+    """
+    Streams schedules out of CSV lines
+
+    :param lines: iterable of CSV lines with a header row (like an open file)
+    :param errors: list that `(line number, message)` is appended to for every rejected row
+    :rtype: generator of `scheduled_users` documents
+    """
+    reader = csv.DictReader(lines)
+    missing = {'user_id', 'start_date', 'end_date'} - set(reader.fieldnames
+                                                          or ())
+    if missing:
+        errors.append((1, f'Missing columns: {", ".join(sorted(missing))}'))
+        return
+    for row in reader:
+        try:
+            yield validate((row['user_id'] or '').strip(),
+                           (row.get('name') or '').strip(),
+                           (row['start_date'] or '').strip(),
+                           (row['end_date'] or '').strip())
+        except ValueError as e:
+            errors.append((reader.line_num, str(e)))
+
+
+def _unfold(lines):
+    """Joins ICS continuation lines (lines starting with a space or tab) onto the line before"""
+    current, number = None, 0
+    for i, line in enumerate(lines, 1):
+        line = line.rstrip('\r\n')
+        if line[:1] in (' ', '\t') and current is not None:
+            current += line[1:]
+            continue
+        if current is not None:
+            yield number, current
+        current, number = line, i
+    if current is not None:
+        yield number, current
+
+
+def _ics_date(value: str) -> date:
+    return datetime.strptime(value[:8], '%Y%m%d').date()
+
+
+def read_ics(lines, errors: list):
+    """
+    Streams schedules out of an iCalendar file. DTEND is exclusive for all-day events, so the last day on call is the day before it
+
+    :param lines: iterable of ICS lines (like an open file)
+    :param errors: list that `(line number, message)` is appended to for every rejected event
+    :rtype: generator of `scheduled_users` documents
+    """
+    event = None
+    for number, line in _unfold(lines):
+        name, _, value = line.partition(':')
+        name = name.split(';')[0].upper()
+        if name == 'BEGIN' and value == 'VEVENT':
+            event = {'line': number}
+        elif event is None:
+            continue
+        elif name == 'END' and value == 'VEVENT':
+            try:
+                start = _ics_date(event['DTSTART'])
+                end = _ics_date(event['DTEND']) - timedelta(
+                    days=1) if 'DTEND' in event else start
+                yield validate(_unescape(event.get('X-SLACK-USER-ID', '')),
+                               _unescape(event.get('X-SLACK-USER-NAME', '')),
+                               start.isoformat(), end.isoformat())
+            except (KeyError, ValueError) as e:
+                errors.append((event['line'], f'Invalid event: {e}'))
+            event = None
+        else:
+            event[name] = value
+
+
+def _unescape(text: str) -> str:
+    return re.sub(r'\\(.)', lambda m: '\n'
+                  if m.group(1) in 'nN' else m.group(1), text)
+
+
+READERS = {'csv': read_csv, 'ics': read_ics}
+
+
+def _day(split_date) -> date:
+    return date(*(int(part) for part in split_date))
+
+
+def csv_lines(documents):
+    """
+    Streams schedules as CSV
+
+    :param documents: iterable of `scheduled_users` documents
+    :rtype: generator of CSV lines
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(CSV_FIELDS)
+    for doc in documents:
+        writer.writerow((doc['user_id'], doc.get('name') or '',
+                         '-'.join(doc['start_date']),
+                         '-'.join(doc['end_date'])))
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def _escape(text: str) -> str:
+    return text.replace('\\', '\\\\').replace(';', '\\;').replace(
+        ',', '\\,').replace('\n', '\\n')
+
+
+def ics_lines(documents, calendar_name: str = 'On Call'):
+    """
+    Streams schedules as an iCalendar file of all-day events
+
+    :param documents: iterable of `scheduled_users` documents
+    :param calendar_name: name calendar clients show for the calendar
+    :rtype: generator of ICS lines
+    """
+    stamp = datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')
+    yield ('BEGIN:VCALENDAR\r\n'
+           'VERSION:2.0\r\n'
+           'PRODID:-//slack-bot//On Call//EN\r\n'
+           f'X-WR-CALNAME:{_escape(calendar_name)}\r\n')
+    for doc in documents:
+        start = _day(doc['start_date'])
+        end = _day(doc['end_date']) + timedelta(days=1)
+        name = doc.get('name') or doc['user_id']
+        yield ('BEGIN:VEVENT\r\n'
+               f'UID:{doc["user_id"]}-{start:%Y%m%d}@oncall\r\n'
+               f'DTSTAMP:{stamp}\r\n'
+               f'DTSTART;VALUE=DATE:{start:%Y%m%d}\r\n'
+               f'DTEND;VALUE=DATE:{end:%Y%m%d}\r\n'
+               f'SUMMARY:{_escape(name)} on call\r\n'
+               f'X-SLACK-USER-ID:{doc["user_id"]}\r\n'
+               f'X-SLACK-USER-NAME:{_escape(doc.get("name") or "")}\r\n'
+               'END:VEVENT\r\n')
+    yield 'END:VCALENDAR\r\n'
+
+
+def import_schedules(db: MongoTools,
+                     lines,
+                     format: str = 'csv',
+                     batch_size: int = 500,
+                     collection: str = "scheduled_users") -> tuple:
+    """
+    Streams a CSV or ICS file into MongoDB with batched upserts
+
+    :param db: MongoTools to write with
+    :param lines: iterable of lines (like an open file)
+    :param format: `csv` or `ics`
+    :param batch_size: Upserts sent per `bulk_write`
+    :param collection: The MongoDB Collection
+    :rtype: tuple of the number of schedules imported and a list of `(line number, message)` errors
+    """
+    errors = []
+    imported = db.upsert_many(READERS[format](lines, errors),
+                              collection=collection,
+                              batch_size=batch_size)
+    return imported, errors
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('file', help='CSV or ICS file to import')
+    parser.add_argument('--format',
+                        choices=sorted(READERS),
+                        help='file format (guessed from the extension)')
+    parser.add_argument(
+        '--team',
+        help=
+        'stored workspace to import into (the default workspace\'s scheduled_users if not given)'
+    )
+    parser.add_argument('--batch-size', type=int, default=500)
+    args = parser.parse_args(argv)
+
+    from dotenv import load_dotenv
+    from pymongo import MongoClient
+
+    from Workspaces import Workspaces
+    load_dotenv(join(dirname(__file__), '.env'))
+    client = MongoClient(os.getenv('MONGO_URI', 'mongodb://localhost:27017/'))
+    db = MongoTools(buffer_size=int(os.getenv('MONGO_BUFFER_SIZE', 3)),
+                    mongo_client=client)
+    collection = "scheduled_users"
+    if args.team:
+        try:
+            collection = Workspaces(client['users'],
+                                    None).schedule_collection(args.team)
+        except KeyError as e:
+            parser.error(e.args[0])
+
+    format = args.format or args.file.rsplit('.', 1)[-1].lower()
+    if format not in READERS:
+        parser.error(f'unknown format {format}, pass --format')
+    with open(args.file, newline='') as f:
+        imported, errors = import_schedules(db,
+                                            f,
+                                            format=format,
+                                            batch_size=args.batch_size,
+                                            collection=collection)
+    for line, message in errors:
+        print(f'line {line}: {message}')
+    print(
+        f'imported {imported} schedules into {collection}, rejected {len(errors)}'
+    )
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,335 @@
+import asyncio
+import heapq
+import logging
+import threading
+import time
+from collections import namedtuple
+from datetime import date, datetime, timedelta
+
+from AsyncTools import maybe_await, run_sync
+from CalendarEngine import date_words
+from Database import date_key
+
+logger = logging.getLogger(__name__)
+
+Reminder = namedtuple(
+    'Reminder',
+    'fire_at kind team_id user_id day')  # kind is start, end, handoff or refill
+
+
+def key_to_date(key: int) -> date:
+    """
+    Converts a date key (`YYYYMMDD`) back into a date
+
+    :param key: int date key
+    :rtype: date
+    """
+    return date(key // 10000, key // 100 % 100, key % 100)
+
+
+class ShiftReminders():
+    """
+    DMs people when their on call shift starts and ends, and posts a daily handoff to a channel.
+    Every upcoming reminder of every workspace is kept in one heap, driven by one timer, instead of a job per user.
+    Only the next `horizon` days are queued (found with the schedule index), so the heap stays small
+    with tens of thousands of schedules, and a refill at midnight queues the next day.
+    Reminders are claimed in `sent` (a `MongoEventDedupe`) before they are sent, so restarts and other
+    instances don't send them twice, and reminders missed while the bot was down are sent on startup if
+    they are less than `catch_up` seconds late
+    """
+
+    def __init__(self,
+                 workspaces,
+                 sent,
+                 start_hour: int = 9,
+                 end_hour: int = 17,
+                 handoff_hour: int = 9,
+                 handoff_channel: str = None,
+                 horizon: int = 2,
+                 catch_up: float = 3600,
+                 clock=time.time):
+        """
+        :param workspaces: `Workspaces` the reminders are sent from
+        :param sent: `EventDedupe` remembering which reminders were sent (keep it longer than `catch_up`)
+        :param start_hour: Hour of the first day of a shift its start reminder is sent
+        :param end_hour: Hour of the last day of a shift its end reminder is sent
+        :param handoff_hour: Hour the daily handoff is posted
+        :param handoff_channel: Channel the handoff is posted in, for workspaces without their own `handoff_channel` (no handoff if None)
+        :param horizon: Days of reminders kept queued
+        :param catch_up: Most seconds late a reminder is still sent after a restart
+        :param clock: Function returning the current unix time
+        """
+        self.workspaces = workspaces
+        self.sent = sent
+        self.START_HOUR = start_hour
+        self.END_HOUR = end_hour
+        self.HANDOFF_HOUR = handoff_hour
+        self.handoff_channel = handoff_channel
+        self.HORIZON = horizon
+        self.CATCH_UP = catch_up
+        self.clock = clock
+
+        self._heap = []  # (fire_at, reminder id, Reminder), soonest first
+        self._queued = set()  # ids of reminders in the heap
+        self._teams = set()  # team ids being watched
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._stopped = False
+
+        self.reminders_sent = 0
+        self.reminders_skipped = 0  # Already sent, or the schedule changed
+        self.reminders_failed = 0
+
+    def watch(self, ws):
+        """
+        Queues a workspace's reminders and keeps them up to date as schedules change
+
+        :param ws: the `Workspace` (call it from the workspaces' setup function, so a workspace loaded again after
+            being dropped from the cache is watched too)
+        """
+        with self._lock:
+            self._teams.add(ws.team_id)
+            self._push(self._refill_at(self.clock()),
+                       catch_up=0)  # Only queued once, it has the same id
+        ws.db.add_listener(
+            lambda user_id, document: self._changed(ws, user_id))
+        ws.schedule_index.add_listener(lambda: self.queue_window(
+            ws))  # Schedules written by another process
+        self.queue_window(ws, catch_up=self.CATCH_UP)
+
+    def queue_window(self, ws, catch_up: float = 0) -> int:
+        """
+        Queues the reminders of a workspace for the next `horizon` days
+
+        :param ws: the `Workspace`
+        :param catch_up: Most seconds in the past a reminder can be and still be queued
+        :rtype: int of reminders queued
+        """
+        today = datetime.fromtimestamp(self.clock()).date()
+        first, last = date_key(today), date_key(today +
+                                                timedelta(days=self.HORIZON - 1))
+        reminders = []
+        for doc in ws.schedule_index.between(first, last):
+            reminders.extend(
+                self._shift_reminders(ws.team_id, doc, first, last))
+        if self._handoff_channel(ws):
+            reminders.extend(
+                self._reminder('handoff', ws.team_id, None, date_key(day))
+                for day in (today + timedelta(days=i)
+                            for i in range(self.HORIZON)))
+        with self._lock:
+            queued = sum(
+                self._push(reminder, catch_up) for reminder in reminders)
+        self._wake.set()
+        return queued
+
+    def due(self) -> list:
+        """
+        Takes the reminders that are due off the heap
+
+        :rtype: list of Reminder, soonest first
+        """
+        now = self.clock()
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                _, reminder_id, reminder = heapq.heappop(self._heap)
+                self._queued.discard(reminder_id)
+                due.append(reminder)
+        return due
+
+    def next_at(self) -> float:
+        """
+        When the next reminder is due
+
+        :rtype: float unix time, or None if nothing is queued
+        """
+        with self._lock:
+            return self._heap[0][0] if self._heap else None
+
+    async def send(self, reminder: Reminder):
+        """
+        Sends a reminder, unless its shift changed or it was already sent (by this or another instance)
+
+        :param reminder: a Reminder from `due`
+        """
+        if reminder.kind == 'refill':
+            with self._lock:  # Queued first, so a failing team can't stop the refills
+                self._push(self._refill_at(self.clock()), catch_up=0)
+            for team_id in list(self._teams):
+                try:
+                    self.queue_window(self.workspaces.get(team_id))
+                except Exception:
+                    logger.exception('queueing the reminders of %s failed',
+                                     team_id)
+            return
+
+        ws = self.workspaces.get(reminder.team_id)
+        text, channel = self._message(ws, reminder)
+        reminder_id = self._id(reminder)
+        if text is None or await maybe_await(self.sent.seen(reminder_id)):
+            self.reminders_skipped += 1
+            return
+        try:
+            await maybe_await(
+                ws.client.chat_postMessage(channel=channel, text=text))
+            self.reminders_sent += 1
+        except Exception:
+            logger.exception('sending reminder %s failed', reminder_id)
+            await maybe_await(self.sent.forget(
+                reminder_id))  # So it is sent again after a restart
+            self.reminders_failed += 1
+
+    def start(self) -> threading.Thread:
+        """
+        Sends reminders from a background thread as they come due (for the Flask app). Does nothing if the thread
+        is already running
+
+        :rtype: threading.Thread
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return self._thread
+
+        def run():
+            while not self._stopped:
+                for reminder in self.due():
+                    try:
+                        run_sync(self.send(reminder))
+                    except Exception:
+                        logger.exception('reminder %s failed', reminder)
+                next_at = self.next_at()
+                self._wake.wait(None if next_at is None else max(
+                    0, next_at - self.clock()))
+                self._wake.clear()
+
+        self._thread = threading.Thread(target=run,
+                                        name='shift-reminders',
+                                        daemon=True)
+        self._thread.start()
+        return self._thread
+
+    async def run(self, poll: float = 60):
+        """
+        Sends reminders as they come due (for the ASGI server)
+
+        :param poll: Most seconds between checks, so reminders queued while sleeping aren't late by more than this
+        """
+        while True:
+            for reminder in self.due():
+                try:
+                    await self.send(reminder)
+                except Exception:
+                    logger.exception('reminder %s failed', reminder)
+            next_at = self.next_at()
+            await asyncio.sleep(poll if next_at is None else min(
+                poll, max(0, next_at - self.clock())))
+
+    def stop(self):
+        """Stops the background thread"""
+        self._stopped = True
+        self._wake.set()
+
+    def stats(self) -> dict:
+        """
+        Reminder counters
+
+        :rtype: dict of reminders queued, sent, skipped and failed
+        """
+        with self._lock:
+            queued = len(self._heap)
+        return {
+            'queued': queued,
+            'sent': self.reminders_sent,
+            'skipped': self.reminders_skipped,
+            'failed': self.reminders_failed
+        }
+
+    def _changed(self, ws, user_id):
+        """Queues the reminders of a schedule that was just written (old ones are skipped when they come due)"""
+        doc = ws.schedule_index.get(user_id)
+        if not doc or not doc.get('start_key'):
+            return
+        today = datetime.fromtimestamp(self.clock()).date()
+        first, last = date_key(today), date_key(today +
+                                                timedelta(days=self.HORIZON - 1))
+        with self._lock:
+            for reminder in self._shift_reminders(ws.team_id, doc, first,
+                                                  last):
+                self._push(reminder, catch_up=0)
+        self._wake.set()
+
+    def _shift_reminders(self, team_id, doc, first, last):
+        if first <= doc['start_key'] <= last:
+            yield self._reminder('start', team_id, doc['user_id'],
+                                 doc['start_key'])
+        if doc.get('end_key') and first <= doc['end_key'] <= last:
+            yield self._reminder('end', team_id, doc['user_id'],
+                                 doc['end_key'])
+
+    def _reminder(self, kind, team_id, user_id, day) -> Reminder:
+        hour = {
+            'start': self.START_HOUR,
+            'end': self.END_HOUR,
+            'handoff': self.HANDOFF_HOUR
+        }[kind]
+        fire_at = datetime.combine(key_to_date(day),
+                                   datetime.min.time()).replace(hour=hour)
+        return Reminder(fire_at.timestamp(), kind, team_id, user_id, day)
+
+    def _refill_at(self, now) -> Reminder:
+        tomorrow = datetime.fromtimestamp(now).date() + timedelta(days=1)
+        return Reminder(
+            datetime.combine(tomorrow, datetime.min.time()).timestamp(),
+            'refill', None, None, date_key(tomorrow))
+
+    def _push(self, reminder, catch_up) -> bool:
+        """Caller must hold the lock"""
+        reminder_id = self._id(reminder)
+        if reminder_id in self._queued or reminder.fire_at < self.clock(
+        ) - catch_up:
+            return False
+        heapq.heappush(self._heap, (reminder.fire_at, reminder_id, reminder))
+        self._queued.add(reminder_id)
+        return True
+
+    def _message(self, ws, reminder) -> tuple:
+        """Text and channel of a reminder, or (None, None) if it no longer applies"""
+        if reminder.kind == 'handoff':
+            return self._handoff(ws, reminder.day), self._handoff_channel(ws)
+
+        doc = ws.schedule_index.get(reminder.user_id)
+        if not doc or doc.get(f'{reminder.kind}_key') != reminder.day:
+            return None, None
+        if reminder.kind == 'start':
+            return (
+                f"Your on call shift starts today and runs until {date_words(doc['end_date'])}.",
+                reminder.user_id)
+        return 'Your on call shift ends today. Thanks for covering!', reminder.user_id
+
+    def _handoff(self, ws, day) -> str:
+        on_call = ws.schedule_index.at(day)
+        starting = [doc for doc in on_call if doc['start_key'] == day]
+        ending = [doc for doc in on_call if doc['end_key'] == day]
+
+        def mentions(docs, limit=50):
+            text = ', '.join(f"<@{doc['user_id']}>" for doc in docs[:limit])
+            if len(docs) > limit:
+                text += f' _and {len(docs) - limit} more_'
+            return text
+
+        lines = [f'*On call handoff for {date_words(key_to_date(day))}*']
+        lines.append(f'On call today: {mentions(on_call)}'
+                     if on_call else '_Nobody is on call today_')
+        if starting:
+            lines.append(f'Starting today: {mentions(starting)}')
+        if ending:
+            lines.append(f'Ending today: {mentions(ending)}')
+        return '\n'.join(lines)
+
+    def _handoff_channel(self, ws) -> str:
+        return ws.handoff_channel or self.handoff_channel
+
+    @staticmethod
+    def _id(reminder) -> str:
+        return f'{reminder.team_id}:{reminder.kind}:{reminder.user_id}:{reminder.day}'
@@ -0,0 +1,408 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+import slack
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+from slack.errors import SlackApiError
+from slack.web.slack_response import SlackResponse
+
+from Metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+SLACK_API_SECONDS = metrics.histogram('slack_api_seconds',
+                                      'Time spent in slack Web API requests')
+
+# Requests per minute allowed by each of slack's rate limit tiers
+TIERS = {1: 1, 2: 20, 3: 50, 4: 100}
+
+# Tier of the methods this bot uses
+METHOD_LIMITS = {
+    'chat.postMessage': 60,  # "Special": about one message per second in each channel
+    'chat.postEphemeral': TIERS[4],
+    'chat.update': TIERS[3],
+    'chat.delete': TIERS[3],
+    'conversations.open': TIERS[3],
+    'im.open': TIERS[3],
+    'users.info': TIERS[4],
+    'users.list': TIERS[2],
+    'users.profile.get': TIERS[4],
+    'views.open': TIERS[4],
+    'views.update': TIERS[4],
+}
+
+# Methods limited per channel rather than per workspace, so they get a bucket for every channel
+CHANNEL_LIMITED_METHODS = {'chat.postMessage'}
+
+# Read only methods, where identical requests made at the same time can share one response
+COALESCED_METHODS = {
+    'conversations.info', 'users.info', 'users.list', 'users.profile.get'
+}
+
+# Methods that can be sent twice without doing anything twice, so they are retried after any connection error.
+# Others (like chat.postMessage) are only retried when the connection failed before the request was sent
+IDEMPOTENT_METHODS = COALESCED_METHODS | {
+    'chat.update', 'chat.delete', 'conversations.open', 'im.open',
+    'views.update'
+}
+
+
+def request_channel(data=None, json=None) -> str:
+    """
+    Gets the channel a request is sent to
+
+    :param data: form body
+    :param json: json body
+    :rtype: str, or None if the request has no channel
+    """
+    for body in (data, json):
+        if isinstance(body, dict) and body.get('channel'):
+            return body['channel']
+    return None
+
+
+def sent_nothing(error: requests.ConnectionError) -> bool:
+    """
+    Whether a connection error happened before the request reached slack, so retrying it can't repeat it
+
+    :param error: the error raised by requests
+    :rtype: bool
+    """
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+class TokenBucket():
+    """
+    Token bucket allowing `rate` requests per minute, with bursts of up to `burst`
+    """
+
+    def __init__(self, rate: float, burst: int = None, clock=time.monotonic):
+        """
+        :param rate: Requests allowed per minute
+        :param burst: Most requests allowed at once (defaults to a tenth of the rate, at least 1)
+        :param clock: Function returning the current time in seconds
+        """
+        self.RATE = rate / 60
+        self.BURST = burst or max(1, int(rate / 10))
+        self.clock = clock
+        self.tokens = self.BURST
+        self.updated_at = clock()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """
+        Takes a token
+
+        :rtype: float, seconds to wait before the request can be sent
+        """
+        with self._lock:
+            now = self.clock()
+            self.tokens = min(self.BURST,
+                              self.tokens + (now - self.updated_at) * self.RATE)
+            self.updated_at = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.RATE
+
+    def pause(self, seconds: float):
+        """
+        Empties the bucket so the next `reserve` waits `seconds` (used for `Retry-After`)
+
+        :param seconds: seconds to wait
+        """
+        with self._lock:
+            self.tokens = min(self.tokens, 1 - seconds *
+                              self.RATE)  # The next reserve takes one more token
+            self.updated_at = self.clock()
+
+
+class _PendingCall():
+    """A request that identical requests can wait on"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SlackTransport():
+    """
+    Pooled HTTP transport for the slack Web API, shared by every `PooledWebClient`
+    """
+
+    def __init__(self,
+                 pool_size: int = 10,
+                 max_retries: int = 3,
+                 timeout: float = 10,
+                 default_limit: float = TIERS[3],
+                 max_buckets: int = 10000,
+                 sleep=time.sleep):
+        """
+        :param pool_size: Most keep-alive connections kept open
+        :param max_retries: Times a rate limited (429) or failed request is retried
+        :param timeout: Seconds to wait for slack to respond
+        :param default_limit: Requests per minute for methods not in METHOD_LIMITS
+        :param max_buckets: Most rate limiters kept (there is one per channel for CHANNEL_LIMITED_METHODS)
+        :param sleep: Function used to wait (replaceable in tests)
+        """
+        self.MAX_RETRIES = max_retries
+        self.TIMEOUT = timeout
+        self.DEFAULT_LIMIT = default_limit
+        self.MAX_BUCKETS = max_buckets
+        self.sleep = sleep
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self._buckets = OrderedDict(
+        )  # (token, method, channel) -> TokenBucket, least recently used first
+        self._pending = {}  # request key -> _PendingCall
+        self._lock = threading.Lock()
+
+        self.calls = 0
+        self.retries = 0
+        self.coalesced = 0
+
+    def call(self,
+             base_url: str,
+             token: str,
+             method: str,
+             http_verb: str = "POST",
+             params: dict = None,
+             data: dict = None,
+             json: dict = None,
+             headers: dict = None) -> tuple:
+        """
+        Calls a slack Web API method, waiting on rate limits and retrying when slack returns 429
+
+        :param base_url: Web API url (like `https://www.slack.com/api/`)
+        :param token: slack token the request is made with
+        :param method: api method (like `chat.postMessage`)
+        :param http_verb: `GET` or `POST`
+        :param params: query string parameters
+        :param data: form body
+        :param json: json body
+        :param headers: extra headers
+        :rtype: tuple of the status code, response headers and response data
+        """
+        if method not in COALESCED_METHODS or data or json:
+            return self._send(base_url, token, method, http_verb, params, data,
+                              json, headers)
+
+        key = (base_url, token, method, tuple(sorted((params or {}).items())))
+        with self._lock:
+            pending = self._pending.get(key)
+            is_leader = pending is None
+            if is_leader:
+                pending = self._pending[key] = _PendingCall()
+            else:
+                self.coalesced += 1
+
+        if not is_leader:
+            pending.event.wait()
+            if pending.error is not None:
+                raise pending.error
+            return pending.result
+
+        try:
+            pending.result = self._send(base_url, token, method, http_verb,
+                                        params, data, json, headers)
+            return pending.result
+        except Exception as e:
+            pending.error = e
+            raise
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+            pending.event.set()
+
+    def bucket(self, token: str, method: str, channel: str = None) -> TokenBucket:
+        """
+        Gets the rate limiter for a token's calls to a method
+
+        :param token: slack token
+        :param method: api method
+        :param channel: channel the call is sent to (only used for CHANNEL_LIMITED_METHODS)
+        :rtype: TokenBucket
+        """
+        key = (token, method,
+               channel if method in CHANNEL_LIMITED_METHODS else None)
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                self._buckets.move_to_end(key)
+                return bucket
+            bucket = self._buckets[key] = TokenBucket(
+                METHOD_LIMITS.get(method, self.DEFAULT_LIMIT))
+            while len(self._buckets) > self.MAX_BUCKETS:
+                self._buckets.popitem(last=False)
+            return bucket
+
+    def stats(self) -> dict:
+        """
+        Transport counters
+
+        :rtype: dict of calls, retries and coalesced requests
+        """
+        with self._lock:
+            return {
+                'calls': self.calls,
+                'retries': self.retries,
+                'coalesced': self.coalesced
+            }
+
+    def _send(self, base_url, token, method, http_verb, params, data, json,
+              headers):
+        bucket = self.bucket(token, method, request_channel(data, json))
+        headers = {**(headers or {}), 'Authorization': f'Bearer {token}'}
+
+        for attempt in range(self.MAX_RETRIES + 1):
+            wait = bucket.reserve()
+            if wait > 0:
+                self.sleep(wait)
+
+            with self._lock:
+                self.calls += 1
+            try:
+                with SLACK_API_SECONDS.time(method=method):
+                    res = self.session.request(http_verb,
+                                               base_url + method,
+                                               params=params,
+                                               data=data,
+                                               json=json,
+                                               headers=headers,
+                                               timeout=self.TIMEOUT)
+            except requests.ConnectionError as e:
+                if attempt == self.MAX_RETRIES or not (
+                        method in IDEMPOTENT_METHODS or sent_nothing(e)):
+                    raise
+                with self._lock:
+                    self.retries += 1
+                self.sleep(2**attempt)
+                continue
+
+            if res.status_code == 429 and attempt < self.MAX_RETRIES:
+                retry_after = float(res.headers.get('Retry-After', 1))
+                logger.warning(
+                    f'{method} rate limited, retrying in {retry_after}s')
+                with self._lock:
+                    self.retries += 1
+                bucket.pause(retry_after)
+                continue
+
+            try:
+                body = res.json()
+            except ValueError:
+                body = {'ok': False, 'error': res.text}
+            return res.status_code, dict(res.headers), body
+
+
+class PooledWebClient(slack.WebClient):
+    """
+    `slack.WebClient` that sends every request through a shared `SlackTransport`
+    """
+
+    def __init__(self, token: str = None, transport: SlackTransport = None,
+                 **kwargs):
+        """
+        :param token: slack token
+        :param transport: transport shared with other clients (one is made if None)
+        :param **kwargs: passed to `slack.WebClient` (like `base_url`, for a fake slack server)
+        """
+        super().__init__(token=token, **kwargs)
+        self.transport = transport or SlackTransport()
+
+    def api_call(self,
+                 api_method: str,
+                 *,
+                 http_verb: str = "POST",
+                 files: dict = None,
+                 data: dict = None,
+                 params: dict = None,
+                 json: dict = None,
+                 headers: dict = None,
+                 auth: dict = None):
+        if files or auth:  # Uploads and basic auth are left to slack.WebClient
+            return super().api_call(api_method,
+                                    http_verb=http_verb,
+                                    files=files,
+                                    data=data,
+                                    params=params,
+                                    json=json,
+                                    headers=headers,
+                                    auth=auth)
+
+        status_code, res_headers, body = self.transport.call(
+            self.base_url,
+            self.token,
+            api_method,
+            http_verb=http_verb,
+            params=params,
+            data=data,
+            json=json,
+            headers=headers)
+        return SlackResponse(client=self,
+                             http_verb=http_verb,
+                             api_url=self.base_url + api_method,
+                             req_args={
+                                 'params': params,
+                                 'data': data,
+                                 'json': json
+                             },
+                             data=body,
+                             headers=res_headers,
+                             status_code=status_code).validate()
+
+
+class AsyncWebClient(slack.WebClient):
+    """
+    `slack.WebClient` in async mode (aiohttp), paced by the rate limiters of a `SlackTransport` and retrying 429s
+    like it does. Its api methods return coroutines
+    """
+
+    def __init__(self, token: str = None, transport: SlackTransport = None,
+                 **kwargs):
+        """
+        :param token: slack token
+        :param transport: transport whose rate limiters and counters are shared (one is made if None)
+        :param **kwargs: passed to `slack.WebClient` (pass an `aiohttp.ClientSession` as `session` to share connections)
+        """
+        super().__init__(token=token, run_async=True, **kwargs)
+        self.transport = transport or SlackTransport()
+
+    async def api_call(self, api_method: str, **kwargs):
+        transport = self.transport
+        bucket = transport.bucket(
+            self.token, api_method,
+            request_channel(kwargs.get('data'), kwargs.get('json')))
+
+        for attempt in range(transport.MAX_RETRIES + 1):
+            wait = bucket.reserve()
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+            with transport._lock:
+                transport.calls += 1
+            try:
+                with SLACK_API_SECONDS.time(method=api_method):
+                    return await super().api_call(api_method, **kwargs)
+            except SlackApiError as e:
+                if (e.response.status_code != 429
+                        or attempt == transport.MAX_RETRIES):
+                    raise
+                retry_after = float(e.response.headers.get('Retry-After', 1))
+                logger.warning(
+                    f'{api_method} rate limited, retrying in {retry_after}s')
+                with transport._lock:
+                    transport.retries += 1
+                bucket.pause(retry_after)
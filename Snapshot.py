@@ -0,0 +1,96 @@
+import threading
+import time
+
+from AsyncTools import maybe_await
+
+
+class Snapshot():
+    """
+    Cache of fully rendered results (like the `view on call` blocks) that writes invalidate, with a staleness bound
+    """
+
+    def __init__(self,
+                 build,
+                 max_age: float = 300,
+                 max_size: int = 64,
+                 clock=time.monotonic):
+        """
+        :param build: function rendering the result for a key (called with the key's parts). May be a coroutine function
+        :param max_age: Seconds a result is served before it is rebuilt anyway
+        :param max_size: Most results kept (the oldest is dropped first)
+        :param clock: Function returning the current time in seconds
+        """
+        self.build = build
+        self.MAX_AGE = max_age
+        self.MAX_SIZE = max_size
+        self.clock = clock
+        self._results = {}  # key -> (built_at, result)
+        self._generation = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.builds = 0
+
+    async def aget(self, *key):
+        """
+        Gets the result for a key from a coroutine, awaiting the build function if it returns an awaitable
+
+        :param *key: passed to the build function
+        """
+        hit, result = self._lookup(key)
+        if hit:
+            return result
+        return await self._abuild(key, result)
+
+    async def arefresh(self, *key):
+        """
+        Rebuilds the result for a key right away, from a coroutine
+
+        :param *key: passed to the build function
+        """
+        with self._lock:
+            generation = self._generation
+        return await self._abuild(key, generation)
+
+    def invalidate(self, *args):
+        """Drops every result (takes any arguments so it can be used as a write listener)"""
+        with self._lock:
+            self._results.clear()
+            self._generation += 1
+
+    def stats(self) -> dict:
+        """
+        Snapshot counters
+
+        :rtype: dict of hits, builds and size
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'builds': self.builds,
+                'size': len(self._results)
+            }
+
+    def _lookup(self, key) -> tuple:
+        """Returns (True, result) for a fresh result, otherwise (False, current generation)"""
+        with self._lock:
+            entry = self._results.get(key)
+            if entry is not None and self.clock() - entry[0] < self.MAX_AGE:
+                self.hits += 1
+                return True, entry[1]
+            return False, self._generation
+
+    async def _abuild(self, key, generation):
+        built_at = self.clock()
+        result = await maybe_await(self.build(*key))
+        return self._store(key, generation, built_at, result)
+
+    def _store(self, key, generation, built_at, result):
+        with self._lock:
+            self.builds += 1
+            if generation == self._generation:  # Don't keep results built from data that changed during the build
+                self._results.pop(key, None)
+                self._results[key] = (built_at, result)
+                while len(self._results) > self.MAX_SIZE:
+                    self._results.pop(next(iter(self._results)))
+        return result
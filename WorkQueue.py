@@ -0,0 +1,124 @@
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class WorkQueue():
+    """
+    Bounded work queue with a thread pool, so slack requests can be acknowledged right away
+    """
+
+    def __init__(self, workers: int = 4, max_size: int = 100):
+        """
+        :param workers: Number of worker threads
+        :param max_size: Most jobs waiting before new jobs are rejected
+        """
+        self.WORKERS = workers
+        self.MAX_SIZE = max_size
+        self.jobs = queue.Queue(maxsize=max_size)
+        self._lock = threading.Lock()
+        self._threads = []
+
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def start(self):
+        """Starts the worker threads (if they aren't already running)"""
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.WORKERS):
+                thread = threading.Thread(target=self._work,
+                                          name=f'work-queue-{i}',
+                                          daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, func, *args, **kwargs) -> bool:
+        """
+        Queues a function to be run by a worker
+
+        :param func: function to run
+        :param *args, **kwargs: arguments passed to func
+        :rtype: bool, False if the queue is full and the job was rejected
+        """
+        self.start()
+        try:
+            self.jobs.put_nowait((time.monotonic(), func, args, kwargs))
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            return False
+        with self._lock:
+            self.submitted += 1
+        return True
+
+    def shutdown(self, wait: bool = True):
+        """
+        Stops the workers once every queued job is done
+
+        :param wait: If true, blocks until the workers have stopped
+        """
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for _ in threads:
+            self.jobs.put((None, None, None, None))
+        if wait:
+            for thread in threads:
+                thread.join()
+
+    def stats(self) -> dict:
+        """
+        Queue counters: depth, wait times, and how many jobs were rejected
+
+        :rtype: dict
+        """
+        with self._lock:
+            started = self.completed + self.failed
+            return {
+                'depth': self.jobs.qsize(),
+                'workers': len(self._threads),
+                'submitted': self.submitted,
+                'rejected': self.rejected,
+                'completed': self.completed,
+                'failed': self.failed,
+                'avg_wait': self.total_wait / started if started else 0.0,
+                'max_wait': self.max_wait
+            }
+
+    def _work(self):
+        """Worker loop: runs jobs until it gets the shutdown sentinel"""
+        while True:
+            queued_at, func, args, kwargs = self.jobs.get()
+            if func is None:
+                self.jobs.task_done()
+                return
+
+            wait = time.monotonic() - queued_at
+            try:
+                func(*args, **kwargs)
+            except Exception as e:
+                logger.exception(e)
+                failed = True
+            else:
+                failed = False
+            finally:
+                self.jobs.task_done()
+
+            with self._lock:
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+                if failed:
+                    self.failed += 1
+                else:
+                    self.completed += 1
+
+    def __len__(self) -> int:
+        return self.jobs.qsize()
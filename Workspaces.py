@@ -0,0 +1,441 @@
+import hmac
+import logging
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from pymongo import ReturnDocument
+
+from Database import MongoTools, with_date_keys
+from IntervalIndex import IntervalIndex
+from ProfileCache import ProfileCache
+from SlackTransport import PooledWebClient
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TEAM = 'default'  # Workspace using the tokens from the environment
+DEFAULT_COLLECTION = 'scheduled_users'  # Schedules of the default workspace, and of the first workspace stored
+STORED_CHECK_SECONDS = 60  # How often a deployment without stored workspaces checks if one was added
+
+
+class Workspace():
+    """
+    Everything the bot keeps for one slack workspace: its tokens, schedules and (lazily) its slack clients
+    """
+
+    def __init__(self,
+                 team_id: str,
+                 bot_token: str,
+                 user_token: str,
+                 db: MongoTools,
+                 owner,
+                 handoff_channel: str = None,
+                 export_token: str = None):
+        """
+        :param team_id: slack team id (or `DEFAULT_TEAM`)
+        :param bot_token: bot token (`xoxb-`)
+        :param user_token: user token (`xoxp-`), used to get user data
+        :param db: MongoTools writing to the workspace's collection
+        :param owner: the `Workspaces` that caches this workspace's clients
+        :param handoff_channel: channel the daily on call handoff is posted in
+        :param export_token: secret the schedule exports must be requested with (exports are off if None)
+        """
+        self.team_id = team_id
+        self.bot_token = bot_token
+        self.user_token = user_token
+        self.db = db
+        self.handoff_channel = handoff_channel
+        self.export_token = export_token
+        self.schedule_index = IntervalIndex(
+            loader=self._stored_schedules,
+            version=lambda: db.stored_version(db.collection),
+            changes=self._changed_schedules)
+        db.add_listener(self.schedule_index.apply
+                        )  # Answers on call queries without going to MongoDB
+        self._owner = owner
+
+    def allows_export(self, token: str) -> bool:
+        """
+        Checks the token a schedule export (`/oncall.ics`, `/oncall.csv`) was requested with
+
+        :param token: the `token` query parameter
+        :rtype: bool
+        """
+        return bool(self.export_token) and hmac.compare_digest(
+            self.export_token.encode(), (token or '').encode())
+
+    def _stored_schedules(self) -> list:
+        """Every schedule in MongoDB, with the writes still in the buffer on top"""
+        documents = {
+            doc['user_id']: doc
+            for doc in self.db.database[self.db.collection].find({}, {
+                '_id': 0,
+                'updated_at': 0,
+                'created_at': 0
+            })
+        }
+        for user_id, doc in self.db.pending().items():
+            documents[user_id] = with_date_keys({
+                **documents.get(user_id, {}),
+                **doc
+            })
+        return list(documents.values())
+
+    def _changed_schedules(self, since: tuple, now: tuple) -> list:
+        """
+        Schedules written between two `stored_version`s, with the writes still in the buffer on top.
+        None if the counts don't add up (schedules were deleted), so the index is reloaded
+        """
+        (count, updated_at), (stored_count, _) = since, now
+        if updated_at is None:
+            return None
+        documents, inserted = self.db.changed_since(updated_at,
+                                                    self.db.collection)
+        if count + inserted != stored_count:
+            return None
+        pending = self.db.pending()
+        return [
+            with_date_keys({
+                **doc,
+                **pending[doc['user_id']]
+            }) if doc['user_id'] in pending else doc for doc in documents
+        ]
+
+    @property
+    def client(self) -> PooledWebClient:
+        """Client using the bot token"""
+        return self._owner._clients_for(self)[0]
+
+    @property
+    def user_client(self) -> PooledWebClient:
+        """Client using the user token"""
+        return self._owner._clients_for(self)[1]
+
+    @property
+    def profiles(self) -> ProfileCache:
+        """Profile cache of the workspace's users"""
+        return self._owner._clients_for(self)[2]
+
+
+def _schedule_collection(stored: dict) -> str:
+    return stored.get('collection') or f"scheduled_users_{stored['team_id']}"
+
+
+def _retire(workspace: Workspace):
+    """
+    Flushes a workspace that was dropped from the cache. Requests still holding it write straight through afterwards,
+    since nothing flushes its buffer any more
+    """
+    workspace.db.BUFFER_SIZE = 1
+    MongoTools.push_to_collection(
+        workspace.db, workspace.db.collection)  # Sync even for AsyncMongoTools
+
+
+class Workspaces():
+    """
+    Routes events to the workspace they came from. Tokens are stored per `team_id` in MongoDB,
+    every workspace writes schedules to its own collection, and workspaces and their slack clients are kept in bounded
+    LRU caches, all sharing one `SlackTransport` and one MongoClient.
+    Until a workspace is stored, every team uses the default workspace (the tokens from the environment). The first
+    workspace stored takes over the default workspace's schedules
+    """
+
+    def __init__(self,
+                 database,
+                 transport,
+                 collection: str = "workspaces",
+                 default_tokens: tuple = None,
+                 default_export_token: str = None,
+                 max_clients: int = 32,
+                 max_workspaces: int = 256,
+                 profile_size: int = 1024,
+                 profile_ttl: float = 3600,
+                 buffer_size: int = 3,
+                 buffer_age: float = 60,
+                 setup=None,
+                 client_factory=None,
+                 db_factory=None):
+        """
+        :param database: pymongo database holding the tokens and schedules
+        :param transport: `SlackTransport` shared by every client
+        :param collection: Collection of `{team_id, bot_token, user_token}` documents
+        :param default_tokens: (bot token, user token) of the default workspace, used while no workspace is stored so one workspace works without any setup
+        :param default_export_token: export token of the default workspace
+        :param max_clients: Most workspaces whose slack clients (and profile caches) are kept
+        :param max_workspaces: Most workspaces (with their schedule indexes) kept loaded. The least recently used is
+            flushed and dropped, and loaded again on its next event
+        :param profile_size: Profiles cached per workspace
+        :param profile_ttl: Seconds a profile stays fresh
+        :param buffer_size: MongoTools buffer size of each workspace
+        :param buffer_age: Seconds a write can wait in a workspace's buffer
+        :param setup: function called with every `Workspace` when it is first loaded (to attach more state)
+        :param client_factory: function making a slack client from a token (a `PooledWebClient` on the shared transport by default)
+        :param db_factory: function making the MongoTools of a collection (a `MongoTools` on the shared MongoClient by default)
+        """
+        self.database = database
+        self.transport = transport
+        self.collection = collection
+        self.default_tokens = default_tokens if default_tokens and default_tokens[
+            0] else None
+        self.default_export_token = default_export_token
+        self.MAX_CLIENTS = max_clients
+        self.MAX_WORKSPACES = max_workspaces
+        self.profile_size = profile_size
+        self.profile_ttl = profile_ttl
+        self.buffer_size = buffer_size
+        self.buffer_age = buffer_age
+        self.setup = setup
+        self.client_factory = client_factory or (
+            lambda token: PooledWebClient(token, transport=self.transport))
+        self.db_factory = db_factory or (lambda collection: MongoTools(
+            database=self.database.name,
+            buffer_size=self.buffer_size,
+            max_age=self.buffer_age,
+            collection=collection,
+            mongo_client=self.database.client))
+
+        self._workspaces = OrderedDict(
+        )  # team_id -> Workspace (with its schedule index), least recently used first
+        self._clients = OrderedDict(
+        )  # team_id -> (client, user_client, profiles), least recently used first
+        self._lock = threading.RLock()
+        self._any_stored = False
+        self._stored_checked_at = None
+
+        self.client_evictions = 0
+        self.workspace_evictions = 0
+
+    def get(self, team_id: str) -> Workspace:
+        """
+        Gets a team's workspace. While no workspace is stored, every team (and None) gets the default workspace;
+        once one is, teams that aren't stored are refused, and None gets the team that took over the default
+        workspace. Unknown teams are never cached
+
+        :param team_id: slack team id, or None for the default workspace
+        :rtype: Workspace
+        :raises KeyError: if the team isn't stored (or there are no default tokens)
+        """
+        with self._lock:
+            workspace = self._workspaces.get(team_id)
+            if workspace is not None:
+                self._workspaces.move_to_end(team_id)
+                return workspace
+
+            if team_id in (None, DEFAULT_TEAM) and self._has_stored():
+                owner = self.database[self.collection].find_one(
+                    {'collection': DEFAULT_COLLECTION}, {'team_id': 1})
+                if owner is not None:  # It took over the default workspace, so they share one buffer
+                    return self.get(owner['team_id'])
+
+            if team_id in (None, DEFAULT_TEAM) or not self._has_stored():
+                if not self.default_tokens:
+                    raise KeyError(f'No tokens stored for team {team_id}')
+                workspace = self._workspaces.get(DEFAULT_TEAM)
+                if workspace is not None:
+                    self._workspaces.move_to_end(DEFAULT_TEAM)
+                    return workspace
+                workspace = self._load(DEFAULT_TEAM,
+                                       *self.default_tokens,
+                                       DEFAULT_COLLECTION,
+                                       export_token=self.default_export_token)
+            else:
+                stored = self.database[self.collection].find_one(
+                    {'team_id': team_id})
+                if stored is None:
+                    raise KeyError(f'No tokens stored for team {team_id}')
+                workspace = self._load(team_id, stored['bot_token'],
+                                       stored.get('user_token'),
+                                       _schedule_collection(stored),
+                                       stored.get('handoff_channel'),
+                                       stored.get('export_token'))
+            evicted = self._evict()
+        for old in evicted:
+            _retire(old)
+        return workspace
+
+    def add(self,
+            team_id: str,
+            bot_token: str,
+            user_token: str = None,
+            handoff_channel: str = None,
+            export_token: str = None,
+            collection: str = None) -> str:
+        """
+        Stores a team's tokens (after an OAuth install, for example)
+
+        :param team_id: slack team id
+        :param bot_token: bot token (`xoxb-`)
+        :param user_token: user token (`xoxp-`)
+        :param handoff_channel: channel the daily on call handoff is posted in
+        :param export_token: secret for the schedule exports (a random one is made the first time the team is stored if None)
+        :param collection: collection the team's schedules are kept in. If None, the first team stored keeps the default
+            workspace's `scheduled_users` (so the schedules saved before it was stored stay its own), and later teams get
+            `scheduled_users_<team_id>`. Kept when the team is stored again
+        :rtype: str of the team's export token
+        """
+        takes_over = self.database[self.collection].find_one({}, {'_id': 1
+                                                                  }) is None
+        update = {
+            '$set': {
+                'team_id': team_id,
+                'bot_token': bot_token,
+                'user_token': user_token,
+                'handoff_channel': handoff_channel
+            }
+        }
+        update['$setOnInsert'] = {}
+        if export_token:
+            update['$set']['export_token'] = export_token
+        else:  # Kept when the team is stored again, so calendar subscriptions keep working
+            update['$setOnInsert']['export_token'] = secrets.token_urlsafe(24)
+        if collection:
+            update['$set']['collection'] = collection
+        else:
+            update['$setOnInsert']['collection'] = (
+                DEFAULT_COLLECTION
+                if takes_over else f'scheduled_users_{team_id}')
+        stored = self.database[self.collection].find_one_and_update(
+            {'team_id': team_id},
+            update,
+            upsert=True,
+            return_document=ReturnDocument.AFTER)
+        with self._lock:  # Reloaded with the new tokens on next use
+            self._any_stored = True
+            retired = [self._workspaces.pop(team_id, None)]
+            self._clients.pop(team_id, None)
+            if _schedule_collection(stored) == DEFAULT_COLLECTION:
+                retired.append(self._workspaces.pop(
+                    DEFAULT_TEAM, None))  # So one collection has one buffer
+        for old in retired:
+            if old is not None:
+                _retire(old)
+        if takes_over:
+            logger.info('workspace %s took over the default workspace (%s)',
+                        team_id, _schedule_collection(stored))
+        return stored.get('export_token')
+
+    def schedule_collection(self, team_id: str) -> str:
+        """
+        Gets the collection a stored team's schedules are kept in, without loading the workspace
+
+        :param team_id: slack team id
+        :rtype: str
+        :raises KeyError: if the team isn't stored
+        """
+        stored = self.database[self.collection].find_one({'team_id': team_id})
+        if stored is None:
+            raise KeyError(f'No tokens stored for team {team_id}')
+        return _schedule_collection(stored)
+
+    def stored(self) -> list:
+        """
+        Loads every stored workspace (or the default one, if none are stored)
+
+        :rtype: list of Workspace
+        """
+        team_ids = [
+            doc['team_id'] for doc in self.database[self.collection].find(
+                {}, {'team_id': 1})
+        ]
+        if self.default_tokens and not team_ids:
+            team_ids.append(DEFAULT_TEAM)
+        return [self.get(team_id) for team_id in team_ids]
+
+    def loaded(self) -> list:
+        """
+        Gets the workspaces that have been used
+
+        :rtype: list of Workspace, without duplicates
+        """
+        with self._lock:
+            return list({
+                id(workspace): workspace
+                for workspace in self._workspaces.values()
+            }.values())
+
+    def profile_stats(self) -> dict:
+        """
+        Counters of the profile caches that are loaded (without loading any)
+
+        :rtype: dict of team id to `ProfileCache.stats()`
+        """
+        with self._lock:
+            caches = [(team_id, clients[2])
+                      for team_id, clients in self._clients.items()]
+        return {team_id: profiles.stats() for team_id, profiles in caches}
+
+    def ensure_indexes(self):
+        """Creates the index tokens are looked up by"""
+        self.database[self.collection].create_index('team_id', unique=True)
+
+    def stats(self) -> dict:
+        """
+        Workspace counters
+
+        :rtype: dict of workspaces, clients, and client and workspace evictions
+        """
+        with self._lock:
+            return {
+                'workspaces': len(self.loaded()),
+                'clients': len(self._clients),
+                'client_evictions': self.client_evictions,
+                'workspace_evictions': self.workspace_evictions
+            }
+
+    def _has_stored(self) -> bool:
+        """Whether any workspace is stored, checked at most every STORED_CHECK_SECONDS. Caller must hold the lock"""
+        now = time.monotonic()
+        if not self._any_stored and (
+                self._stored_checked_at is None
+                or now - self._stored_checked_at >= STORED_CHECK_SECONDS):
+            self._stored_checked_at = now
+            self._any_stored = self.database[self.collection].find_one(
+                {}, {'_id': 1}) is not None
+        return self._any_stored
+
+    def _evict(self) -> list:
+        """Drops the least recently used workspaces past MAX_WORKSPACES. Caller must hold the lock"""
+        evicted = []
+        while len(self._workspaces) > self.MAX_WORKSPACES:
+            team_id, workspace = self._workspaces.popitem(last=False)
+            self._clients.pop(team_id, None)
+            self.workspace_evictions += 1
+            evicted.append(workspace)
+        return evicted
+
+    def _load(self,
+              team_id,
+              bot_token,
+              user_token,
+              collection,
+              handoff_channel=None,
+              export_token=None) -> Workspace:
+        """Caller must hold the lock"""
+        workspace = Workspace(team_id, bot_token, user_token,
+                              self.db_factory(collection), self,
+                              handoff_channel, export_token)
+        self._workspaces[team_id] = workspace
+        if self.setup is not None:
+            self.setup(workspace)
+        logger.info('loaded workspace %s (%s)', team_id, collection)
+        return workspace
+
+    def _clients_for(self, workspace: Workspace) -> tuple:
+        with self._lock:
+            clients = self._clients.get(workspace.team_id)
+            if clients is not None:
+                self._clients.move_to_end(workspace.team_id)
+                return clients
+
+            client = self.client_factory(workspace.bot_token)
+            user_client = self.client_factory(workspace.user_token)
+            clients = self._clients[workspace.team_id] = (
+                client, user_client,
+                ProfileCache(user_client,
+                             max_size=self.profile_size,
+                             ttl=self.profile_ttl))
+            while len(self._clients) > self.MAX_CLIENTS:
+                self._clients.popitem(last=False)
+                self.client_evictions += 1
+            return clients
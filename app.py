@@ -1,183 +1,427 @@
+"""
+Flask server for the bot. `create_app` returns right away: MongoDB, the slack clients and the caches are made on first use,
+and schedules and profiles are loaded by a background warm-up while requests are already being served.
+
+Usage:
+```
+python app.py
+gunicorn 'app:create_app()'
+```
+"""
 import atexit
 import json
 import logging
 import os
-import re
-from collections import defaultdict
+import threading
+import time
 from datetime import datetime
+from functools import wraps
 from os.path import dirname, join
-from pprint import pformat
-from urllib.parse import quote
-from urllib.request import unquote
 
-import requests
-import slack
 from apscheduler.schedulers.background import BackgroundScheduler
 from dotenv import load_dotenv
-from flask import Flask, request
+from flask import Flask, Response, current_app, request
+from pymongo import MongoClient
 from slackeventsapi import SlackEventAdapter
 
-from BlockCreator import BlockBuilder, date_to_words
-from Database import MongoTools, parse_date
+import Commands
+from AsyncTools import run_sync
+from Commands import router, setup_workspace
+from Database import date_key
+from EventDedupe import (MemoryEventDedupe, MongoEventDedupe, event_key,
+                         interaction_key)
+from Interactions import decode_payload
+from LogTools import Pretty, configure_logging, payloads
+from Metrics import metrics, stat_samples
+from ScheduleIO import csv_lines, ics_lines
+from ShiftReminders import ShiftReminders
+from SlackTransport import SlackTransport
+from WorkQueue import WorkQueue
+from Workspaces import Workspace, Workspaces
+
+logger = logging.getLogger('app')
+
+
+def lazy(build):
+    """
+    Property made by `build` on first use, once even when many threads ask at the same time
+
+    :param build: method making the value
+    """
+    name = build.__name__
 
-app = Flask(__name__)
+    @property
+    @wraps(build)
+    def get(self):
+        try:
+            return self._built[name]
+        except KeyError:
+            with self._lock:
+                if name not in self._built:
+                    self._built[name] = build(self)
+                return self._built[name]
 
-dotenv_path = join(dirname(__file__), '.env')
-load_dotenv(dotenv_path)
+    return get
 
-slack_event_adapter = SlackEventAdapter(  # * Create environment (.env) variables for your slack signing secret
-    os.getenv('SLACK_SECRET'), "/slack/events", app)
-client = slack.WebClient(  # * Create environment variables for your bot token secret
-    os.getenv('SLACK_BOT_SECRET'))
-user_client = slack.WebClient(
-    token=os.getenv('SLACK_OAUTH_SECRET'))  # Used to get user data from slack
-scheduler = BackgroundScheduler()
-db = MongoTools(
-)  # Creates a mongotools instance for helping with user management
-logging.basicConfig(
-    filename='debug.log',
-    filemode='a',
-    format='%(asctime)s,%(msecs)d %(levelname)s %(message)s',
-    datefmt='%H:%M:%S',
-    level=logging.DEBUG)  # Creates logger to make debugging easier
-atexit.register(lambda: scheduler.shutdown())
 
-datepickers = {}  # Used as a cache for selecting dates.
+class Services():
+    """
+    Everything the Flask app uses. Each one is made the first time it is used, so workers start serving
+    requests before MongoDB or slack are ever contacted
+    """
+
+    def __init__(self, config: dict = None):
+        """
+        :param config: settings overriding the environment variables of the same name (like `{'WORKERS': 8}`)
+        """
+        self.config = config or {}
+        self._built = {}  # name -> value of each lazy property made so far
+        self._lock = threading.RLock()
+
+        self.startup_seconds = None  # Time `create_app` took
+        self.warm_up_seconds = None  # Time the background warm-up took
+
+    def setting(self, name: str, default=None):
+        """
+        Gets a setting from the config, or else the environment
+
+        :param name: setting name, the same as its environment variable
+        :param default: value if it is set in neither
+        """
+        if name in self.config:
+            return self.config[name]
+        return os.getenv(name, default)
+
+    @lazy
+    def transport(self) -> SlackTransport:
+        """Keep-alive connections, rate limits and retries shared by every slack client"""
+        return SlackTransport(
+            pool_size=int(self.setting('SLACK_POOL_SIZE', 10)),
+            max_retries=int(self.setting('SLACK_MAX_RETRIES', 3)))
+
+    @lazy
+    def mongo(self) -> MongoClient:
+        """One connection pool for every workspace"""
+        return MongoClient(
+            self.setting('MONGO_URI', 'mongodb://localhost:27017/'))
+
+    @lazy
+    def workspaces(self) -> Workspaces:
+        """Clients, profile caches and schedules of every slack workspace, by team_id"""
+        return Workspaces(
+            self.mongo['users'],
+            self.transport,
+            default_tokens=(
+                self.setting('SLACK_BOT_SECRET'),
+                self.setting('SLACK_OAUTH_SECRET')
+            ),  # * Create environment variables for your bot and user token secrets
+            default_export_token=self.setting('EXPORT_TOKEN'),
+            max_clients=int(self.setting('WORKSPACE_CLIENTS', 32)),
+            max_workspaces=int(self.setting('WORKSPACE_CACHE_SIZE', 256)),
+            profile_size=int(self.setting('PROFILE_CACHE_SIZE', 1024)),
+            profile_ttl=int(self.setting('PROFILE_CACHE_TTL', 3600)),
+            buffer_size=int(self.setting('MONGO_BUFFER_SIZE', 3)),
+            buffer_age=int(self.setting('MONGO_BUFFER_AGE', 60)),
+            setup=lambda ws: setup_workspace(ws, self.reminders, self.setting))
+
+    @lazy
+    def dedupe(self):
+        """Skips events slack sends again while a handler is slow"""
+        if self.setting('EVENT_DEDUPE') == 'mongo':  # Shared by every instance
+            return MongoEventDedupe(self.mongo['users'],
+                                    ttl=int(
+                                        self.setting('EVENT_DEDUPE_TTL', 900)))
+        return MemoryEventDedupe(
+            ttl=int(self.setting('EVENT_DEDUPE_TTL', 900)),
+            max_size=int(self.setting('EVENT_DEDUPE_SIZE', 10000)))
+
+    @lazy
+    def reminders(self) -> ShiftReminders:
+        """DMs at the start and end of shifts, or None if they are off"""
+        if not self.setting('SHIFT_REMINDERS'):
+            return None
+        return ShiftReminders(
+            self.workspaces,
+            MongoEventDedupe(self.mongo['users'],
+                             collection='sent_reminders',
+                             ttl=2 * 24 * 3600),
+            start_hour=int(self.setting('SHIFT_START_HOUR', 9)),
+            end_hour=int(self.setting('SHIFT_END_HOUR', 17)),
+            handoff_hour=int(self.setting('HANDOFF_HOUR', 9)),
+            handoff_channel=self.setting('HANDOFF_CHANNEL') or None,
+            catch_up=int(self.setting('SHIFT_REMINDER_CATCH_UP', 3600)))
+
+    @lazy
+    def work_queue(self) -> WorkQueue:
+        """Runs commands after slack is acknowledged"""
+        return WorkQueue(workers=int(self.setting('WORKERS', 4)),
+                         max_size=int(self.setting('WORK_QUEUE_SIZE', 100)))
+
+    @lazy
+    def scheduler(self) -> BackgroundScheduler:
+        return BackgroundScheduler()
+
+    def workspace_for(self, team_id: str) -> Workspace:
+        """
+        Gets the workspace an event or interaction came from
+
+        :param team_id: slack team id
+        :rtype: Workspace, or None if the team isn't installed
+        """
+        try:
+            return self.workspaces.get(team_id)
+        except KeyError:
+            logger.warning('no tokens for team %s', team_id)
+            return None
+
+    def start_jobs(self):
+        """
+        Starts the periodic jobs: flushing stale writes, reloading schedule indexes that other processes wrote to,
+        and rebuilding the on call snapshots at midnight. Also starts sending shift reminders, if they are on
+        (reminders are queued for each workspace as it is loaded, whether by the warm up or by its first event)
+        """
+        self.scheduler.add_job(
+            func=lambda: [
+                ws.db.flush_if_stale(collection=ws.db.collection)
+                for ws in self.workspaces.loaded()
+            ],
+            trigger='interval',
+            seconds=int(self.setting('MONGO_BUFFER_AGE', 60))
+        )  # Pushes to collection once buffered writes are older than MONGO_BUFFER_AGE
+        if int(self.setting('SCHEDULE_INDEX_REFRESH', 30)):
+            self.scheduler.add_job(
+                func=self.refresh_indexes,
+                trigger='interval',
+                seconds=int(self.setting('SCHEDULE_INDEX_REFRESH', 30))
+            )  # Picks up schedules written by other workers and imports
+        self.scheduler.add_job(
+            func=lambda: [
+                ws.on_call_snapshot.invalidate() or run_sync(
+                    ws.on_call_snapshot.arefresh(date_key(datetime.now()), 0))
+                for ws in self.workspaces.loaded()
+            ],
+            trigger='cron',
+            hour='0',
+            minute='0')  # Rebuilds the on call snapshots when the day rolls over
+        self.scheduler.start()
+        if self.reminders is not None:
+            self.reminders.start()
+        logger.info('started scheduled jobs successfully')
+
+    def refresh_indexes(self):
+        """Reloads the schedule index of every loaded workspace whose schedules changed in MongoDB"""
+        for ws in self.workspaces.loaded():
+            try:
+                if ws.schedule_index.refresh():
+                    logger.info(
+                        f'reloaded {len(ws.schedule_index)} schedules of {ws.team_id}'
+                    )
+            except Exception:
+                logger.exception('reloading the schedules of %s failed',
+                                 ws.team_id)
+
+    def warm_up(self):
+        """
+        Creates the indexes, loads the schedules and DM channels of every stored workspace and (with PROFILE_CACHE_WARM) their profiles.
+        `create_app` runs it in a background thread
+        """
+        started = time.perf_counter()
+        try:
+            self._warm_up()
+        except Exception:  # Everything is still loaded on first use
+            logger.exception('warm up failed')
+            return
+        self.warm_up_seconds = time.perf_counter() - started
+        logger.info(f'warmed up in {self.warm_up_seconds:.3f}s')
+
+    def _warm_up(self):
+        self.workspaces.ensure_indexes()
+        if isinstance(self.dedupe, MongoEventDedupe):
+            self.dedupe.ensure_indexes()
+        if self.reminders is not None:
+            self.reminders.sent.ensure_indexes()
+
+        for ws in self.workspaces.stored():
+            ws.db.ensure_indexes(ws.db.collection)
+            logger.info(
+                f'added date keys to {ws.db.migrate_date_keys(ws.db.collection)} schedules of {ws.team_id}'
+            )
+            logger.info(
+                f'loaded {len(ws.schedule_index)} schedules of {ws.team_id} into the index'
+            )
+        for ws in self.workspaces.loaded():
+            logger.info(
+                f'loaded {ws.dms.warm()} DM channels of {ws.team_id}')
+        if self.setting('PROFILE_CACHE_WARM'):
+            for ws in self.workspaces.loaded():
+                logger.info(
+                    f'warmed profile cache of {ws.team_id} with {ws.profiles.warm(ws.client)} users'
+                )
+        if self.reminders is not None:
+            logger.info(f'queued shift reminders: {self.reminders.stats()}')
+
+    def shutdown(self):
+        """Stops the jobs and workers, then flushes buffered writes. Only what was made is touched"""
+        built = dict(self._built)
+        if 'scheduler' in built and built['scheduler'].running:
+            built['scheduler'].shutdown()
+        if built.get('reminders') is not None:
+            built['reminders'].stop()
+        if 'work_queue' in built:
+            built['work_queue'].shutdown()
+        for ws in built['workspaces'].loaded() if 'workspaces' in built else (
+        ):
+            ws.db.push_to_collection(
+                ws.db.collection)  # After the workers are done
+
+    def collect_stats(self):
+        """Counters kept by the app, workspaces, caches, reminders, dedupe, queue, transport and router"""
+        built = dict(self._built)
+        for key in ('startup_seconds', 'warm_up_seconds'):
+            if getattr(self, key) is not None:
+                yield ('app_' + key, 'gauge',
+                       'Seconds create_app and the background warm-up took',
+                       {}, getattr(self, key))
+        if 'workspaces' in built:
+            yield from stat_samples(
+                'workspaces_', built['workspaces'].stats(),
+                'Workspaces loaded, slack clients cached and evictions')
+            for team_id, stats in built['workspaces'].profile_stats().items(
+            ):
+                yield from stat_samples(
+                    'profile_cache_', stats,
+                    'Profile cache counters (hits, misses, evictions, size)',
+                    {'team': team_id})
+            for ws in built['workspaces'].loaded():
+                yield from stat_samples(
+                    'on_call_snapshot_', ws.on_call_snapshot.stats(),
+                    'On call snapshot hits, builds and size',
+                    {'team': ws.team_id})
+                yield from stat_samples(
+                    'dm_channels_', ws.dms.stats(),
+                    'DM channels found, opened and pings coalesced',
+                    {'team': ws.team_id})
+        if built.get('reminders') is not None:
+            yield from stat_samples(
+                'shift_reminders_', built['reminders'].stats(),
+                'Shift reminders queued, sent, skipped and failed')
+        if 'dedupe' in built:
+            yield from stat_samples(
+                'event_dedupe_', built['dedupe'].stats(),
+                'Slack events checked and retries suppressed')
+        if 'work_queue' in built:
+            yield from stat_samples(
+                'work_queue_', built['work_queue'].stats(),
+                'Work queue depth, wait times and rejections')
+        if 'transport' in built:
+            yield from stat_samples(
+                'slack_transport_', built['transport'].stats(),
+                'Slack transport calls, retries and coalesced requests')
+        for name, stats in router.stats().items():
+            yield from stat_samples('command_', stats,
+                                    'Command invocations, errors and latency',
+                                    {'command': name})
+
+
+def create_app(config: dict = None) -> Flask:
+    """
+    Makes the Flask app. Nothing slow happens here, so a worker starts serving within milliseconds
+
+    :param config: settings overriding the environment variables of the same name.
+        `WARM_UP` (load schedules and profiles in the background) and `BACKGROUND_JOBS` (periodic flushes and
+        midnight refreshes) are on unless set to an empty value, and an empty `LOG_FILE` leaves logging alone
+    :rtype: Flask
+    :usage:
+    ```python
+    app = create_app({'EVENT_DEDUPE': 'mongo', 'WARM_UP': ''})
+    ```
+    """
+    started = time.perf_counter()
+    load_dotenv(join(dirname(__file__), '.env'))
+    services = Services(config)
+
+    app = Flask(__name__)
+    app.extensions['slack_bot'] = services
+    SlackEventAdapter(  # * Create environment (.env) variables for your slack signing secret
+        services.setting('SLACK_SECRET'), "/slack/events",
+        app).on(event="message")(handle_message)
+    app.add_url_rule("/slack/interactive",
+                     view_func=handle_interaction,
+                     methods=['GET', 'POST'])
+    app.add_url_rule("/oncall.ics", view_func=export_ics, methods=['GET'])
+    app.add_url_rule("/oncall.csv", view_func=export_csv, methods=['GET'])
+    app.add_url_rule("/metrics", view_func=handle_metrics, methods=['GET'])
+
+    metrics.enabled = bool(services.setting(
+        'METRICS_ENABLED'))  # Otherwise metrics are recorded after the first scrape
+    metrics.collector(
+        services.collect_stats)  # Replaces the collector of an older app, if any
+    if services.setting('LOG_FILE', 'debug.log'):
+        log_listener = configure_logging(
+            filename=services.setting('LOG_FILE', 'debug.log'),
+            level=services.setting('LOG_LEVEL', 'DEBUG'),
+            levels=services.setting('LOG_LEVELS', ''),
+            max_bytes=int(services.setting('LOG_MAX_BYTES',
+                                           10 * 1024 * 1024)),
+            backup_count=int(services.setting('LOG_BACKUP_COUNT', 5)),
+            when=services.setting('LOG_ROTATE_WHEN')
+        )  # Writes JSON lines from a background thread, rotating the file
+        atexit.register(lambda: log_listener.stop())
+    atexit.register(
+        services.shutdown)  # Registered last, so it runs before logging stops
+
+    if services.setting('BACKGROUND_JOBS', '1'):
+        services.start_jobs()
+    if services.setting('WARM_UP', '1'):
+        threading.Thread(target=services.warm_up, name='warm-up',
+                         daemon=True).start()
+
+    services.startup_seconds = time.perf_counter() - started
+    logger.info(f'created app in {services.startup_seconds:.3f}s')
+    return app
+
+
+def services() -> Services:
+    """The Services of the app handling the current request"""
+    return current_app.extensions['slack_bot']
 
 
-@slack_event_adapter.on(event="message")
 def handle_message(event_data):
     """
-    Does stuff with slack messages
-    
+    Queues slack messages to be run by `run_message`, so slack is acknowledged right away
+
     :param event_data: the payload sent from slack
     """
-    logging.debug(pformat(event_data))  # * DEBUG
+    payloads.debug('%s', Pretty(event_data))  # * DEBUG
 
     message = event_data["event"]  # gets event payload
-    user = message.get("user")  # Gets user id of user or None if not a user
-
-    if user:  # Makes sure that message is not sent by a bot
-
-        channel = message.get(
-            "channel")  # Gets channel that message was sent in
-        if message.get(
-                "text") == "on call":  # Command to schedule when on call
-
-            text = f"Hello <@{user}>! select the start date of the days you will be on call"
-
-            block = BlockBuilder([]).section(text=text).divider().datepicker(
-                text="Start Date").many_buttons(
-                    name_value=(("Next", "yes0"), ("Cancel",
-                                                   "no0"))).to_block()  # Block
-
-            client.chat_postMessage(channel=channel, blocks=block)
-            block = None
-        elif message.get(
-                "text"
-        ) == "view on call":  # See who is on call on whichever dates
-
-            db.push_to_collection('scheduled_users')
-
-            block = BlockBuilder(
-                []).section(text='*Dates People are on Call*').divider()
-
-            collection = db.database['scheduled_users']
-            c_time = datetime.now()
-            user_images = {}
-            for users in collection.find():
-                start_date = users['start_date']
-                end_date = users['end_date']
-                if start_date and end_date and len(start_date) >= 3 and len(
-                        end_date) >= 3:
-                    user_data = user_client.users_profile_get(
-                        user=users["user_id"])
-                    user_images[
-                        users['user_id']] = user_data['profile']['image_72']
-                    if int(start_date[0]) <= c_time.year <= int(end_date[0]):
-                        if int(start_date[1]) <= c_time.month <= int(
-                                end_date[1]):
-                            if int(start_date[2]) <= c_time.day <= int(
-                                    end_date[2]):
-
-                                block.context(data=((
-                                    'img', user_images[users['user_id']],
-                                    '_error displaying user image_'
-                                ), ('text',
-                                    f'<@{users["user_id"]}> is on call from the *{date_to_words(start_date[0], start_date[1], start_date[2])[0]}* to the *{date_to_words(end_date[0], end_date[1], end_date[2])[0]}*.\n_Contact them if you have any concerns_'
-                                    ))).button(name="Ping",
-                                               value=f'{users["user_id"]}')
-
-            block = block.to_block()
-            logging.debug(pformat(user_images))
-            logging.debug(pformat(block))
-            client.api_call("chat.postMessage",
-                            json={
-                                "channel": channel,
-                                "blocks": block
-                            })
-
-            block = None
-
-        elif message.get(
-                "text") == "reset on call":  # Remove user from on call list
-
-            db.database['scheduled_users'].update_one(
-                filter={'user_id': user},
-                update={'$set': {
-                    'start_date': None,
-                    'end_date': None
-                }},
-                upsert=True)
-            client.chat_postEphemeral(
-                user=user,
-                channel=channel,
-                text=f'Sucessfully removed you from on call list')
-
-        elif message.get("text") == "help me schedule":  # Help Command
-
-            block = BlockBuilder([]).section(
-                text='_Beep Boop_. I am a bot who schedules things!'
-            ).divider().section(
-                text=
-                '*Command*: `view on call`\n\nThis command displays who is on call on certain dates.\n>Usage: type `view on call` to see who is on call.'
-            ).section(
-                text=
-                '*Command*: `view me`\n\nThis command shows only when you are on call.\n>Usage: type `view me` to view when you are on call.'
-            ).section(
-                text=
-                '*Command*: `on call`\n\nThis command allows you to pick the dates you are on call.\n>Usage: type `on call` and follow the steps I display!'
-            ).section(
-                text=
-                '*Command*: `reset on call`\n\nThis command removes you from the on call list.\n>Usage: type `reset on call` to be removed from the list'
-            ).to_block()
-
-            client.chat_postEphemeral(user=user, channel=channel, blocks=block)
-
-            block = None
-        elif message.get("text") == "view me":
-            user_data = db.database['scheduled_users'].find_one(
-                {'user_id': user})
-            start_date = user_data.get("start_date")
-            end_date = user_data.get("end_date")
-            if not (start_date or end_date):
-                client.chat_postMessage(
-                    channel=channel,
-                    text=
-                    "You haven't specified when you will be on call! To specify, please type `on call` and follow the steps it gives you."
-                )
-                return
-
-            block = BlockBuilder(
-                []
-            ).section(text="Showing when *you* are on call").divider().section(
-                text=
-                f"You are on call from the *{date_to_words(start_date[0], start_date[1], start_date[2])[0]}* to the *{date_to_words(end_date[0], end_date[1], end_date[2])[0]}*.\n>If you would like to change this, type `on call`. If you would like to remove yourself from the on call list, type `reset on call`."
-            ).to_block()
 
-            client.chat_postMessage(channel=channel, blocks=block)
+    if message.get("user") and router.match(message.get("text"))[
+            0]:  # Makes sure that message is a command not sent by a bot
+        bot = services()
+        key = event_key(event_data)
+        if bot.dedupe.seen(key):
+            logger.info('skipped retry %s of event %s',
+                        request.headers.get('X-Slack-Retry-Num'), key)
+            return
+        if not bot.work_queue.submit(run_message, bot, message,
+                                     event_data.get("team_id")):
+            bot.dedupe.forget(key)  # So slack's retry is run
+            logger.warning('work queue full, dropped message: %s',
+                           bot.work_queue.stats())
+
+
+def run_message(bot: Services, message, team_id=None):
+    """
+    Does stuff with slack messages
 
-            block = None
+    :param bot: Services of the app the message was sent to
+    :param message: the event sent from slack
+    :param team_id: workspace the event came from
+    """
+    ws = bot.workspace_for(team_id or message.get("team"))
+    if ws is not None:
+        run_sync(Commands.run_command(ws, message))
 
 
 # @slack_event_adapter.on(event="message.im")
@@ -194,217 +438,114 @@ def handle_message(event_data):
 #         client.chat_postMessage(channel=im_channel, text="hello to you!")
 
 
-@app.route("/slack/interactive", methods=['GET', 'POST'])
 def handle_interaction():
     """Sends payload whenever interactive element (button, etc.) is pressed"""
     raw_data = request.get_data()  # Gets the data
 
-    if raw_data is not None:
+    if raw_data:
         # converts url-ified JSON payload into readable json
         try:
-            req = json.loads(
-                unquote(raw_data.decode()).replace("payload=", ""))
-        except:
-            logging.debug(
+            req = decode_payload(raw_data)
+        except ValueError:
+            logger.exception(
                 "Something went wrong on slack's side")  # Slack Problem
-            raise
+            return 'action unsuccessful: Invalid Payload', 400
 
-        logging.debug(pformat(req))
-        message = req.get('message')
-        user = req.get('user')
-
-        channel = req.get('channel').get('id')
-        m_ts = message.get('ts')
-        actions = req.get('actions')
+        payloads.debug('%s', Pretty(req))
     else:
-        logging.debug("Slack sent no data back!")
+        logger.debug("Slack sent no data back!")
         return 'action unsuccessful: No Data Recieved'  # Slack Problem
-    logging.debug(pformat(req))
-    global datepickers
-
-    if actions[0].get(
-            'type'
-    ) == 'button':  # Uses a dict-cache to save values of previous datepicker
-        handle_button_click(value=actions[0].get('value'),
-                            user=user['id'],
-                            channel=channel,
-                            ts=m_ts)
-        if re.match(re.compile(r"\w{9}"), actions[0].get('value')):
-            dm_payload = client.im_open(user=actions[0].get('value'))
-
-            client.chat_postMessage(
-                channel=dm_payload['channel']['id'],
-                text=
-                f'<@{user["id"]}> wants to talk to you about when you\'re on call. Please shoot them a dm.'
-            )
-            return 'action successful'
-
-        if actions[0].get('value') == "no0" or actions[0].get(
-                'value') == "no1" or actions[0].get('value') == "yes1":
-            if actions[0].get('value') == "yes1":
-                logging.debug(pformat(datepickers))
-                if datepickers.get(user['id']):
-                    if datepickers.get(user['id']).get('start_date'):
-                        start_date = datepickers.get(
-                            user['id']).get('start_date')
-                    else:
-                        start_date = message['blocks'][2]['accessory'][
-                            'initial_date']
-                    if datepickers.get(user['id']).get('end_date'):
-                        end_date = datepickers.get(user['id']).get('end_date')
-                    else:
-                        end_date = message['blocks'][2]['accessory'][
-                            'initial_date']
-                else:
-                    start_date = message['blocks'][2]['accessory'][
-                        'initial_date']
-                    end_date = message['blocks'][2]['accessory'][
-                        'initial_date']
-                db.append(other=[{
-                    'user_id': user['id'],
-                    'name': user['username'],
-                    'start_date': parse_date(start_date)[1],
-                    'end_date': parse_date(end_date)[1]
-                }])
-            client.api_call("chat.delete",
-                            json={
-                                "channel": channel,
-                                "ts": m_ts
-                            })
-            datepickers.pop(user['id'])
-
-    if actions[0].get('type') == 'datepicker':
-        if message.get('blocks')[-1].get('elements')[0].get('value') == 'yes0':
-            try:
-                datepickers[user['id']] = {
-                    'start_date': actions[0].get('selected_date')
-                }
-            except Exception as e:
-                logging.exception(e)
-                datepickers[user['id']] = {
-                    'start_date': actions[0].get('initial_date')
-                }
-            logging.debug(pformat(datepickers))
-        if message.get('blocks')[-1].get('elements')[0].get('value') == 'yes1':
-            try:
-                try:
-                    datepickers[user['id']] = {
-                        'start_date': datepickers[user['id']].get('start_date')
-                    }
-                except:
-                    datepickers[user['id']] = {
-                        'start_date': actions[0].get('initial_date')
-                    }
-                datepickers[user['id']]['end_date'] = actions[0].get(
-                    'selected_date')
-            except Exception as e:
-                logging.exception(e)
-                try:
-                    datepickers[user['id']] = {
-                        'start_date': datepickers[user['id']].get('start_date')
-                    }
-                except Exception as e:
-                    logging.exception(e)
-                    datepickers[user['id']] = {
-                        'start_date': actions[0].get('initial_date')
-                    }
-                datepickers[user['id']]['end_date'] = {
-                    actions[0].get('initial_date')
-                }
-            logging.debug(pformat(datepickers))
 
+    bot = services()
+    key = interaction_key(req)
+    if req.get('type') == 'view_submission':  # Saving the same dates again is harmless, and a retry needs the response too
+        return run_view_submission(bot, req)
+    if bot.dedupe.seen(key):
+        logger.info('skipped repeated interaction %s', key)
+        return 'action successful'
+    if Commands.interactions.is_inline(
+            req):  # Like opening a modal, which has to happen within 3 seconds of the click
+        try:
+            run_interaction(bot, req)
+        except Exception:
+            logger.exception('interaction failed')
+        return 'action successful'
+    if not bot.work_queue.submit(run_interaction, bot, req):
+        bot.dedupe.forget(key)
+        logger.warning('work queue full, dropped interaction: %s',
+                       bot.work_queue.stats())
+        return 'action unsuccessful: Too Busy', 503
     return 'action successful'
 
 
-def handle_button_click(
-        value,
-        user,
-        channel,
-        ts,
-):
+def run_interaction(bot: Services, req):
+    """
+    Handles an interaction payload queued by `handle_interaction`
+
+    :param bot: Services of the app the interaction was sent to
+    :param req: the decoded interaction payload
+    """
+    ws = bot.workspace_for((req.get('team') or {}).get('id'))
+    if ws is not None:
+        run_sync(Commands.run_interaction(ws, req))
+
+
+def run_view_submission(bot: Services, req) -> Response:
+    """
+    Handles a submitted modal while slack waits, so validation errors are shown in the modal
+
+    :param bot: Services of the app the modal was submitted to
+    :param req: the decoded `view_submission` payload
+    :rtype: Response, empty to close the modal
     """
-    Handles user interaction with date selection block interaction
-    
-    :param value: button value
-    :param user: user id
-    :param channel: channel posting
-    :ts: timestamp of actual message
+    ws = bot.workspace_for((req.get('team') or {}).get('id'))
+    response = run_sync(Commands.run_view_submission(
+        ws, req)) if ws is not None else None
+    if response is None:
+        return Response(status=200)
+    return Response(json.dumps(response), mimetype='application/json')
+
+
+def export_ics():
+    """Everyone's on call dates as a calendar feed"""
+    return export_schedules('ics', ics_lines, 'text/calendar; charset=utf-8')
+
+
+def export_csv():
+    """Everyone's on call dates as CSV"""
+    return export_schedules('csv', csv_lines, 'text/csv; charset=utf-8')
+
+
+def export_schedules(format: str, lines, mimetype: str) -> Response:
+    """
+    Streams every schedule of a workspace (`?team=<team_id>`, or the default one) from its index, for requests
+    with the workspace's export token (`&token=<token>`). The ETag is a hash of the schedules, the same in every worker,
+    so polling clients get a 304 until something changes
+
+    :param format: file extension, part of the ETag
+    :param lines: generator function turning schedule documents into lines
+    :param mimetype: Content-Type of the response
     """
-    if value == 'yes0':
-        block = BlockBuilder([]).section(
-            text=f'Now select the end date, <@{user}>.').divider().datepicker(
-                text="End Date").many_buttons(name_value=(("Submit", "yes1"),
-                                                          ("Cancel",
-                                                           "no1"))).to_block()
-
-        client.api_call("chat.update",
-                        json={
-                            "text": '',
-                            "channel": channel,
-                            "ts": ts,
-                            "blocks": block
-                        })
-        block = None
-
-    elif value == 'no0':
-        client.api_call("chat.postEphemeral",
-                        json={
-                            "attachments": [{
-                                "pretext":
-                                ":tada: *Deleting message...* :tada:",
-                                "text": "No longer scheduling"
-                            }],
-                            "user":
-                            user,
-                            "channel":
-                            channel
-                        })
-
-    elif value == 'yes1':
-        client.api_call(
-            "chat.postEphemeral",
-            json={
-                'attachments': [{
-                    'pretext':
-                    ':tada: *Scheduling message...* :tada:',
-                    'text':
-                    'Please allow up to `10` minutes for your scheduling to be saved.'
-                }],
-                'user':
-                user,
-                'channel':
-                channel
-            })
-    elif value == 'no1':
-        client.api_call("chat.postEphemeral",
-                        json={
-                            "attachments": [{
-                                "pretext":
-                                ":tada: *Deleting message...* :tada:",
-                                "text": "No longer scheduling"
-                            }],
-                            "user":
-                            user,
-                            "channel":
-                            channel
-                        })
+    ws = services().workspace_for(request.args.get('team'))
+    if ws is None:
+        return 'unknown team', 404
+    if not ws.allows_export(request.args.get('token')):
+        return 'invalid token', 403
+    version, documents = ws.schedule_index.snapshot()
+    etag = f'{format}-{ws.team_id}-{version}'
+    headers = {'ETag': f'"{etag}"', 'Cache-Control': 'no-cache'}
+    if etag in request.if_none_match:
+        return Response(status=304, headers=headers)
+    return Response(lines(documents), mimetype=mimetype, headers=headers)
+
+
+def handle_metrics():
+    """Prometheus scrape endpoint"""
+    return Response(metrics.render(),
+                    mimetype='text/plain; version=0.0.4; charset=utf-8')
 
 
 if __name__ == "__main__":
-    open('debug.log', 'w+').close()
-
-    scheduler.add_job(func=lambda: open('debug.log', 'w+').close(),
-                      trigger='cron',
-                      year='*',
-                      month='*',
-                      day='*',
-                      hour='0')  # Adds job to reset logs @ 12:00 AM Every Day
-    scheduler.add_job(
-        func=lambda: db.push_to_collection(collection="scheduled_users"),
-        trigger='interval',
-        minutes=10)  # Pushes to collection every 10 minutes
-    scheduler.start()
-    logging.info('started scheduled jobs successfully')
-
-    app.run(port=3000
-            )  # Starts server for listening to slack web api and interactivity
+    create_app().run(
+        port=3000
+    )  # Starts server for listening to slack web api and interactivity
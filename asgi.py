@@ -0,0 +1,418 @@
+"""
+ASGI server for the bot, an alternative to the Flask app (`app.py`) that holds many slack requests at once on one event loop.
+Slack is called with the async slack client and schedules are written with motor; the commands are the same ones the Flask app runs (see Commands.py)
+
+Usage:
+```
+pip install uvicorn motor aiohttp
+uvicorn asgi:app --port 3000
+```
+"""
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import os
+import time
+from datetime import datetime
+from os.path import dirname, join
+from urllib.parse import parse_qsl
+
+import aiohttp
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import MongoClient
+
+import Commands
+from AsyncTools import maybe_await
+from Commands import router, setup_workspace
+from Database import AsyncMongoTools, date_key
+from EventDedupe import (AsyncMongoEventDedupe, MemoryEventDedupe, event_key,
+                         interaction_key)
+from Interactions import decode_payload, loads
+from LogTools import Pretty, configure_logging, payloads
+from Metrics import metrics, stat_samples
+from ScheduleIO import csv_lines, ics_lines
+from ShiftReminders import ShiftReminders
+from SlackTransport import AsyncWebClient, SlackTransport
+from Workspaces import Workspaces
+
+load_dotenv(join(dirname(__file__), '.env'))
+
+metrics.enabled = bool(os.getenv(
+    'METRICS_ENABLED'))  # Otherwise metrics are recorded after the first scrape
+SIGNING_SECRET = os.getenv('SLACK_SECRET', '')
+MAX_IN_FLIGHT = int(os.getenv(
+    'ASGI_MAX_IN_FLIGHT', 500))  # Events and interactions handled at once
+
+transport = SlackTransport(max_retries=int(os.getenv(
+    'SLACK_MAX_RETRIES', 3)))  # Rate limiters and counters (aiohttp sends)
+mongo = MongoClient(os.getenv('MONGO_URI', 'mongodb://localhost:27017/')
+                    )  # Only used to load the schedule indexes
+async_mongo = AsyncIOMotorClient(
+    os.getenv('MONGO_URI', 'mongodb://localhost:27017/'))
+http_session = None  # aiohttp.ClientSession shared by every slack client, made on startup
+if os.getenv('EVENT_DEDUPE') == 'mongo':
+    dedupe = AsyncMongoEventDedupe(async_mongo['users'],
+                                   ttl=int(os.getenv('EVENT_DEDUPE_TTL', 900)))
+else:
+    dedupe = MemoryEventDedupe(ttl=int(os.getenv('EVENT_DEDUPE_TTL', 900)),
+                               max_size=int(
+                                   os.getenv('EVENT_DEDUPE_SIZE', 10000)))
+workspaces = Workspaces(
+    mongo['users'],
+    transport,
+    default_tokens=(os.getenv('SLACK_BOT_SECRET'),
+                    os.getenv('SLACK_OAUTH_SECRET')),
+    default_export_token=os.getenv('EXPORT_TOKEN'),
+    max_clients=int(os.getenv('WORKSPACE_CLIENTS', 32)),
+    max_workspaces=int(os.getenv('WORKSPACE_CACHE_SIZE', 256)),
+    profile_size=int(os.getenv('PROFILE_CACHE_SIZE', 1024)),
+    profile_ttl=int(os.getenv('PROFILE_CACHE_TTL', 3600)),
+    buffer_size=int(os.getenv('MONGO_BUFFER_SIZE', 3)),
+    buffer_age=int(os.getenv('MONGO_BUFFER_AGE', 60)),
+    setup=lambda ws: setup_workspace(ws, reminders),
+    client_factory=lambda token: AsyncWebClient(
+        token, transport=transport, session=http_session),
+    db_factory=lambda collection: AsyncMongoTools(
+        async_mongo,
+        buffer_size=workspaces.buffer_size,
+        max_age=workspaces.buffer_age,
+        collection=collection,
+        mongo_client=mongo))
+reminders = ShiftReminders(
+    workspaces,
+    AsyncMongoEventDedupe(async_mongo['users'],
+                          collection='sent_reminders',
+                          ttl=2 * 24 * 3600),
+    start_hour=int(os.getenv('SHIFT_START_HOUR', 9)),
+    end_hour=int(os.getenv('SHIFT_END_HOUR', 17)),
+    handoff_hour=int(os.getenv('HANDOFF_HOUR', 9)),
+    handoff_channel=os.getenv('HANDOFF_CHANNEL') or None,
+    catch_up=int(os.getenv('SHIFT_REMINDER_CATCH_UP', 3600))) if os.getenv(
+        'SHIFT_REMINDERS') else None
+log_listener = configure_logging(
+    filename=os.getenv('LOG_FILE', 'debug.log'),
+    level=os.getenv('LOG_LEVEL', 'DEBUG'),
+    levels=os.getenv('LOG_LEVELS', ''),
+    max_bytes=int(os.getenv('LOG_MAX_BYTES', 10 * 1024 * 1024)),
+    backup_count=int(os.getenv('LOG_BACKUP_COUNT', 5)),
+    when=os.getenv('LOG_ROTATE_WHEN'))
+logger = logging.getLogger('asgi')
+
+_tasks = set()  # Running handlers (the event loop only keeps weak references)
+_background = []  # Periodic jobs started on startup
+
+
+def verify_signature(body: bytes, timestamp: str, signature: str,
+                     now: float = None) -> bool:
+    """
+    Checks that a request was signed by slack with the signing secret
+
+    :param body: raw request body
+    :param timestamp: `X-Slack-Request-Timestamp` header
+    :param signature: `X-Slack-Signature` header
+    :param now: current unix time (defaults to time.time())
+    :rtype: bool
+    """
+    try:
+        if abs((now or time.time()) - int(timestamp)) > 60 * 5:
+            return False  # Stops replayed requests
+    except (TypeError, ValueError):
+        return False
+    expected = 'v0=' + hmac.new(SIGNING_SECRET.encode(),
+                                b'v0:' + timestamp.encode() + b':' + body,
+                                hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature or '')
+
+
+async def workspace_for(team_id: str):
+    """
+    Gets the workspace an event or interaction came from, with its schedule index loaded. Both read MongoDB with
+    pymongo the first time, so they run off the event loop
+
+    :param team_id: slack team id
+    :rtype: Workspace, or None if the team isn't installed
+    """
+
+    def load():
+        ws = workspaces.get(team_id)
+        len(ws.schedule_index)  # Loads it here, instead of in the first handler that queries it
+        return ws
+
+    try:
+        return await asyncio.get_running_loop().run_in_executor(None, load)
+    except KeyError:
+        logger.warning('no tokens for team %s', team_id)
+        return None
+
+
+def spawn(coroutine) -> bool:
+    """
+    Runs a handler in the background, so slack is acknowledged right away
+
+    :param coroutine: the handler
+    :rtype: bool, False if MAX_IN_FLIGHT handlers are already running
+    """
+    if len(_tasks) >= MAX_IN_FLIGHT:
+        coroutine.close()
+        return False
+    task = asyncio.get_running_loop().create_task(coroutine)
+    _tasks.add(task)
+    task.add_done_callback(_finished)
+    return True
+
+
+def _finished(task):
+    _tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error('handler failed', exc_info=task.exception())
+
+
+async def handle_event(body: bytes, retry: str = None):
+    """Slack Events API requests"""
+    try:
+        event_data = loads(body)
+    except ValueError:
+        return 400, 'text/plain', b'Invalid JSON'
+    if event_data.get('type') == 'url_verification':
+        return 200, 'text/plain', event_data['challenge'].encode()
+
+    payloads.debug('%s', Pretty(event_data))
+    message = event_data.get('event') or {}
+    if message.get('type') == 'message' and message.get(
+            'user') and router.match(message.get('text'))[0]:
+        key = event_key(event_data)
+        if await maybe_await(dedupe.seen(key)):
+            logger.info('skipped retry %s of event %s', retry, key)
+            return 200, 'text/plain', b''
+        ws = await workspace_for(event_data.get(
+            'team_id'))  # Only reads MongoDB the first time a team is seen
+        if ws is not None and not spawn(Commands.run_command(ws, message)):
+            await maybe_await(dedupe.forget(key))  # So slack's retry is run
+            logger.warning('too many requests in flight, dropped message')
+            return 503, 'text/plain', b'Too Busy'
+    return 200, 'text/plain', b''
+
+
+async def handle_interaction(body: bytes, retry: str = None):
+    """Slack interactivity requests (buttons, datepickers, modal submissions)"""
+    try:
+        req = decode_payload(body)
+    except ValueError:
+        logger.exception("Something went wrong on slack's side")
+        return 400, 'text/plain', b'action unsuccessful: Invalid Payload'
+    payloads.debug('%s', Pretty(req))
+
+    ws = await workspace_for((req.get('team') or {}).get('id'))
+    if req.get('type') == 'view_submission':  # Slack waits for the response, to show validation errors (retries need it too)
+        response = await Commands.run_view_submission(
+            ws, req) if ws is not None else None
+        if response is None:
+            return 200, 'text/plain', b''
+        return 200, 'application/json', json.dumps(response).encode()
+    key = interaction_key(req)
+    if await maybe_await(dedupe.seen(key)):
+        logger.info('skipped repeated interaction %s', key)
+        return 200, 'text/plain', b'action successful'
+    if ws is not None and Commands.interactions.is_inline(
+            req):  # Like opening a modal, which has to happen within 3 seconds of the click
+        try:
+            await Commands.run_interaction(ws, req)
+        except Exception:
+            logger.exception('interaction failed')
+        return 200, 'text/plain', b'action successful'
+    if ws is not None and not spawn(Commands.run_interaction(ws, req)):
+        await maybe_await(dedupe.forget(key))
+        logger.warning('too many requests in flight, dropped interaction')
+        return 503, 'text/plain', b'action unsuccessful: Too Busy'
+    return 200, 'text/plain', b'action successful'
+
+
+async def app(scope, receive, send):
+    """The ASGI application"""
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+
+    path, method = scope['path'], scope['method']
+    headers = {k.decode().lower(): v.decode() for k, v in scope['headers']}
+
+    if method == 'GET' and path == '/metrics':
+        return await respond(send, 200,
+                             'text/plain; version=0.0.4; charset=utf-8',
+                             metrics.render().encode())
+    if method == 'GET' and path in ('/oncall.ics', '/oncall.csv'):
+        return await export_schedules(scope, headers, send)
+    if method != 'POST' or path not in ('/slack/events',
+                                        '/slack/interactive'):
+        return await respond(send, 404, 'text/plain', b'Not Found')
+
+    body = await read_body(receive)
+    if not verify_signature(body, headers.get('x-slack-request-timestamp'),
+                            headers.get('x-slack-signature')):
+        return await respond(send, 403, 'text/plain', b'Invalid signature')
+
+    handler = handle_event if path == '/slack/events' else handle_interaction
+    await respond(send, *await handler(body, headers.get('x-slack-retry-num')))
+
+
+async def export_schedules(scope, headers: dict, send):
+    """Streams every schedule of a workspace, like the Flask app's `/oncall.ics` and `/oncall.csv`"""
+    query = dict(parse_qsl(scope['query_string'].decode()))
+    ws = await workspace_for(query.get('team'))
+    if ws is None:
+        return await respond(send, 404, 'text/plain', b'unknown team')
+    if not ws.allows_export(query.get('token')):
+        return await respond(send, 403, 'text/plain', b'invalid token')
+
+    format = scope['path'].rsplit('.', 1)[-1]
+    version, documents = await asyncio.get_running_loop().run_in_executor(
+        None, ws.schedule_index.snapshot)  # Sorting and hashing every schedule
+    etag = f'"{format}-{ws.team_id}-{version}"'
+    response_headers = [(b'etag', etag.encode()), (b'cache-control', b'no-cache')]
+    if etag in (tag.strip().replace('W/', '', 1)
+                for tag in headers.get('if-none-match', '').split(',')):
+        return await send({
+            'type': 'http.response.start',
+            'status': 304,
+            'headers': response_headers
+        })
+
+    mimetype = 'text/calendar' if format == 'ics' else 'text/csv'
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [(b'content-type', f'{mimetype}; charset=utf-8'.encode())] +
+        response_headers
+    })
+    lines = ics_lines if format == 'ics' else csv_lines
+    for line in lines(documents):
+        await send({
+            'type': 'http.response.body',
+            'body': line.encode(),
+            'more_body': True
+        })
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+@metrics.collector
+def collect_stats():
+    """Counters kept by the event dedupe and the shift reminders"""
+    if reminders is not None:
+        yield from stat_samples(
+            'shift_reminders_', reminders.stats(),
+            'Shift reminders queued, sent, skipped and failed')
+    yield from stat_samples('event_dedupe_', dedupe.stats(),
+                            'Slack events checked and retries suppressed')
+
+
+async def read_body(receive) -> bytes:
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+
+async def respond(send, status: int, content_type: str, body: bytes):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', content_type.encode())]
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await startup()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await shutdown()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def startup():
+    global http_session
+    http_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(
+        limit=int(os.getenv('SLACK_POOL_SIZE', 10))))
+    if isinstance(dedupe, AsyncMongoEventDedupe):
+        await dedupe.ensure_indexes()
+    if reminders is not None:
+        await reminders.sent.ensure_indexes()
+
+    def load():  # pymongo, so it runs off the event loop
+        workspaces.ensure_indexes()
+        for ws in workspaces.stored():
+            ws.db.ensure_indexes(ws.db.collection)
+            logger.info(
+                f'added date keys to {ws.db.migrate_date_keys(ws.db.collection)} schedules of {ws.team_id}'
+            )
+            logger.info(
+                f'loaded {len(ws.schedule_index)} schedules of {ws.team_id} into the index'
+            )
+
+    await asyncio.get_running_loop().run_in_executor(None, load)
+    _background.append(asyncio.ensure_future(flush_stale()))
+    _background.append(asyncio.ensure_future(refresh_at_midnight()))
+    if int(os.getenv('SCHEDULE_INDEX_REFRESH', 30)):
+        _background.append(asyncio.ensure_future(refresh_indexes()))
+    if reminders is not None:
+        _background.append(asyncio.ensure_future(reminders.run()))
+    logger.info('started asgi server')
+
+
+async def shutdown():
+    for job in _background:
+        job.cancel()
+    if _tasks:
+        await asyncio.wait(list(_tasks), timeout=10)
+    for ws in workspaces.loaded():
+        await ws.db.push_to_collection(ws.db.collection)
+    await http_session.close()
+    log_listener.stop()
+
+
+async def flush_stale():
+    """Pushes buffered writes once they are older than MONGO_BUFFER_AGE"""
+    while True:
+        await asyncio.sleep(workspaces.buffer_age)
+        for ws in workspaces.loaded():
+            try:
+                await ws.db.flush_if_stale(collection=ws.db.collection)
+            except Exception:
+                logger.exception('flushing %s failed', ws.team_id)
+
+
+async def refresh_indexes():
+    """Reloads schedule indexes that other processes wrote to, every SCHEDULE_INDEX_REFRESH seconds"""
+    while True:
+        await asyncio.sleep(int(os.getenv('SCHEDULE_INDEX_REFRESH', 30)))
+        for ws in workspaces.loaded():
+            try:  # pymongo, so it runs off the event loop
+                if await asyncio.get_running_loop().run_in_executor(
+                        None, ws.schedule_index.refresh):
+                    logger.info(
+                        f'reloaded {len(ws.schedule_index)} schedules of {ws.team_id}'
+                    )
+            except Exception:
+                logger.exception('reloading the schedules of %s failed',
+                                 ws.team_id)
+
+
+async def refresh_at_midnight():
+    """Rebuilds the on call snapshots when the day rolls over"""
+    while True:
+        now = datetime.now()
+        tomorrow = datetime.fromordinal(now.toordinal() + 1)
+        await asyncio.sleep((tomorrow - now).total_seconds())
+        for ws in workspaces.loaded():
+            ws.on_call_snapshot.invalidate()
+            await ws.on_call_snapshot.arefresh(date_key(datetime.now()), 0)
@@ -0,0 +1,258 @@
+"""
+Microbenchmarks for the code that runs on every request (and the calendar engine), and the time a worker takes to start
+
+Usage:
+```
+python benchmarks.py                 # compare against bench_baseline.json
+python benchmarks.py --save          # record a new baseline
+python benchmarks.py --sizes 10,1000 --threshold 0.3
+```
+"""
+import argparse
+import json
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import date
+from importlib.util import find_spec
+from os.path import dirname, join
+
+from BlockCreator import BlockBuilder, date_to_words, slot
+from CalendarEngine import coverage_gaps
+from Database import MongoTools, parse_date, with_date_keys
+
+BASELINE_PATH = join(dirname(__file__), 'bench_baseline.json')
+DEFAULT_SIZES = (10, 1000, 100000)
+STARTUP_SCRIPT = ("import app; app.create_app({'SLACK_SECRET': 'benchmark', "
+                  "'LOG_FILE': '', 'WARM_UP': '', 'BACKGROUND_JOBS': ''})"
+                  )  # Imports and app creation, without MongoDB or slack
+
+
+class FakeCollection():
+    """In-memory stand-in for the parts of a pymongo collection MongoTools uses"""
+
+    def __init__(self):
+        self.documents = {}  # user_id -> document
+
+    def update_one(self, filter, update, upsert=False):
+        doc = self.documents.get(filter['user_id'])
+        if doc is None and upsert:
+            doc = self.documents[filter['user_id']] = {}
+        if doc is not None:
+            doc.update(update['$set'])
+
+    def bulk_write(self, requests, ordered=True):
+        for request in requests:  # pymongo.UpdateOne keeps its arguments in private attributes
+            self.update_one(request._filter, request._doc, request._upsert)
+
+    def find_one(self, filter):
+        return self.documents.get(filter['user_id'])
+
+
+class FakeDatabase(dict):
+    def __missing__(self, name):
+        collection = self[name] = FakeCollection()
+        return collection
+
+
+def synthetic_schedules(count: int, seed: int = 0) -> list:
+    """
+    Creates reproducible schedule documents
+
+    :param count: number of users
+    :param seed: random seed
+    :rtype: list of dicts shaped like `scheduled_users` documents
+    """
+    rng = random.Random(seed)
+    schedules = []
+    for i in range(count):
+        year = rng.choice(('2025', '2026'))
+        month = f'{rng.randint(1, 12):02}'
+        start_day = rng.randint(1, 20)
+        schedules.append({
+            'user_id': f'U{i:08}',
+            'name': f'user{i}',
+            'start_date': [year, month, f'{start_day:02}'],
+            'end_date': [year, month, f'{start_day + rng.randint(0, 8):02}']
+        })
+    return schedules
+
+
+def fake_mongo_tools(buffer_size: int) -> MongoTools:
+    """MongoTools writing to a FakeDatabase instead of MongoDB"""
+    tools = MongoTools(buffer_size=buffer_size, max_age=float('inf'))
+    tools.database = FakeDatabase()
+    return tools
+
+
+def measure(func, ops: int, rounds: int = 5, round_time: float = 0.1) -> dict:
+    """
+    Times a benchmark and measures its allocations. The best round is kept, since slower rounds are noise
+
+    :param func: function running `ops` operations per call
+    :param ops: operations done by one call of func
+    :param rounds: times the benchmark is repeated
+    :param round_time: seconds each round keeps calling func for
+    :rtype: dict of ops/sec and bytes allocated per op
+    """
+    func()  # Warm up
+
+    best = 0.0
+    for _ in range(rounds):
+        calls = 0
+        start = time.perf_counter()
+        while True:
+            func()
+            calls += 1
+            elapsed = time.perf_counter() - start
+            if elapsed >= round_time:
+                break
+        best = max(best, calls * ops / elapsed)
+
+    tracemalloc.start()
+    func()
+    allocated, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {'ops_per_sec': best, 'bytes_per_op': peak / ops}
+
+
+def benchmarks(sizes: tuple) -> dict:
+    """
+    Builds every benchmark
+
+    :param sizes: numbers of synthetic users to run the size dependent benchmarks with
+    :rtype: dict of benchmark name to (function, ops per call)
+    """
+    suite = {}
+    dates = [
+        f"{s['start_date'][0]}-{s['start_date'][1]}-{s['start_date'][2]}"
+        for s in synthetic_schedules(1000)
+    ]
+    splits = [s['start_date'] for s in synthetic_schedules(1000)]
+
+    suite['parse_date'] = (lambda: [parse_date(d) for d in dates], len(dates))
+    suite['date_to_words'] = (lambda: [date_to_words(*d) for d in splits],
+                              len(splits))
+
+    def builder_chain():
+        block = BlockBuilder([]).section(
+            text='*Dates People are on Call*').divider()
+        for i in range(10):
+            block.context(data=(('img', 'https://example.com/a.png', 'alt'),
+                                ('text', f'<@U{i:08}> is on call'))).button(
+                                    name="Ping", value=f'U{i:08}')
+        return block.to_block()
+
+    suite['block_builder_chain'] = (builder_chain, 1)
+
+    def builder_messages():
+        block = BlockBuilder([]).section(text='*Everyone on call*').divider()
+        for i in range(200):
+            block.context(data=(('text', f'<@U{i:08}> is on call'), )).button(
+                name="Ping", value=f'U{i:08}')
+        return block.to_messages()
+
+    suite['block_to_messages'] = (builder_messages, 1)
+
+    template = BlockBuilder([]).section(
+        text=f"Hello <@{slot('user')}>!").divider().datepicker(
+            text="Start Date", initial_date=slot('date')).to_template()
+    suite['block_template_render'] = (lambda: [
+        template.render(user=f'U{i:08}', date='2026-01-01') for i in range(100)
+    ], 100)
+
+    if find_spec('flask') and find_spec('slackeventsapi'):
+        suite['app_startup'] = (lambda: subprocess.run(
+            [sys.executable, '-c', STARTUP_SCRIPT],
+            cwd=dirname(__file__) or '.',
+            check=True), 1)  # ops/sec is starts per second
+
+    for size in sizes:
+        schedules = synthetic_schedules(size)
+
+        def append(schedules=schedules):
+            tools = fake_mongo_tools(buffer_size=len(schedules) + 1)
+            for schedule in schedules:
+                tools.append([schedule])
+
+        def push(schedules=schedules):
+            tools = fake_mongo_tools(buffer_size=len(schedules) + 1)
+            tools.append(schedules)
+            tools.push_to_collection('scheduled_users')
+
+        keyed = [with_date_keys(dict(s)) for s in schedules]
+        suite[f'coverage_gaps[{size}]'] = (
+            lambda keyed=keyed: coverage_gaps(keyed, start=date(2025, 1, 1)),
+            size)
+        suite[f'mongo_append[{size}]'] = (append, size)
+        suite[f'mongo_push_to_collection[{size}]'] = (push, size)
+    return suite
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """
+    Finds benchmarks slower than the baseline by more than the threshold
+
+    :param results: results of this run
+    :param baseline: saved results
+    :param threshold: allowed slowdown (0.2 is 20% fewer ops/sec)
+    :rtype: list of regression messages
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        expected = baseline[name]['ops_per_sec']
+        if result['ops_per_sec'] < expected * (1 - threshold):
+            regressions.append(
+                f"{name}: {result['ops_per_sec']:.0f} ops/sec, baseline {expected:.0f}"
+            )
+    return regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--sizes',
+                        default=','.join(map(str, DEFAULT_SIZES)),
+                        help='comma separated numbers of synthetic users')
+    parser.add_argument('--threshold',
+                        type=float,
+                        default=0.2,
+                        help='allowed slowdown before failing (0.2 = 20%%)')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save',
+                        action='store_true',
+                        help='save the results as the new baseline')
+    args = parser.parse_args(argv)
+
+    sizes = tuple(int(size) for size in args.sizes.split(','))
+    results = {}
+    for name, (func, ops) in benchmarks(sizes).items():
+        results[name] = measure(func, ops)
+        print(f"{name:40} {results[name]['ops_per_sec']:>14,.0f} ops/sec"
+              f" {results[name]['bytes_per_op']:>10,.0f} B/op")
+
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f'saved baseline to {args.baseline}')
+        return 0
+
+    try:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        print('no baseline saved yet, run with --save')
+        return 0
+
+    regressions = compare(results, baseline, args.threshold)
+    for regression in regressions:
+        print(f'REGRESSION {regression}')
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -5,7 +5,12 @@ setup(
     version="0.0.4-ALPHA",
     packages=[
         'flask', 'slackeventsapi', 'slackclient', 'pymongo', 'python-dotenv',
-        'apscheduler'
+        'apscheduler', 'numpy'
     ],
+    extras_require={
+        'fast': ['orjson'],  # Faster JSON decoding of interaction payloads
+        'async': ['uvicorn', 'motor', 'aiohttp'],  # The ASGI server (asgi.py)
+        'test': ['pytest', 'mongomock'],  # python -m pytest
+    },
     long_description=open("readme.md").read(),
 )
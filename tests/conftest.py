@@ -0,0 +1,5 @@
+import sys
+from os.path import abspath, dirname
+
+sys.path.insert(0, dirname(dirname(abspath(
+    __file__))))  # The modules live at the top of the repo
@@ -0,0 +1,84 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeSlack():
+    """
+    Local stand-in for the slack Web API. Every call is recorded, and answers can be scripted per method
+    """
+
+    def __init__(self):
+        self.calls = []  # (method, body) of every request received
+        self.scripts = {}  # method -> list of (status, headers, body), used before the default answer
+        self.delay = 0  # Seconds every answer takes
+        self._lock = threading.Lock()
+
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                fake._handle(self)
+
+            do_GET = do_POST
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.base_url = f'http://127.0.0.1:{self.server.server_port}/api/'
+        self._thread = threading.Thread(target=self.server.serve_forever,
+                                        args=(0.01, ),
+                                        daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def script(self, method: str, *answers):
+        """
+        Queues answers for a method, each a (status, headers, body) tuple or 'disconnect' to drop the connection
+
+        :param method: api method (like `chat.postMessage`)
+        """
+        self.scripts.setdefault(method, []).extend(answers)
+
+    def count(self, method: str) -> int:
+        with self._lock:
+            return sum(1 for called, _ in self.calls if called == method)
+
+    def _handle(self, request):
+        method = request.path.rsplit('/', 1)[-1].split('?')[0]
+        length = int(request.headers.get('Content-Length') or 0)
+        body = request.rfile.read(length).decode()
+        with self._lock:
+            self.calls.append((method, body))
+            scripted = self.scripts.get(method)
+            answer = scripted.pop(0) if scripted else (200, {}, {
+                'ok': True,
+                'channel': {
+                    'id': 'D1'
+                },
+                'ts': f'{len(self.calls)}.0'
+            })
+        if self.delay:
+            time.sleep(self.delay)
+        if answer == 'disconnect':
+            request.close_connection = True
+            request.connection.shutdown(2)
+            return
+
+        status, headers, payload = answer
+        data = json.dumps(payload).encode()
+        request.send_response(status)
+        request.send_header('Content-Type', 'application/json')
+        request.send_header('Content-Length', str(len(data)))
+        for name, value in headers.items():
+            request.send_header(name, value)
+        request.end_headers()
+        request.wfile.write(data)
@@ -0,0 +1,22 @@
+import pytest
+
+pytest.importorskip('flask')
+pytest.importorskip('slackeventsapi')
+
+from app import create_app  # noqa: E402
+
+
+def test_reminders_start_without_the_warm_up():
+    app = create_app({
+        'SLACK_SECRET': 'test',
+        'LOG_FILE': '',
+        'WARM_UP': '',
+        'SHIFT_REMINDERS': '1'
+    })
+    services = app.extensions['slack_bot']
+    try:
+        thread = services.reminders._thread
+        assert thread is not None and thread.is_alive()
+        assert services.reminders.start() is thread  # Starting again keeps the running thread
+    finally:
+        services.shutdown()
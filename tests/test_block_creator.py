@@ -0,0 +1,97 @@
+import json
+
+import pytest
+
+from BlockCreator import (MAX_BLOCKS, MAX_MESSAGE_BYTES, BlockBuilder,
+                          BlockLimitError)
+
+
+def encoded_size(blocks: list) -> int:
+    return len(json.dumps(blocks, separators=(",", ":")))
+
+
+def on_call_list(users: int, text: str = 'is on call') -> BlockBuilder:
+    block = BlockBuilder([]).section(text='*Everyone on call*').divider()
+    for i in range(users):
+        block.context(data=(('text', f'<@U{i:08}> {text}'), )).button(
+            name="Ping", value=f'U{i:08}')
+    return block
+
+
+def test_size_is_kept_up_to_date():
+    block = on_call_list(30)
+
+    assert block.size == encoded_size(block.block)
+    assert BlockBuilder(list(block.block)).size == block.size
+
+
+def test_messages_stay_within_the_limits_and_keep_the_order():
+    block = on_call_list(200)
+    messages = block.to_messages()
+
+    assert len(messages) == 9  # 402 blocks
+    assert [b for message in messages for b in message] == block.block
+    for message in messages:
+        assert len(message) <= MAX_BLOCKS
+        assert encoded_size(message) <= MAX_MESSAGE_BYTES
+
+
+def test_messages_are_split_by_size():
+    block = on_call_list(40, text='is on call ' + 'x' * 2000)
+    messages = block.to_messages()
+
+    assert len(messages) > 2
+    assert [b for message in messages for b in message] == block.block
+    for message in messages:
+        assert encoded_size(message) <= MAX_MESSAGE_BYTES
+
+
+def test_buttons_stay_with_the_block_before_them():
+    for max_blocks in (3, 4, 5):
+        messages = on_call_list(10).to_messages(max_blocks=max_blocks)
+        for message in messages[1:]:
+            assert message[0]['type'] == 'context'
+
+
+def test_buttons_are_only_carried_when_they_fit_with_their_block():
+    block = on_call_list(2, text='x' * 300)
+    together = encoded_size(block.block[2:4])  # A context block and its buttons
+
+    for max_bytes, carried in ((together, True), (together - 1, False)):
+        messages = block.to_messages(max_bytes=max_bytes)
+        assert [b for message in messages for b in message] == block.block
+        for message in messages:
+            assert encoded_size(message) <= max_bytes
+        assert (messages[1][0]['type'] == 'context') is carried
+
+
+def test_a_block_too_big_for_any_message_is_an_error():
+    block = BlockBuilder([]).context(data=(('text', 'x' * 500), ))
+
+    with pytest.raises(BlockLimitError, match='block 1'):
+        block.to_messages(max_bytes=100)
+
+
+def test_validate_checks_the_encoded_size():
+    block = on_call_list(20, text='x' * 2500)
+
+    assert len(block) <= MAX_BLOCKS and block.size > MAX_MESSAGE_BYTES
+    with pytest.raises(BlockLimitError, match='bytes'):
+        block.to_block()
+    assert len(block.to_messages()) == 2
+
+
+def test_validate_lists_every_broken_limit():
+    block = BlockBuilder([]).section(text='x').append({
+        'type': 'context',
+        'elements': [{
+            'type': 'mrkdwn',
+            'text': 'x'
+        }] * 11
+    })
+
+    with pytest.raises(BlockLimitError,
+                       match='block 2: context with 11 elements'):
+        block.to_block()
+    with pytest.raises(BlockLimitError):
+        block.to_messages()
@@ -0,0 +1,47 @@
+import asyncio
+
+import pytest
+
+from CommandRouter import CommandError, CommandRouter
+
+
+@pytest.fixture
+def router():
+    router = CommandRouter()
+    router.calls = []
+
+    @router.command("on call")
+    def on_call(user):
+        router.calls.append(('on call', user))
+
+    @router.command("view on call", args=(("date", int, None), ))
+    def view_on_call(user, date):
+        router.calls.append(('view on call', date))
+
+    return router
+
+
+def test_commands_match_with_their_arguments(router):
+    assert router.match('on call')[0].name == 'on call'
+    assert router.match('View On Call 20300101') == (router.match(
+        'view on call')[0], ['20300101'])
+
+
+def test_extra_words_are_chatter_not_a_command(router):
+    assert router.match('on call rotation is broken today') == (None, None)
+    assert router.match('view on call for next week') == (None, None)
+    assert asyncio.run(
+        router.adispatch('on call rotation is broken today',
+                         user='U1')) is False
+    assert router.calls == []
+
+
+def test_invalid_arguments_are_reported(router):
+    with pytest.raises(CommandError, match='Usage: `view on call \\[date\\]`'):
+        asyncio.run(router.adispatch('view on call tomorrow', user='U1'))
+
+
+def test_dispatch_runs_the_handler(router):
+    assert asyncio.run(router.adispatch('view on call 20300101', user='U1'))
+    assert router.calls == [('view on call', 20300101)]
+    assert router.stats()['view on call']['invocations'] == 1
@@ -0,0 +1,185 @@
+import asyncio
+
+import mongomock
+import pytest
+
+from CommandRouter import CommandError
+from Commands import (MAX_ON_CALL_PAGE_SIZE, interactions, on_call_blocks,
+                      router, run_view_submission, schedule_errors,
+                      setup_workspace)
+from Database import with_date_keys
+from Workspaces import Workspaces
+
+
+def workspace(config: dict, buffer_size: int = 3):
+    workspaces = Workspaces(mongomock.MongoClient()['users'],
+                            transport=None,
+                            default_tokens=('xoxb-default', None),
+                            buffer_size=buffer_size,
+                            setup=lambda ws: setup_workspace(
+                                ws, setting=lambda name, default=None: config.
+                                get(name, default)))
+    return workspaces.get(None)
+
+
+def test_setup_reads_the_settings_it_is_given():
+    ws = workspace({
+        'ON_CALL_PAGE_SIZE': '4',
+        'ON_CALL_SNAPSHOT_AGE': '30',
+        'DM_CHANNEL_CACHE_SIZE': '8',
+        'PING_WINDOW': '5'
+    })
+
+    assert ws.on_call_page_size == 4
+    assert ws.on_call_snapshot.MAX_AGE == 30
+    assert ws.dms.MAX_SIZE == 8
+    assert ws.dms.WINDOW == 5
+
+
+def test_on_call_pages_fit_in_a_message():
+    assert workspace({'ON_CALL_PAGE_SIZE': '1000'
+                      }).on_call_page_size == MAX_ON_CALL_PAGE_SIZE
+
+
+def test_schedule_errors_accepts_dates_from_today_on():
+    assert schedule_errors('2030-01-01', '2030-01-01', today=20300101) == {}
+    assert schedule_errors('2029-12-01', '2030-01-05', today=20300101) == {}
+
+
+def test_schedule_errors_needs_both_dates():
+    assert schedule_errors(None, '2030-01-01') == {'start': 'Pick a date'}
+    assert schedule_errors('2030-01-01', 'not a date') == {
+        'end': 'Pick a date'
+    }
+    assert schedule_errors(None, None) == {
+        'start': 'Pick a date',
+        'end': 'Pick a date'
+    }
+
+
+def test_schedule_errors_refuses_backwards_and_past_shifts():
+    assert schedule_errors('2030-01-05', '2030-01-01', today=20290101) == {
+        'end': "The end date can't be before the start date"
+    }
+    assert schedule_errors('2029-12-01', '2029-12-31', today=20300101) == {
+        'end': 'The end date has already passed'
+    }
+
+
+def test_opening_the_schedule_modal_runs_inline():
+    assert interactions.is_inline(
+        {'actions': [{
+            'action_id': 'schedule_open',
+            'value': 'open'
+        }]})
+    assert not interactions.is_inline(
+        {'actions': [{
+            'action_id': 'ping',
+            'value': 'U1'
+        }]})
+    assert not interactions.is_inline({'type': 'view_submission'})
+
+
+def schedule_submission(start: str, end: str) -> dict:
+    return {
+        'type': 'view_submission',
+        'user': {
+            'id': 'U1',
+            'username': 'ann'
+        },
+        'view': {
+            'callback_id': 'schedule',
+            'state': {
+                'values': {
+                    'start': {
+                        'start_date': {
+                            'selected_date': start
+                        }
+                    },
+                    'end': {
+                        'end_date': {
+                            'selected_date': end
+                        }
+                    }
+                }
+            }
+        }
+    }
+
+
+def test_saving_the_modal_buffers_the_dates_without_flushing():
+    ws = workspace({}, buffer_size=1)
+
+    response = asyncio.run(
+        run_view_submission(ws, schedule_submission('2999-01-01',
+                                                    '2999-01-05')))
+
+    assert response['response_action'] == 'update'
+    assert ws.db.buffer['U1']['end_date'] == ['2999', '01', '05']
+    assert ws.schedule_index.get('U1')['name'] == 'ann'
+    assert ws.db.flushes == 0
+
+
+def test_saving_the_modal_flushes_without_background_jobs():
+    ws = workspace({'BACKGROUND_JOBS': ''})
+
+    asyncio.run(
+        run_view_submission(ws, schedule_submission('2999-01-01',
+                                                    '2999-01-05')))
+
+    assert len(ws.db) == 0
+    assert ws.db.database[ws.db.collection].find_one(
+        {'user_id': 'U1'})['end_key'] == 29990105
+
+
+def test_saving_the_modal_shows_what_is_wrong():
+    ws = workspace({})
+
+    response = asyncio.run(
+        run_view_submission(ws, schedule_submission('2999-01-05',
+                                                    '2999-01-01')))
+
+    assert response == {
+        'response_action': 'errors',
+        'errors': {
+            'end': "The end date can't be before the start date"
+        }
+    }
+    assert len(ws.db) == 0
+
+
+def test_on_call_pages_are_read_from_mongodb_until_the_index_is_loaded():
+    ws = workspace({'ON_CALL_PAGE_SIZE': '2'})
+    for i in range(5):
+        ws.db.database[ws.db.collection].insert_one(
+            with_date_keys({
+                'user_id': f'U{i}',
+                'start_date': ['2030', '01', f'{i + 1:02}'],
+                'end_date': ['2030', '01', '10']
+            }))
+        ws.profiles.put(f'U{i}', {'image_72': f'https://example.com/U{i}.png'})
+
+    def pages():
+        return [asyncio.run(on_call_blocks(ws, 20300105, page)) for page in range(3)]
+
+    cold = pages()
+    assert "<@U0>" in str(cold[0]) and "<@U4>" in str(cold[2])
+    assert not ws.schedule_index.loaded
+    assert len(ws.schedule_index) == 5
+    assert pages() == cold
+
+
+def test_view_on_call_takes_real_dates():
+    command, words = router.match('view on call 2030-01-31')
+    assert command.parse(words) == {'date': 20300131}
+    assert command.parse([]) == {'date': None}
+
+
+@pytest.mark.parametrize('text', [
+    'view on call 2026-02-31', 'view on call 12345', 'view on call 2030-1-5x',
+    'view on call tomorrow'
+])
+def test_view_on_call_refuses_bad_dates(text):
+    command, words = router.match(text)
+    with pytest.raises(CommandError, match='Usage: `view on call \\[date\\]`'):
+        command.parse(words)
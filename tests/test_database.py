@@ -0,0 +1,183 @@
+import asyncio
+import threading
+
+import mongomock
+import pytest
+
+from Database import AsyncMongoTools, MongoTools
+
+
+def mongo_tools(buffer_size=10):
+    return MongoTools(buffer_size=buffer_size,
+                      max_age=float('inf'),
+                      mongo_client=mongomock.MongoClient())
+
+
+def stored(tools):
+    return {
+        doc['user_id']: doc
+        for doc in tools.database['scheduled_users'].find({}, {'_id': 0})
+    }
+
+
+def test_writes_to_the_same_user_are_merged():
+    tools = mongo_tools()
+    tools.append([{
+        'user_id': 'U1',
+        'name': 'ann',
+        'start_date': ['2030', '01', '01']
+    }])
+    tools.append([{'user_id': 'U1', 'start_date': ['2030', '02', '01']}])
+
+    assert len(tools) == 1
+    assert tools.buffer['U1'] == {
+        'user_id': 'U1',
+        'name': 'ann',
+        'start_date': ['2030', '02', '01']
+    }
+
+
+def schedule(user_id):
+    return {
+        'user_id': user_id,
+        'start_date': ['2030', '01', '01'],
+        'end_date': ['2030', '01', '02']
+    }
+
+
+def test_full_buffer_is_flushed_in_one_bulk_write():
+    tools = mongo_tools(buffer_size=3)
+    tools.append([schedule('U0'), schedule('U1')])
+    assert stored(tools) == {}
+
+    tools.append([schedule('U2')])
+    assert len(tools) == 0
+    assert tools.flushes == 1
+    assert stored(tools)['U2']['start_key'] == 20300101
+
+
+def test_appends_that_dont_flush_leave_it_to_the_next_write():
+    tools = mongo_tools(buffer_size=1)
+    tools.append([schedule('U0')], flush=False)
+    assert len(tools) == 1 and stored(tools) == {}
+
+    tools.append([schedule('U1')])
+    assert len(tools) == 0
+    assert sorted(stored(tools)) == ['U0', 'U1']
+
+
+def test_failed_flush_is_restored_without_losing_newer_writes():
+    tools = mongo_tools()
+    tools.append([{
+        'user_id': 'U1',
+        'name': 'ann',
+        'start_date': ['2030', '01', '01']
+    }, {
+        'user_id': 'U2',
+        'name': 'bob'
+    }])
+    collection = tools.database['scheduled_users']
+    flushing = threading.Event()
+
+    def bulk_write(requests, ordered=True):
+        flushing.set()
+        tools.append([{
+            'user_id': 'U1',
+            'start_date': ['2030', '03', '01']
+        }])  # Written while the flush is in flight
+        raise ConnectionError('mongo is down')
+
+    collection.bulk_write = bulk_write
+    tools.database = {'scheduled_users': collection}
+    with pytest.raises(ConnectionError):
+        tools.push_to_collection('scheduled_users')
+
+    assert flushing.is_set()
+    assert tools.buffer['U1'] == {
+        'user_id': 'U1',
+        'name': 'ann',
+        'start_date': ['2030', '03', '01']
+    }
+    assert tools.buffer['U2'] == {'user_id': 'U2', 'name': 'bob'}
+    assert tools._in_flight == {}
+
+
+def test_listeners_see_every_write():
+    tools = mongo_tools()
+    seen = []
+    tools.add_listener(lambda user_id, doc: seen.append((user_id, doc)))
+    tools.append([{'user_id': 'U1', 'name': 'ann'}])
+    tools.remove_user('scheduled_users', 'U1')
+
+    assert seen == [('U1', {'user_id': 'U1', 'name': 'ann'}), ('U1', None)]
+
+
+def test_on_call_between_uses_the_date_keys():
+    tools = mongo_tools(buffer_size=1)
+    tools.ensure_indexes()
+    tools.append([
+        schedule('U0'), {
+            'user_id': 'U1',
+            'start_date': ['2030', '01', '02'],
+            'end_date': ['2030', '01', '09']
+        }
+    ])
+
+    assert [doc['user_id'] for doc in tools.on_call_between(20300101)] == ['U0']
+    assert sorted(doc['user_id'] for doc in tools.on_call_between(
+        '2030-01-02', '2030-01-03')) == ['U0', 'U1']
+    assert list(tools.on_call_between(20300110)) == []
+    assert 'start_key_1_end_key_1' in tools.database[
+        'scheduled_users'].index_information()
+
+
+class AsyncCollection():
+    """A mongomock collection with motor's async `bulk_write`"""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def bulk_write(self, requests, ordered=True):
+        return self.collection.bulk_write(requests, ordered=ordered)
+
+
+def async_tools():
+    client = mongomock.MongoClient()
+    motor = {
+        'users': {
+            'scheduled_users': AsyncCollection(client['users']['scheduled_users'])
+        }
+    }
+    return AsyncMongoTools(motor,
+                           buffer_size=10,
+                           max_age=float('inf'),
+                           mongo_client=client)
+
+
+def test_async_flush_waits_for_the_running_flush():
+    tools = async_tools()
+
+    async def flush_while_locked():
+        await tools.append([schedule('U1')], flush=False)
+        tools._flush_lock.acquire()  # Like a flush from another thread
+        flush = asyncio.ensure_future(
+            tools.push_to_collection('scheduled_users'))
+        await asyncio.sleep(0.05)
+        assert not flush.done()
+        tools._flush_lock.release()
+        return await flush
+
+    assert asyncio.run(flush_while_locked()) == 1
+    assert 'U1' in stored(tools)
+
+
+def test_async_import_flushes_the_buffer_first():
+    tools = async_tools()
+
+    async def import_over_a_buffered_write():
+        await tools.append([{**schedule('U1'), 'name': 'old'}], flush=False)
+        return await tools.upsert_many([{**schedule('U1'), 'name': 'new'}])
+
+    assert asyncio.run(import_over_a_buffered_write()) == 1
+    assert len(tools) == 0
+    assert stored(tools)['U1']['name'] == 'new'
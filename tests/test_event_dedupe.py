@@ -0,0 +1,19 @@
+import pytest
+
+from EventDedupe import EventDedupe, MemoryEventDedupe
+
+
+def test_the_interface_cannot_be_used_directly():
+    with pytest.raises(TypeError):
+        EventDedupe()
+
+
+def test_retries_are_suppressed_until_forgotten():
+    dedupe = MemoryEventDedupe(ttl=60)
+
+    assert not dedupe.seen('Ev1')
+    assert dedupe.seen('Ev1')
+    assert not dedupe.seen(None)
+    dedupe.forget('Ev1')
+    assert not dedupe.seen('Ev1')
+    assert dedupe.stats() == {'checked': 3, 'suppressed': 1}
@@ -0,0 +1,178 @@
+import random
+
+import mongomock
+
+from Database import MongoTools, date_key
+from IntervalIndex import IntervalIndex
+from Workspaces import Workspace
+
+
+def random_schedules(count, seed):
+    rng = random.Random(seed)
+    schedules = []
+    for i in range(count):
+        start = 20300101 + rng.randint(0, 27)
+        schedules.append({
+            'user_id': f'U{i:04}',
+            'start_key': start,
+            'end_key': start + rng.randint(0, 5)
+        })
+    return schedules
+
+
+def brute_force(schedules, start, end):
+    return sorted((doc for doc in schedules
+                   if doc['start_key'] <= end and doc['end_key'] >= start),
+                  key=lambda doc: (doc['start_key'], doc['user_id']))
+
+
+def test_range_queries_match_brute_force():
+    for seed in range(20):
+        schedules = random_schedules(200, seed)
+        index = IntervalIndex()
+        index.load(schedules)
+        rng = random.Random(seed)
+        for _ in range(50):
+            start = 20300101 + rng.randint(-3, 33)
+            end = start + rng.randint(0, 6)
+            assert index.between(start, end) == brute_force(
+                schedules, start, end)
+
+
+def test_writes_are_applied_to_queries():
+    schedules = random_schedules(50, 0)
+    index = IntervalIndex()
+    index.load(schedules)
+
+    index.apply('U0001', {
+        'start_date': ['2030', '02', '01'],
+        'end_date': ['2030', '02', '03']
+    })
+    index.apply('U0002', None)
+
+    on_call = [doc['user_id'] for doc in index.at('2030-02-02')]
+    assert on_call == ['U0001']
+    assert index.get('U0002') is None
+    assert len(index) == 49
+
+
+def workspace():
+    db = MongoTools(buffer_size=100,
+                    max_age=float('inf'),
+                    mongo_client=mongomock.MongoClient())
+    return Workspace('T1', 'xoxb-test', None, db, owner=None)
+
+
+def test_refresh_picks_up_writes_from_other_processes():
+    ws = workspace()
+    other = MongoTools(buffer_size=1, mongo_client=ws.db.mc)  # Another worker, or an import
+    reloaded = []
+    ws.schedule_index.add_listener(lambda: reloaded.append(True))
+    assert len(ws.schedule_index) == 0
+
+    other.append([{
+        'user_id': 'U1',
+        'start_date': ['2030', '01', '01'],
+        'end_date': ['2030', '01', '05']
+    }])
+    assert ws.schedule_index.get('U1') is None
+    assert ws.schedule_index.refresh()
+    assert ws.schedule_index.get('U1')['start_key'] == 20300101
+    assert reloaded == [True]
+    assert not ws.schedule_index.refresh()  # Nothing changed since
+
+
+def test_refresh_keeps_buffered_writes():
+    ws = workspace()
+    other = MongoTools(buffer_size=1, mongo_client=ws.db.mc)
+    ws.db.append([{
+        'user_id': 'U1',
+        'start_date': ['2030', '01', '01'],
+        'end_date': ['2030', '01', '02']
+    }])  # Still in this worker's buffer
+    other.append([{
+        'user_id': 'U2',
+        'start_date': ['2030', '01', '01'],
+        'end_date': ['2030', '01', '02']
+    }])
+
+    assert ws.schedule_index.refresh()
+    assert [doc['user_id']
+            for doc in ws.schedule_index.at(date_key('2030-01-01'))
+            ] == ['U1', 'U2']
+
+
+def test_snapshot_version_is_the_same_in_every_process():
+    schedules = random_schedules(50, seed=1)
+    first, second = IntervalIndex(), IntervalIndex()
+    first.load(dict(doc) for doc in schedules)
+    second.load({
+        **dict(reversed(list(doc.items()))), '_id': i
+    } for i, doc in enumerate(reversed(schedules)))  # Another order, with MongoDB ids
+
+    assert first.snapshot()[0] == second.snapshot()[0]
+
+    first.apply('U0001', {'end_key': 20310101})
+    assert first.snapshot()[0] != second.snapshot()[0]
+    second.apply('U0001', {'end_key': 20310101})
+    assert first.snapshot()[0] == second.snapshot()[0]
+
+
+def test_writes_go_to_the_overlay_until_it_is_full():
+    schedules = random_schedules(200, 2)
+    index = IntervalIndex(overlay_size=10)
+    index.load(dict(doc) for doc in schedules)
+    root = index._tree()
+    rng = random.Random(2)
+
+    for i in range(10):
+        start = 20300101 + rng.randint(0, 27)
+        user_id = f'U{rng.randint(0, 199):04}'
+        if i % 4 == 3:
+            index.apply(user_id, None)
+            schedules = [doc for doc in schedules if doc['user_id'] != user_id]
+        else:
+            doc = {'user_id': user_id, 'start_key': start, 'end_key': start + 2}
+            index.apply(user_id, doc)
+            schedules = [
+                other for other in schedules if other['user_id'] != user_id
+            ] + [doc]
+        for day in range(20300101, 20300129, 3):
+            assert [(doc['user_id'], doc['start_key'])
+                    for doc in index.between(day, day + 2)] == [
+                        (doc['user_id'], doc['start_key'])
+                        for doc in brute_force(schedules, day, day + 2)
+                    ]
+        assert index._tree() is root  # Not rebuilt yet
+
+    index.apply('U0000', {'end_key': 20300201})
+    index.apply('U0001', {'end_key': 20300201})
+    assert index._tree() is not root
+
+
+def test_refresh_reads_only_the_schedules_written_since():
+    ws = workspace()
+    other = MongoTools(buffer_size=1, mongo_client=ws.db.mc)
+    for user_id in ('U1', 'U2'):
+        other.append([{
+            'user_id': user_id,
+            'start_date': ['2030', '01', '01'],
+            'end_date': ['2030', '01', '02']
+        }])
+    assert len(ws.schedule_index) == 2
+
+    other.append([{'user_id': 'U1', 'end_date': ['2030', '01', '05']}])
+    other.append([{
+        'user_id': 'U3',
+        'start_date': ['2030', '01', '04'],
+        'end_date': ['2030', '01', '04']
+    }])
+    assert ws.schedule_index.refresh()
+    assert (ws.schedule_index.updates, ws.schedule_index.reloads) == (1, 0)
+    assert [doc['user_id'] for doc in ws.schedule_index.at(20300104)
+            ] == ['U1', 'U3']
+
+    other.remove_user('scheduled_users', 'U2')  # The count no longer adds up
+    assert ws.schedule_index.refresh()
+    assert ws.schedule_index.reloads == 1
+    assert ws.schedule_index.get('U2') is None
@@ -0,0 +1,95 @@
+import pytest
+
+from Metrics import Registry, stat_samples
+
+
+def parse(text):
+    """Families of a prometheus text exposition, failing on anything a scraper would reject"""
+    families = {}  # name -> (type, samples)
+    series = set()
+    current = None
+    for line in text.splitlines():
+        if line.startswith('# HELP '):
+            continue
+        if line.startswith('# TYPE '):
+            _, _, name, metric_type = line.split(' ', 3)
+            assert name not in families, f'{name} is described twice'
+            families[name] = (metric_type, [])
+            current = name
+            continue
+        name = line.split('{', 1)[0].split(' ', 1)[0]
+        assert line.rsplit(' ', 1)[0] not in series, f'{line} is rendered twice'
+        series.add(line.rsplit(' ', 1)[0])
+        assert current is not None and name.startswith(
+            current), f'{name} is outside its family'
+        families[current][1].append(line)
+    return families
+
+
+def test_counts_are_counters_and_sizes_are_gauges():
+    samples = list(
+        stat_samples('cache_', {
+            'hits': 3,
+            'size': 2
+        }, 'Cache counters', {'team': 'T1'}))
+
+    assert samples == [('cache_hits_total', 'counter', 'Cache counters', {
+        'team': 'T1'
+    }, 3), ('cache_size', 'gauge', 'Cache counters', {
+        'team': 'T1'
+    }, 2)]
+
+
+def test_samples_of_a_family_are_rendered_together():
+    registry = Registry()
+
+    @registry.collector
+    def collect():
+        for command in ('on call', 'view on call'):
+            yield from stat_samples('command_', {
+                'invocations': 1,
+                'errors': 0
+            }, 'Command counters', {'command': command})
+
+    families = parse(registry.render())
+
+    assert families['command_invocations_total'][0] == 'counter'
+    assert len(families['command_invocations_total'][1]) == 2
+    assert len(families['command_errors_total'][1]) == 2
+
+
+def test_registering_a_collector_again_replaces_it():
+    registry = Registry()
+
+    class App():
+
+        def __init__(self, value):
+            self.value = value
+
+        def collect(self):
+            yield ('app_value', 'gauge', 'Value', {}, self.value)
+
+    registry.collector(App(1).collect)
+    registry.collector(App(2).collect)
+
+    assert parse(registry.render())['app_value'][1] == ['app_value 2']
+
+
+def test_apps_made_twice_render_valid_metrics():
+    pytest.importorskip('flask')
+    pytest.importorskip('slackeventsapi')
+    from app import create_app
+
+    config = {'SLACK_SECRET': 'test', 'LOG_FILE': '', 'WARM_UP': ''}
+    create_app(config).extensions['slack_bot'].shutdown()
+    app = create_app(config)
+    try:
+        families = parse(
+            app.test_client().get('/metrics').get_data(as_text=True))
+    finally:
+        app.extensions['slack_bot'].shutdown()
+
+    assert families['command_invocations_total'][0] == 'counter'
+    assert families['command_max_time'][0] == 'gauge'
+    assert all(name.endswith('_total') for name, (metric_type, _) in
+               families.items() if metric_type == 'counter')
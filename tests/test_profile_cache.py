@@ -0,0 +1,55 @@
+import asyncio
+
+import pytest
+
+from ProfileCache import ProfileCache
+
+
+class SlowClient():
+    """Async client answering `users.profile.get` after a short wait"""
+    run_async = True
+
+    def __init__(self, error=None):
+        self.error = error
+        self.calls = 0
+
+    async def users_profile_get(self, user):
+        self.calls += 1
+        await asyncio.sleep(0.01)
+        if self.error is not None:
+            raise self.error
+        return {'profile': {'image_72': f'https://example.com/{user}.png'}}
+
+
+def test_concurrent_misses_share_one_call():
+    client = SlowClient()
+    cache = ProfileCache(client)
+
+    async def fetch():
+        return await asyncio.gather(*(cache.aimage(user)
+                                      for user in ('U1', 'U1', 'U2', 'U1')))
+
+    images = asyncio.run(fetch())
+
+    assert images[0] == images[1] == images[3] == 'https://example.com/U1.png'
+    assert client.calls == 2
+    assert asyncio.run(cache.aimage('U1')) == images[0]
+    assert client.calls == 2
+
+
+def test_concurrent_misses_share_the_error():
+    client = SlowClient(error=RuntimeError('slack is down'))
+    cache = ProfileCache(client)
+
+    async def fetch():
+        return await asyncio.gather(cache.aget('U1'),
+                                    cache.aget('U1'),
+                                    return_exceptions=True)
+
+    errors = asyncio.run(fetch())
+
+    assert [str(e) for e in errors] == ['slack is down'] * 2
+    assert client.calls == 1
+    with pytest.raises(RuntimeError):
+        asyncio.run(cache.aget('U1'))  # Errors aren't cached
+    assert client.calls == 2
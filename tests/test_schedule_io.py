@@ -0,0 +1,61 @@
+import mongomock
+import pymongo
+import pytest
+
+import ScheduleIO
+
+CSV = 'user_id,name,start_date,end_date\nU1,ann,2030-01-01,2030-01-05\nU2,bob,2030-13-01,2030-01-05\n'
+
+
+@pytest.fixture
+def mongo(monkeypatch):
+    client = mongomock.MongoClient()
+    monkeypatch.setattr(pymongo, 'MongoClient', lambda uri: client)
+    monkeypatch.setenv('MONGO_URI', 'mongodb://example:27017/')
+    return client
+
+
+@pytest.fixture
+def csv_file(tmp_path):
+    path = tmp_path / 'schedules.csv'
+    path.write_text(CSV)
+    return str(path)
+
+
+def test_imports_into_the_default_collection(mongo, csv_file):
+    assert ScheduleIO.main([csv_file]) == 1  # The bad row is rejected
+
+    stored = mongo['users']['scheduled_users'].find_one({'user_id': 'U1'})
+    assert stored['start_key'] == 20300101
+    assert 'updated_at' in stored  # So running servers reload their index
+
+
+def test_imports_into_a_stored_team(mongo, csv_file):
+    mongo['users']['workspaces'].insert_one({
+        'team_id': 'T1',
+        'bot_token': 'xoxb-test'
+    })
+    ScheduleIO.main([csv_file, '--team', 'T1'])
+
+    assert mongo['users']['scheduled_users_T1'].count_documents({}) == 1
+    assert mongo['users']['scheduled_users'].count_documents({}) == 0
+
+
+def test_unknown_team_is_an_error(mongo, csv_file):
+    with pytest.raises(SystemExit):
+        ScheduleIO.main([csv_file, '--team', 'T404'])
+
+
+def test_exports_users_without_a_name():
+    documents = [{
+        'user_id': 'U1',
+        'name': None,  # Saved by someone without a slack username
+        'start_date': ['2030', '01', '01'],
+        'end_date': ['2030', '01', '05']
+    }]
+
+    ics = ''.join(ScheduleIO.ics_lines(documents))
+    assert 'SUMMARY:U1 on call\r\n' in ics
+    assert 'X-SLACK-USER-NAME:\r\n' in ics
+    assert ''.join(ScheduleIO.csv_lines(documents)).splitlines()[1] == (
+        'U1,,2030-01-01,2030-01-05')
@@ -0,0 +1,41 @@
+import asyncio
+from datetime import datetime
+
+import mongomock
+
+from EventDedupe import MemoryEventDedupe
+from ShiftReminders import ShiftReminders
+from Workspaces import Workspaces
+
+
+def test_refill_keeps_going_when_a_team_fails():
+    now = [datetime(2030, 1, 1, 12).timestamp()]
+    workspaces = Workspaces(mongomock.MongoClient()['users'],
+                            transport=None)
+    reminders = ShiftReminders(workspaces,
+                               MemoryEventDedupe(),
+                               clock=lambda: now[0])
+    for team_id in ('T1', 'T2'):
+        workspaces.add(team_id, f'xoxb-{team_id}')
+        reminders.watch(workspaces.get(team_id))
+    workspaces.get('T2').db.append([{
+        'user_id': 'U1',
+        'start_date': ['2030', '01', '03'],
+        'end_date': ['2030', '01', '09']
+    }])  # Starts after the queued days
+
+    get = workspaces.get
+
+    def get_or_fail(team_id):
+        if team_id == 'T1':  # Like a team removed since it was watched
+            raise KeyError(team_id)
+        return get(team_id)
+
+    workspaces.get = get_or_fail
+    now[0] = datetime(2030, 1, 2).timestamp()
+    (refill, ) = reminders.due()
+    asyncio.run(reminders.send(refill))
+
+    queued = sorted((r.kind, r.team_id, r.day) for _, _, r in reminders._heap)
+    assert queued == [('refill', None, 20300103),
+                      ('start', 'T2', 20300103)]
@@ -0,0 +1,129 @@
+import socket
+import threading
+
+import pytest
+import requests
+
+from SlackTransport import PooledWebClient, SlackTransport, TokenBucket
+
+from fake_slack import FakeSlack
+
+
+@pytest.fixture
+def slack():
+    fake = FakeSlack().start()
+    yield fake
+    fake.stop()
+
+
+@pytest.fixture
+def waits():
+    return []  # Seconds the transport slept, in order
+
+
+@pytest.fixture
+def transport(waits):
+    return SlackTransport(max_retries=3, timeout=5, sleep=waits.append)
+
+
+def test_calls_go_through_the_fake_server(slack, transport):
+    client = PooledWebClient('xoxb-test',
+                             transport=transport,
+                             base_url=slack.base_url)
+    response = client.chat_postMessage(channel='C1', text='hi')
+
+    assert response['ok']
+    assert slack.count('chat.postMessage') == 1
+    assert transport.stats()['calls'] == 1
+
+
+def test_429_is_retried_after_exactly_retry_after(slack, transport, waits):
+    slack.script('users.info', (429, {'Retry-After': '1'}, {'ok': False}))
+
+    status, _, body = transport.call(slack.base_url, 'xoxb-test',
+                                     'users.info', params={'user': 'U1'})
+
+    assert status == 200 and body['ok']
+    assert slack.count('users.info') == 2
+    assert transport.stats()['retries'] == 1
+    assert waits == [pytest.approx(1, abs=0.05)]
+
+
+def test_429_gives_up_after_max_retries(slack, transport):
+    slack.script('users.info',
+                 *[(429, {'Retry-After': '0'}, {'ok': False})] * 4)
+
+    status, _, _ = transport.call(slack.base_url, 'xoxb-test', 'users.info')
+
+    assert status == 429
+    assert slack.count('users.info') == 4
+
+
+def test_identical_reads_in_flight_share_one_request(slack, transport):
+    slack.delay = 0.2
+    results = []
+
+    def get():
+        results.append(
+            transport.call(slack.base_url, 'xoxb-test', 'users.profile.get',
+                           params={'user': 'U1'}))
+
+    threads = [threading.Thread(target=get) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(results) == 5
+    assert slack.count('users.profile.get') == 1
+    assert transport.stats()['coalesced'] == 4
+
+
+def test_messages_are_rate_limited_per_channel(slack, transport, waits):
+    for i in range(8):
+        transport.call(slack.base_url, 'xoxb-test', 'chat.postMessage',
+                       json={'channel': f'C{i}', 'text': 'hi'})
+    assert waits == []  # Different channels don't wait on each other
+
+    for _ in range(8):
+        transport.call(slack.base_url, 'xoxb-test', 'chat.postMessage',
+                       json={'channel': 'C0', 'text': 'hi'})
+    assert len(waits) > 0  # One channel gets about one message a second
+
+
+def test_dropped_post_is_not_sent_twice(slack, transport):
+    slack.script('chat.postMessage', 'disconnect')
+
+    with pytest.raises(requests.ConnectionError):
+        transport.call(slack.base_url, 'xoxb-test', 'chat.postMessage',
+                       json={'channel': 'C1', 'text': 'hi'})
+    assert slack.count('chat.postMessage') == 1
+
+
+def test_dropped_read_is_retried(slack, transport):
+    slack.script('users.info', 'disconnect')
+
+    status, _, _ = transport.call(slack.base_url, 'xoxb-test', 'users.info',
+                                  params={'user': 'U1'})
+
+    assert status == 200
+    assert slack.count('users.info') == 2
+
+
+def test_refused_connection_is_retried_for_any_method(transport, waits):
+    with socket.socket() as sock:  # A port nothing listens on
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+
+    with pytest.raises(requests.ConnectionError):
+        transport.call(f'http://127.0.0.1:{port}/api/', 'xoxb-test',
+                       'chat.postMessage', json={'channel': 'C1'})
+    assert transport.stats()['retries'] == 3
+    assert waits == [1, 2, 4]
+
+
+def test_paused_bucket_waits_for_the_pause_only():
+    now = [0.0]
+    bucket = TokenBucket(60, burst=6, clock=lambda: now[0])
+    bucket.pause(1)
+    assert bucket.reserve() == pytest.approx(1)
@@ -0,0 +1,76 @@
+import mongomock
+import pytest
+
+from Workspaces import DEFAULT_TEAM, Workspaces
+
+
+@pytest.fixture
+def workspaces():
+    return Workspaces(mongomock.MongoClient()['users'],
+                      transport=None,
+                      default_tokens=('xoxb-default', 'xoxp-default'),
+                      default_export_token='secret')
+
+
+def test_every_team_uses_the_default_workspace_until_one_is_stored(
+        workspaces):
+    assert workspaces.get('T1').team_id == DEFAULT_TEAM
+    assert workspaces.get(None) is workspaces.get('T2')
+    assert len(workspaces.loaded()) == 1
+
+
+def test_unknown_teams_are_refused_and_not_cached(workspaces):
+    workspaces.add('T0', 'xoxb-t0')
+    workspaces.add('T1', 'xoxb-t1')
+
+    assert workspaces.get('T1').db.collection == 'scheduled_users_T1'
+    for i in range(5):
+        with pytest.raises(KeyError):
+            workspaces.get(f'T{i + 2}')
+    assert sorted(ws.team_id for ws in workspaces.loaded()) == ['T1']
+
+
+def test_exports_need_the_workspace_token(workspaces):
+    assert workspaces.get(None).allows_export('secret')
+    token = workspaces.add('T1', 'xoxb-t1')
+    ws = workspaces.get('T1')
+
+    assert token and ws.allows_export(token)
+    assert not ws.allows_export(None)
+    assert not ws.allows_export('secret')
+    assert workspaces.add('T1', 'xoxb-new') == token  # Storing it again keeps the token
+    assert not workspaces.get(None).allows_export('secret')  # T1 took over the default workspace
+
+
+def test_the_first_team_stored_keeps_the_default_schedules(workspaces):
+    default = workspaces.get(None)
+    default.db.append([{'user_id': 'U1', 'name': 'Ann'}], flush=False)
+
+    workspaces.add('T1', 'xoxb-t1')
+    workspaces.add('T1', 'xoxb-new')  # Storing it again keeps the collection
+    workspaces.add('T2', 'xoxb-t2')
+    workspaces.add('T3', 'xoxb-t3', collection='team_three')
+
+    assert workspaces.get('T1').db.collection == 'scheduled_users'
+    assert workspaces.get('T1').schedule_index.get('U1')['name'] == 'Ann'
+    assert workspaces.get(None) is workspaces.get('T1')
+    assert workspaces.get('T2').db.collection == 'scheduled_users_T2'
+    assert workspaces.get('T3').db.collection == 'team_three'
+
+
+def test_idle_workspaces_are_flushed_and_dropped():
+    workspaces = Workspaces(mongomock.MongoClient()['users'],
+                            transport=None,
+                            max_workspaces=2,
+                            buffer_size=10)
+    for team_id in ('T1', 'T2', 'T3'):
+        workspaces.add(team_id, f'xoxb-{team_id}')
+    first = workspaces.get('T1')
+    first.db.append([{'user_id': 'U1', 'name': 'Ann'}])
+    workspaces.get('T2')
+    workspaces.get('T3')
+
+    assert sorted(ws.team_id for ws in workspaces.loaded()) == ['T2', 'T3']
+    assert workspaces.stats()['workspace_evictions'] == 1
+    assert workspaces.get('T1') is not first
+    assert workspaces.get('T1').schedule_index.get('U1')['name'] == 'Ann'